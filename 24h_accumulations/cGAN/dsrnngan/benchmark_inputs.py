@@ -0,0 +1,116 @@
+# Time the building of the network inputs from an IFS file, by
+# data.set_fcst_channels and data.normalise_fcst as used by forecast_date.py
+# and the training DataGenerator, against the per-field code they replaced.
+#
+# Usage:
+#    python benchmark_inputs.py ../../IFS_forecast_data/IFS_20241022_00Z.nc [--repeats 5]
+#
+# The fields are read from the file once, so the times are of the array
+# operations alone, for the 7 valid times of a forecast.  The largest
+# difference between the two inputs should be float32 rounding.
+
+import argparse
+import time
+
+import netCDF4 as nc
+import numpy as np
+
+from data import HOURS, all_fcst_fields, accumulated_fields, nonnegative_fields, fcst_norm, logprec
+from data import set_fcst_channels, normalise_fcst, channels_last
+from forecast_date import period_windows
+
+
+def build_inputs_slow(means, sds, valid_time_nums):
+    '''
+    The network inputs, len(valid_time_nums) x lat x lon x 2*len(all_fcst_fields),
+    from the ensemble means and standard deviations of each field, where
+    means[field][i] is time step i+1, as load_fcst_inputs used to make them,
+    one field at a time.
+    '''
+    num_periods = valid_time_nums.max() + 1
+    field_arrays = []
+    for field in all_fcst_fields:
+        all_data_mean = means[field]
+        all_data_var = sds[field]**2  # Convert to variances
+        period_data_mean = all_data_mean[:num_periods*4].reshape((num_periods, 4) + all_data_mean.shape[1:])[valid_time_nums]
+        period_data_var = all_data_var[:num_periods*4].reshape((num_periods, 4) + all_data_var.shape[1:])[valid_time_nums]
+
+        if field in accumulated_fields:
+            data1 = np.mean(period_data_mean, axis=1)            # Mean of the accumulations
+            data2 = np.sqrt(np.mean(period_data_var, axis=1))    # RMS of the standard deviations
+            data = np.stack([data1, data2], axis=-1)
+        else:
+            end_data_mean = all_data_mean[valid_time_nums*4+4]
+            end_data_var = all_data_var[valid_time_nums*4+4]
+            data1 = (period_data_mean[:, 0]/2 + np.sum(period_data_mean[:, 1:4], axis=1) + end_data_mean/2)/4
+            data2 = (period_data_var[:, 0]/2 + np.sum(period_data_var[:, 1:4], axis=1) + end_data_var/2)/4
+            data = np.stack([data1, np.sqrt(data2)], axis=-1)
+
+        if field in nonnegative_fields:
+            data = np.maximum(data, 0.0)  # eliminate any data weirdness/regridding issues
+
+        if field in ["tp", "cp"]:
+            data *= 1000
+            data /= HOURS  # convert to mm/hr
+        elif field in accumulated_fields:
+            data /= (HOURS*3600)  # convert from a 6-hr difference to a per-second rate
+
+        if field in ["tp", "cp"]:
+            data = logprec(data, True)
+        elif field in ["mcc"]:
+            pass
+        elif field in ["sp", "t2m"]:
+            data[..., 0] -= fcst_norm[field]["mean"]
+            data /= fcst_norm[field]["std"]
+        elif field in nonnegative_fields:
+            data /= fcst_norm[field]["max"]
+        else:
+            data /= max(-fcst_norm[field]["min"], fcst_norm[field]["max"])
+
+        field_arrays.append(data)
+
+    return np.concatenate(field_arrays, axis=-1)
+
+
+def build_inputs(means, sds, valid_time_nums):
+    # As build_inputs_slow, using the code shared with training
+    shape = means[all_fcst_fields[0]].shape[1:]
+    channels = np.empty((2*len(all_fcst_fields), len(valid_time_nums)) + shape, dtype=np.float32)
+    for f, field in enumerate(all_fcst_fields):
+        set_fcst_channels(channels, f, field, period_windows(means[field], valid_time_nums),
+                          period_windows(sds[field], valid_time_nums))
+    normalise_fcst(channels, all_fcst_fields, log_precip=True, norm=fcst_norm)
+    return channels_last(channels)
+
+
+def best_time(function, repeats):
+    # The shortest of repeats calls of function, and its result
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time the building of the cGAN network inputs.")
+    parser.add_argument("ifs_file", help="IFS_*.nc file")
+    parser.add_argument("--repeats", help="Repeats of each timing, the shortest is reported", default=5, type=int)
+    args = parser.parse_args()
+
+    valid_time_nums = np.arange(7)
+    num_steps = len(valid_time_nums)*4 + 1
+    nc_in = nc.Dataset(args.ifs_file, mode="r")
+    means = {field: np.array(nc_in[f"{field}_ensemble_mean"][1:num_steps+1]) for field in all_fcst_fields}
+    sds = {field: np.array(nc_in[f"{field}_ensemble_standard_deviation"][1:num_steps+1])
+           for field in all_fcst_fields}
+    nc_in.close()
+
+    time_slow, inputs_slow = best_time(lambda: build_inputs_slow(means, sds, valid_time_nums), args.repeats)
+    time_new, inputs_new = best_time(lambda: build_inputs(means, sds, valid_time_nums), args.repeats)
+    max_diff = np.abs(inputs_new - inputs_slow).max()
+
+    print(f"Per-field: {time_slow*1000:.1f} ms  Shared: {time_new*1000:.1f} ms  "
+          f"Speed-up: {time_slow/time_new:.1f}x  Largest difference: {max_diff:.2e}")
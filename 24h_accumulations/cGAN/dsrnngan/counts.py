@@ -0,0 +1,118 @@
+# Histogram counts of the cGAN ensemble at each grid point, as shown by the
+# interface.  Used by forecast_date.py to bin the ensemble members as they
+# are generated, and by the forecast2histogram scripts to bin them from the
+# GAN_*.nc files afterwards.
+
+import netCDF4 as nc
+import numpy as np
+
+# Define the bins we will use on an approximate log scale (mm/h)
+# Also used by ../../forecast2histogram_7d_lowRAM.py
+bin_spec_1h = np.array([0,0.04,0.1,0.25,0.4,0.6,0.8,1,1.25,1.5,
+                        1.8,2.2,2.6,3,3.5,4,4.7,5.4,6.1,7,
+                        8,9.1,10.3,11.7,13.25,15,1000])
+
+
+def count_edges(bins, dtype):
+    '''
+    The bin edges in dtype for counting values of that dtype: x >= edges[e]
+    exactly when x >= bins[e], for each bin e, and x > top exactly when x is
+    beyond bins[-1].  np.histogram includes the right hand edge in the last
+    bin, so top is the largest value <= bins[-1].
+    '''
+    dtype = np.dtype(dtype)
+    # The smallest value >= each edge
+    edges = bins[:-1].astype(dtype)
+    low = edges < bins[:-1]
+    edges[low] = np.nextafter(edges[low], dtype.type(np.inf))
+    top = bins.astype(dtype)[-1]
+    if top > bins[-1]:
+        top = np.nextafter(top, dtype.type(-np.inf))
+    return edges, top
+
+
+def add_counts(counts, precip, bins=bin_spec_1h, member_block_size=128):
+    '''
+    Add the histogram counts of the ensemble members precip (members x lat x lon)
+    to counts (len(bins)-1 x lat x lon), in place.
+    The same bins are used as np.histogram(precip[:, j, i], bins), so values
+    outside bins[0] to bins[-1] are not counted.
+    member_block_size members are compared with the bin edges at a time, so
+    that they stay in the CPU cache.
+    '''
+    num_bins = len(bins) - 1
+
+    # Compare in the precision of precip
+    edges, top = count_edges(bins, precip.dtype)
+
+    # The number of members >= each bin edge at each grid point.
+    # The count in bin e is then num_ge[e] - num_ge[e+1].
+    num_ge = np.zeros((num_bins+1,) + precip.shape[1:], dtype=np.int64)
+    is_ge = np.empty((min(member_block_size, precip.shape[0]),) + precip.shape[1:], dtype=bool)
+    for m in range(0, precip.shape[0], member_block_size):
+        block = precip[m:m+member_block_size]
+        block_is_ge = is_ge[:block.shape[0]]
+        for e in range(num_bins):
+            np.greater_equal(block, edges[e], out=block_is_ge)
+            num_ge[e] += np.add.reduce(block_is_ge.view(np.uint8), axis=0, dtype=np.uint16)
+        np.greater(block, top, out=block_is_ge)
+        num_ge[num_bins] += np.add.reduce(block_is_ge.view(np.uint8), axis=0, dtype=np.uint16)
+
+    counts += (num_ge[:-1] - num_ge[1:]).astype(counts.dtype)
+
+
+def write_counts_file(file_name, latitude, longitude, time, valid_time, counts, num_members, bins=bin_spec_1h):
+    '''
+    Write the histogram counts (len(bins)-1 x lat x lon) for one valid time
+    to file_name, in the format read by the interface.
+    Counts in bin zero are not stored.
+    '''
+    # Create a new NetCDF file
+    rootgrp = nc.Dataset(file_name, "w", format="NETCDF4")
+
+    # Describe where this data comes from
+    rootgrp.description = "cGAN forecast histogram counts"
+
+    # Create dimensions
+    rootgrp.createDimension("longitude", len(longitude))
+    rootgrp.createDimension("latitude", len(latitude))
+    rootgrp.createDimension("time", 1)
+    rootgrp.createDimension("valid_time", 1)
+    rootgrp.createDimension("bins", len(bins)-2)
+
+    # Create the longitude variable
+    longitude_data = rootgrp.createVariable("longitude", "f4", ("longitude"), zlib=False)
+    longitude_data.units = "degrees_east"
+    longitude_data[:] = longitude   # Write the longitude data
+
+    # Create the latitude variable
+    latitude_data = rootgrp.createVariable("latitude", "f4", ("latitude"), zlib=False)
+    latitude_data.units = "degrees_north"
+    latitude_data[:] = latitude     # Write the latitude data
+
+    # Create the time variable
+    time_data = rootgrp.createVariable("time", "f4", ("time"), zlib=False)
+    time_data.units = "hours since 1900-01-01 00:00:00.0"
+    time_data.description = "Time corresponding to forecast model start"
+    time_data[:] = time         # Write the forecast model start time
+
+    # Create the valid_time variable
+    valid_time_data = rootgrp.createVariable("valid_time", "f4", ("valid_time"), zlib=False)
+    valid_time_data.units = "hours since 1900-01-01 00:00:00.0"
+    valid_time_data.description = "Time corresponding to forecast prediction"
+    valid_time_data[:] = valid_time  # Write the forecast model valid time
+
+    # Bin specification. First bin is zero, final bin is infinity.
+    bins_data = rootgrp.createVariable("bins", "f4", ("bins"), zlib=False)
+    bins_data.units = "mm/h"
+    bins_data.description = "Histogram bin edges"
+    bins_data[:] = bins[1:-1]  # Write histogram bin specification
+
+    # Create the counts variable
+    counts_data = rootgrp.createVariable("counts", "i2", ("bins","latitude","longitude"), zlib=True, complevel=9)
+    counts_data.description = "Histogram bin counts"
+    counts_data.num_members = num_members
+    counts_data[:] = counts[1:, :, :]
+
+    # Close the netCDF file
+    rootgrp.close()
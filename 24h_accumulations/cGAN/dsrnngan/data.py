@@ -1,13 +1,14 @@
 """ File for handling data loading and saving. """
 import os
 import datetime
+import functools
 import pickle
 
 import numpy as np
 import netCDF4 as nc
-import xarray as xr
 
 import read_config
+from constants_cache import cache_path, cached_array, norm_to_array, array_to_norm
 
 
 data_paths = read_config.get_data_paths()
@@ -123,6 +124,7 @@ def load_truth_and_mask(date,
     fname = valid_dt.strftime('%Y%m%d_%H')
     data_path = os.path.join(TRUTH_PATH, f"{valid_dt.year}/{fname}.nc")
 
+    import xarray as xr  # slow to import, so only imported where it is used
     ds = xr.open_dataset(data_path)
     da = ds["precipitation"]
     y = da.values
@@ -139,7 +141,10 @@ def load_truth_and_mask(date,
         return y, mask
 
 
-def load_hires_constants(batch_size=1):
+def read_hires_constants():
+    # The hi-res constants from CONSTANTS_PATH, H x W x 2
+    import xarray as xr
+
     oro_path = os.path.join(CONSTANTS_PATH, "elev.nc")
     df = xr.load_dataset(oro_path)
     # Orography in m.  Divide by 10,000 to give O(1) normalisation
@@ -153,7 +158,16 @@ def load_hires_constants(batch_size=1):
     lsm = df["lsm"].values
     df.close()
 
-    temp = np.stack([z, lsm], axis=-1)  # shape H x W x 2
+    return np.stack([z, lsm], axis=-1)  # shape H x W x 2
+
+
+def load_hires_constants(batch_size=1):
+    # The hi-res constants, mapped read-only from their cache, see constants_cache.py
+    temp = cached_array(cache_path(CONSTANTS_PATH, "constants"),
+                        [os.path.join(CONSTANTS_PATH, "elev.nc"), os.path.join(CONSTANTS_PATH, "lsm.nc")],
+                        read_hires_constants)  # shape H x W x 2
+    if batch_size == 1:
+        return temp[np.newaxis, ...]  # shape 1 x H x W x 2, still mapped
     return np.repeat(temp[np.newaxis, ...], batch_size, axis=0)  # shape batch_size x H x W x 2
 
 
@@ -171,30 +185,157 @@ def load_fcst_truth_batch(dates_batch,
         log_precip (bool): Whether to apply log10(1+x) transform to precip-related forecast fields, and truth
         norm (bool): Whether to apply normalisation to forecast fields to make O(1)
     '''
-    batch_x = []  # forecast
+    batch_x = load_fcst_batch(dates_batch, time_idx_batch, fcst_fields, log_precip=log_precip, norm=norm)  # forecast
     batch_y = []  # truth
     batch_mask = []  # mask
 
     for time_idx, date in zip(time_idx_batch, dates_batch):
-        batch_x.append(load_fcst_stack(fcst_fields, date, time_idx, log_precip=log_precip, norm=norm))
         truth, mask = load_truth_and_mask(date, time_idx, log_precip=log_precip)
         batch_y.append(truth)
         batch_mask.append(mask)
 
-    return np.array(batch_x), np.array(batch_y), np.array(batch_mask)
+    return batch_x, np.array(batch_y), np.array(batch_mask)
 
 
-def load_fcst(field,
-              date,
-              time_idx,
-              log_precip=False,
-              norm=False):
+def load_fcst_batch(dates_batch,
+                    time_idx_batch,
+                    fcst_fields=all_fcst_fields,
+                    log_precip=False,
+                    norm=False):
+    '''
+    Returns the forecast fields for each date and time interval,
+    batch x H x W x 2*len(fcst_fields), see set_fcst_channels.  The fields are
+    read into one array, then normalised together.
     '''
-    Returns forecast field data for the given date and time interval.
+    channels = None  # allocated once the grid size is known
+    for i, (time_idx, date) in enumerate(zip(time_idx_batch, dates_batch)):
+        for f, field in enumerate(fcst_fields):
+            mean, sd = read_fcst(field, date, time_idx)
+            if channels is None:
+                channels = np.empty((2*len(fcst_fields), len(dates_batch)) + mean.shape[1:], dtype=np.float32)
+            set_fcst_channels(channels[:, i:i+1], f, field, mean[np.newaxis], sd[np.newaxis])
 
-    Four channels are returned for each field:
-        - instantaneous fields: mean and stdev at the start of the interval, mean and stdev at the end of the interval
-        - accumulated field: mean and stdev of increment over the interval, and the last two channels are all 0
+    normalise_fcst(channels, fcst_fields, log_precip=log_precip, norm=get_fcst_norm(norm))
+    return channels_last(channels)
+
+
+# Weights of the five 6h time steps of a 24h period, the first four of which
+# start the accumulations of accumulated fields
+accumulated_weights = np.array([1, 1, 1, 1, 0], dtype=np.float32)/4  # Mean of the accumulations
+trapezium_weights = np.array([1/2, 1, 1, 1, 1/2], dtype=np.float32)/4  # Trapezium rule
+
+
+def set_fcst_channels(channels, f, field, mean, sd):
+    '''
+    Set the two channels of field, number f of the fields in channels
+    (2*len(fields) x T x lat x lon), from the ensemble mean and standard
+    deviation (T x 5 x lat x lon) at the five 6h time steps spanning each of
+    the T 24h periods:
+        - instantaneous fields: mean and stdev computed using the trapezium rule
+        - accumulated field: mean of the accumulations and RMS of their standard deviations
+    Accumulated fields have been pre-processed s.t. mean[:, j] has the
+    accumulation between times j and j+1.
+    The channels come first so that each is written in one contiguous block;
+    channels_last puts them in the network's order.
+    '''
+    weights = accumulated_weights if field in accumulated_fields else trapezium_weights
+    c = 2*f
+    # Weighted sums over the time steps, one step at a time to keep the temporary arrays small
+    np.multiply(mean[:, 0], weights[0], out=channels[c])
+    np.multiply(np.square(sd[:, 0]), weights[0], out=channels[c+1])  # Convert to variances
+    for k in range(1, len(weights)):
+        if weights[k] != 0:
+            channels[c] += weights[k]*mean[:, k]
+            channels[c+1] += weights[k]*np.square(sd[:, k])
+    np.sqrt(channels[c+1], out=channels[c+1])
+
+
+def channels_last(channels):
+    # T x lat x lon x channels, the network input, from channels x T x lat x lon
+    return np.ascontiguousarray(np.moveaxis(channels, 0, -1))
+
+
+def fcst_transform(fields, log_precip=False, norm=None):
+    '''
+    Returns the arrays lower, offset and scale, with a value for each of the
+    2*len(fields) channels set by set_fcst_channels, and the channels to
+    log10(1+x) transform, which normalise_fcst applies as
+    (max(x, lower) + offset)*scale, then log10(1+x) for those channels.
+    norm is the normalisation dictionary, fcst_norm, or None to only convert
+    the units.
+    '''
+    lower = np.full(2*len(fields), -np.inf, dtype=np.float32)
+    offset = np.zeros(2*len(fields), dtype=np.float32)
+    scale = np.ones(2*len(fields), dtype=np.float32)
+    log_channels = []
+    for f, field in enumerate(fields):
+        c = slice(2*f, 2*f+2)
+        if field in nonnegative_fields:
+            lower[c] = 0.0  # eliminate any data weirdness/regridding issues
+
+        if field in ["tp", "cp"]:
+            # precip is measured in metres, so multiply to get mm
+            units = 1000/HOURS  # convert to mm/hr
+        elif field in accumulated_fields:
+            # for all other accumulated fields [just ssr for us]
+            units = 1/(HOURS*3600)  # convert from a 6-hr difference to a per-second rate
+        else:
+            units = 1.0
+        scale[c] = units
+
+        if field in ["tp", "cp"] and log_precip:
+            log_channels.append(c)
+        elif norm is not None:
+            # apply transformation to make fields O(1), based on historical
+            # forecast data from one of the training years
+            if field in ["mcc"]:
+                # already 0-1
+                pass
+            elif field in ["sp", "t2m"]:
+                # these are bounded well away from zero, so subtract mean from ens mean (but NOT from ens sd!)
+                offset[2*f] = -norm[field]["mean"]/units
+                scale[c] = units/norm[field]["std"]
+            elif field in nonnegative_fields:
+                scale[c] = units/norm[field]["max"]
+            else:
+                # winds
+                scale[c] = units/max(-norm[field]["min"], norm[field]["max"])
+    return lower, offset, scale, log_channels
+
+
+def normalise_fcst(channels, fields, log_precip=False, norm=None):
+    '''
+    Convert the units of channels (2*len(fields) x ...), set by
+    set_fcst_channels, and normalise them with norm, the normalisation
+    dictionary or None, in place.  Every channel is done at once, so this is
+    a few operations on the whole array.  Returns channels.
+    '''
+    lower, offset, scale, log_channels = fcst_transform(fields, log_precip, norm)
+    shape = (-1,) + (1,)*(channels.ndim-1)
+    np.maximum(channels, lower.reshape(shape), out=channels)
+    channels += offset.reshape(shape)
+    channels *= scale.reshape(shape)
+    for c in log_channels:
+        # logprec, log10(1+x)
+        np.log1p(channels[c], out=channels[c])
+        channels[c] *= 1/np.log(10)
+    return channels
+
+
+def get_fcst_norm(norm):
+    # fcst_norm if norm is True, otherwise None
+    if not norm:
+        return None
+    if default_fcst_norm() is None:
+        raise RuntimeError("Forecast normalisation dictionary has not been loaded")
+    return default_fcst_norm()
+
+
+def read_fcst(field, date, time_idx):
+    '''
+    Returns the ensemble mean and standard deviation of field, each
+    5 x lat x lon, at the time steps of the 24h period starting at LEAD_IDX
+    of the forecast on date.
     '''
 
     # print(f"Loading forecast {field} on {date}")
@@ -209,62 +350,28 @@ def load_fcst(field,
 
     # open using netCDF
     nc_file = nc.Dataset(ds_path, mode="r")
-    all_data_mean = nc_file[f"{field}_mean"]
-    all_data_sd = nc_file[f"{field}_sd"]
     # data is stored as [day of year, valid time index, lat, lon]
 
     # calculate first index (i.e., day of year, with Jan 1 = 0)
     fcst_date = datetime.datetime.strptime(date, "%Y%m%d").date()
     fcst_idx = fcst_date.toordinal() - datetime.date(year, 1, 1).toordinal()
 
-    if field in accumulated_fields:
-        # return mean, sd, 0, 0.  zero fields are so that each field returns a 4 x ny x nx array.
-        # accumulated fields have been pre-processed s.t. data[:, j, :, :] has accumulation between times j and j+1
-        data1 = np.mean(all_data_mean[fcst_idx, lead_idx:lead_idx+4, :, :], axis=0)            # Mean of the accumulations
-        data2 = np.sqrt(np.mean(all_data_sd[fcst_idx, lead_idx:lead_idx+4, :, :]**2, axis=0))  # RMS of the standard deviations
-        data = np.stack([data1, data2], axis=-1)
-    else:
-        # return mean and std computed using the trapezium rule
-        temp_data_mean = all_data_mean[fcst_idx, lead_idx:lead_idx+5, :, :]
-        temp_data_var = all_data_sd[fcst_idx, lead_idx:lead_idx+5, :, :]**2  # Convert to variances
-        data1 = (temp_data_mean[0, :, :]/2 + np.sum(temp_data_mean[1:4,:,:], axis=0) + temp_data_mean[4,:,:]/2)/4
-        data2 = (temp_data_var[0, :, :]/2 + np.sum(temp_data_var[1:4,:,:], axis=0) + temp_data_var[4,:,:]/2)/4
-        data = np.stack([data1, np.sqrt(data2)], axis=-1)
-
+    mean = np.array(nc_file[f"{field}_mean"][fcst_idx, lead_idx:lead_idx+5, :, :])
+    sd = np.array(nc_file[f"{field}_sd"][fcst_idx, lead_idx:lead_idx+5, :, :])
     nc_file.close()
+    return mean, sd
 
-    if field in nonnegative_fields:
-        data = np.maximum(data, 0.0)  # eliminate any data weirdness/regridding issues
-
-    if field in ["tp", "cp"]:
-        # precip is measured in metres, so multiply to get mm
-        data *= 1000
-        data /= HOURS  # convert to mm/hr
-    elif field in accumulated_fields:
-        # for all other accumulated fields [just ssr for us]
-        data /= (HOURS*3600)  # convert from a 6-hr difference to a per-second rate
 
-    if field in ["tp", "cp"] and log_precip:
-        return logprec(data, log_precip)
-    elif norm:
-        # apply transformation to make fields O(1), based on historical
-        # forecast data from one of the training years
-        if fcst_norm is None:
-            raise RuntimeError("Forecast normalisation dictionary has not been loaded")
-        if field in ["mcc"]:
-            # already 0-1
-            return data
-        elif field in ["sp", "t2m"]:
-            # these are bounded well away from zero, so subtract mean from ens mean (but NOT from ens sd!)
-            data[:, :, 0] -= fcst_norm[field]["mean"]
-            return data/fcst_norm[field]["std"]
-        elif field in nonnegative_fields:
-            return data/fcst_norm[field]["max"]
-        else:
-            # winds
-            return data/max(-fcst_norm[field]["min"], fcst_norm[field]["max"])
-    else:
-        return data
+def load_fcst(field,
+              date,
+              time_idx,
+              log_precip=False,
+              norm=False):
+    '''
+    Returns forecast field data for the given date and time interval,
+    lat x lon x 2, with the channels described in set_fcst_channels.
+    '''
+    return load_fcst_stack([field], date, time_idx, log_precip=log_precip, norm=norm)
 
 
 def load_fcst_stack(fields,
@@ -274,13 +381,10 @@ def load_fcst_stack(fields,
                     norm=False):
     '''
     Returns forecast fields, for the given date and time interval.
-    Each field returned by load_fcst has two channels (see load_fcst for details),
-    then these are concatentated to form an array of H x W x 4*len(fields)
+    Each field has two channels (see set_fcst_channels for details),
+    so this is an array of H x W x 2*len(fields)
     '''
-    field_arrays = []
-    for f in fields:
-        field_arrays.append(load_fcst(f, date, time_idx, log_precip=log_precip, norm=norm))
-    return np.concatenate(field_arrays, axis=-1)
+    return load_fcst_batch([date], [time_idx], fields, log_precip=log_precip, norm=norm)[0]
 
 
 def get_fcst_stats_slow(field, year=2018):
@@ -371,19 +475,37 @@ def gen_fcst_norm(year=2018):
         pickle.dump(stats_dic, f)
 
 
-def load_fcst_norm(year=2018):
-    print("In load_fcst_norm")
+def read_fcst_norm(year=2018):
     fcstnorm_path = os.path.join(NORMALISATION_PATH, f"FCSTNorm{year}.pkl")
-    print(f"fcstnorm_path = {fcstnorm_path}")
     with open(fcstnorm_path, 'rb') as f:
         return pickle.load(f)
 
 
-try:
-    print("Loading forecast normalisations")
-    fcst_norm = load_fcst_norm(2018)
-except:  # noqa
-    fcst_norm = None
-    print("******************************************")
-    print("*** FORECAST NORMALISATIONS NOT LOADED ***")
-    print("******************************************")
+def load_fcst_norm(year=2018):
+    # The normalisation dictionary, from its cache, see constants_cache.py
+    fcstnorm_path = os.path.join(NORMALISATION_PATH, f"FCSTNorm{year}.pkl")
+    table = cached_array(cache_path(NORMALISATION_PATH, f"FCSTNorm{year}"), [fcstnorm_path],
+                         lambda: norm_to_array(read_fcst_norm(year)))
+    return array_to_norm(table)
+
+
+@functools.lru_cache(maxsize=None)
+def default_fcst_norm():
+    # The normalisation dictionary used by the forecasts, or None if it
+    # cannot be loaded.  Loaded on first use, as data.fcst_norm.
+    try:
+        print("Loading forecast normalisations")
+        return load_fcst_norm(2018)
+    except:  # noqa
+        print("******************************************")
+        print("*** FORECAST NORMALISATIONS NOT LOADED ***")
+        print("******************************************")
+        return None
+
+
+def __getattr__(name):
+    # fcst_norm is only loaded when it is first used, so that the modules
+    # that do not need it import quickly
+    if name == "fcst_norm":
+        return default_fcst_norm()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -14,6 +14,24 @@
 # A more robust version of this script would parse the latitudes, longitudes, and
 # forecast time info from the input file.
 # The forecast data fields must match those defined in data.all_fcst_fields
+#
+# Usage:
+#    python forecast_date.py valid_time_num YYYYMMDD
+#    python forecast_date.py 0,1,2 YYYYMMDD
+#    python forecast_date.py all YYYYMMDD
+#    python forecast_date.py all YYYYMMDD START:STOP
+#
+# With START:STOP only ensemble members START to STOP-1 are made, and they
+# are written to the shards directories described in shards.py.
+#
+# When several valid times are given the IFS file is read once for all of
+# them, and valid times that use the same model are generated together.
+#
+# The functions below are also used by forecast_worker.py, which keeps the
+# generators loaded between forecasts.
+#
+# The time taken by each stage is appended to the run log timing_log in
+# forecast.yaml; see timing.py to summarise it.
 
 import os
 import sys
@@ -24,22 +42,22 @@ import netCDF4 as nc
 import numpy as np
 from tensorflow.keras.utils import Progbar
 
-from data import HOURS, all_fcst_fields, accumulated_fields, nonnegative_fields, fcst_norm, logprec, denormalise, load_hires_constants
+from data import HOURS, all_fcst_fields, fcst_norm, denormalise, load_hires_constants, set_fcst_channels, normalise_fcst, channels_last
 import read_config
 from noise import NoiseGenerator
-from setupmodel import setup_model
+from counts import bin_spec_1h, add_counts, write_counts_file
+from convergence import ConvergenceMonitor
+from shards import shard_path
+from writer import EnsembleWriter
+from packing import packed_dtype, set_packing, pack_precipitation
+from quantiles import EnsembleQuantiles, quantiles_path, create_quantiles_file
+from timing import span, start_run, end_run
+import models
+from inference import CachedConstantsGenerator, SplitFirstBlockGenerator, ExportedGenerator, TFLiteGenerator, \
+    TiledGenerator
 
 from datetime import datetime, timedelta
 
-# Get the valid time number from the command line
-valid_time_num = int(sys.argv[1])
-
-# Get the date from the command line argument
-time_str = sys.argv[2]
-# year = int(time_str[0:4])
-# month = int(time_str[4:6])
-# day = int(time_str[6:8])
-
 # In[2]:
 
 
@@ -48,101 +66,169 @@ latitude = np.arange(-13.65, 24.7, 0.1)
 longitude = np.arange(19.15, 54.3, 0.1)
 
 # Some setup
-read_config.set_gpu_mode()  # set up whether to use GPU, and mem alloc mode
 data_paths = read_config.get_data_paths()  # need the constants directory
 downscaling_steps = read_config.read_downscaling_factor()["steps"]
 assert fcst_norm is not None
 
+# The model folder and checkpoint used for each valid_time_num
+# For 7x 24h forecasts with lead times of 6, 30, 54, 78, 102, 126, 150 hours
+lead_time_models = {0: ("../logs_1", 203776),
+                    1: ("../logs_5", 163840),
+                    2: ("../logs_17", 115200),
+                    3: ("../logs_17", 115200),
+                    4: ("../logs_17", 115200),
+                    5: ("../logs_17", 115200),
+                    6: ("../logs_17", 115200)}
+
 
 # In[3]:
 
 
-# Open and parse forecast.yaml
-#fcstyaml_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "forecast.yaml")
-fcstyaml_path = "forecast.yaml"
-with open(fcstyaml_path, "r") as f:
-    try:
-        fcst_params = yaml.safe_load(f)
-    except yaml.YAMLError as exc:
-        print(exc)
+def load_fcst_params(fcstyaml_path="forecast.yaml"):
+    # Open and parse forecast.yaml
+    with open(fcstyaml_path, "r") as f:
+        try:
+            fcst_params = yaml.safe_load(f)
+        except yaml.YAMLError as exc:
+            print(exc)
+
+    assert fcst_params["INPUT"]["start_hour"] % HOURS == 0, f"start_hour must be divisible by {HOURS}"
+    assert fcst_params["INPUT"]["end_hour"] % HOURS == 0, f"end_hour must be divisible by {HOURS}"
+    assert fcst_params["OUTPUT"]["member_batch_size"] >= 1, "member_batch_size must be at least 1"
+    assert fcst_params["OUTPUT"]["write_ensemble"] or fcst_params["OUTPUT"]["write_counts"], \
+        "at least one of write_ensemble and write_counts must be True"
+    assert not (fcst_params["OUTPUT"]["adaptive_members"] and fcst_params["OUTPUT"]["write_ensemble"]), \
+        "adaptive_members needs write_ensemble: False, as GAN_*.nc has a fixed number of members"
+    return fcst_params
+
+
+def start_timing(fcst_params, script, ensemble_members, **info):
+    # Start timing a run of script that makes ensemble_members members, in
+    # the run log given in fcst_params, see timing.py
+    start_run(fcst_params["OUTPUT"]["timing_log"], script=script, ensemble_members=ensemble_members,
+              config={section: fcst_params[section] for section in ("MODEL", "OUTPUT")}, **info)
 
 
 # In[4]:
 
-if (valid_time_num == 0):
-    model_folder = "../logs_1"
-    checkpoint = 203776
-elif (valid_time_num == 1):
-    model_folder = "../logs_5"
-    checkpoint = 163840
-elif (valid_time_num > 6):
-    print("ERROR: valid_time_num (1st argument) can be 0,1,2,3,4,5,6")
-    sys.exit(1)
-else:
-    model_folder = "../logs_17"
-    checkpoint = 115200
-print(f"Using model in {model_folder} checkpoint {checkpoint}.")
-
-#model_folder = fcst_params["MODEL"]["folder"]
-#checkpoint = fcst_params["MODEL"]["checkpoint"]
-
-input_folder = fcst_params["INPUT"]["folder"]
-
-#input_file = fcst_params["INPUT"]["file"]
-# Instead of reading input_file from forecast.yaml, get it from the command line
-input_file = f"IFS_{time_str}_00Z.nc"
-
-start_hour = fcst_params["INPUT"]["start_hour"]
-end_hour = fcst_params["INPUT"]["end_hour"]
-output_folder = fcst_params["OUTPUT"]["folder"]
-ensemble_members = fcst_params["OUTPUT"]["ensemble_members"]
-
-assert start_hour % HOURS == 0, f"start_hour must be divisible by {HOURS}"
-assert end_hour % HOURS == 0, f"end_hour must be divisible by {HOURS}"
-
-# Open and parse GAN config file
-config_path = os.path.join(model_folder, "setup_params.yaml")
-with open(config_path, "r") as f:
-    try:
-        setup_params = yaml.safe_load(f)
-    except yaml.YAMLError as exc:
-        print(exc)
-
-mode = setup_params["GENERAL"]["mode"]
-arch = setup_params["MODEL"]["architecture"]
-padding = setup_params["MODEL"]["padding"]
-filters_gen = setup_params["GENERATOR"]["filters_gen"]
-noise_channels = setup_params["GENERATOR"]["noise_channels"]
-latent_variables = setup_params["GENERATOR"]["latent_variables"]
-filters_disc = setup_params["DISCRIMINATOR"]["filters_disc"]  # TODO: avoid setting up discriminator in forecast mode?
-constant_fields = 2
-
-assert mode == "GAN", "standalone forecast script only for GAN, not VAE-GAN or deterministic model"
-
-# Set up pre-trained GAN
-weights_fn = os.path.join(model_folder, "models", f"gen_weights-{checkpoint:07}.h5")
-input_channels = 2*len(all_fcst_fields)
-
-model = setup_model(mode=mode,
-                    arch=arch,
-                    downscaling_steps=downscaling_steps,
-                    input_channels=input_channels,
-                    constant_fields=constant_fields,
-                    filters_gen=filters_gen,
-                    filters_disc=filters_disc,
-                    noise_channels=noise_channels,
-                    latent_variables=latent_variables,
-                    padding=padding)
-gen = model.gen
-gen.load_weights(weights_fn)
-
-network_const_input = load_hires_constants(batch_size=1)  # 1 x lats x lons x 2
+
+def build_generator(model_folder):
+    '''
+    Set up the generator described by setup_params.yaml in model_folder,
+    without the discriminator and optimisers that are only needed for
+    training.  Returns the generator and the number of noise channels it
+    expects.
+    '''
+    # Open and parse GAN config file
+    config_path = os.path.join(model_folder, "setup_params.yaml")
+    with open(config_path, "r") as f:
+        try:
+            setup_params = yaml.safe_load(f)
+        except yaml.YAMLError as exc:
+            print(exc)
+
+    mode = setup_params["GENERAL"]["mode"]
+    arch = setup_params["MODEL"]["architecture"]
+    padding = setup_params["MODEL"]["padding"]
+    filters_gen = setup_params["GENERATOR"]["filters_gen"]
+    noise_channels = setup_params["GENERATOR"]["noise_channels"]
+    constant_fields = 2
+
+    assert mode == "GAN", "standalone forecast script only for GAN, not VAE-GAN or deterministic model"
+    assert arch in ("normal", "forceconv", "forceconv-long"), f"unknown architecture {arch}"
+
+    input_channels = 2*len(all_fcst_fields)
+    gen = models.generator(mode=mode,
+                           arch=arch,
+                           downscaling_steps=downscaling_steps,
+                           input_channels=input_channels,
+                           constant_fields=constant_fields,
+                           filters_gen=filters_gen,
+                           noise_channels=noise_channels,
+                           padding=padding)
+    return gen, noise_channels
+
+
+def exported_generator_path(model_folder, checkpoint):
+    # Where export_generator.py saves the generator for this checkpoint
+    return os.path.join(model_folder, "models", f"gen_export-{checkpoint:07}")
+
+
+def quantised_generator_path(model_folder, checkpoint, mode):
+    # Where quantise_generator.py saves the generator for this checkpoint
+    return os.path.join(model_folder, "models", f"gen_{mode}-{checkpoint:07}.tflite")
+
+
+def load_generator(model_folder, checkpoint, network_const_input=None, split_first_block=False, use_export=False,
+                   quantised=None, tile_size=None, tile_halo=None, tile_workers=1):
+    '''
+    Set up the pre-trained generator in model_folder and load the weights
+    saved at the given checkpoint.  Returns the generator and the number of
+    noise channels it expects.
+    If network_const_input is given the generator's constant branch is
+    evaluated once, for these constants, instead of in every predict call.
+    If split_first_block is also True the part of the first residual block
+    that does not depend on the noise is computed once per forecast input.
+    If use_export is True and export_generator.py has saved this checkpoint,
+    the saved generator is loaded instead and the other options are ignored.
+    If quantised is "dynamic", "int8" or "float16" the TFLite generator made
+    by quantise_generator.py with that mode is loaded instead.
+    If tile_size is given the generator is run on tiles of the domain, with
+    tile_halo grid points of overlap (by default its receptive field), using
+    tile_workers threads; see inference.TiledGenerator.  This also needs
+    network_const_input.
+    '''
+    if quantised is not None:
+        tflite_path = quantised_generator_path(model_folder, checkpoint, quantised)
+        assert os.path.isfile(tflite_path), f"{tflite_path} not found, run quantise_generator.py {quantised} first"
+        with span("weights_load"):
+            gen = TFLiteGenerator(tflite_path)
+        return gen, gen.noise_channels
+
+    export_path = exported_generator_path(model_folder, checkpoint)
+    if use_export:
+        if os.path.isdir(export_path):
+            with span("weights_load"):
+                gen = ExportedGenerator(export_path)
+            noise_channels = int(gen.model.generate.input_signature[2].shape[-1])
+            return gen, noise_channels
+        print(f"No exported generator in {export_path}, building the Keras model instead.")
+
+    # Set up pre-trained GAN
+    with span("model_build"):
+        gen, noise_channels = build_generator(model_folder)
+    weights_fn = os.path.join(model_folder, "models", f"gen_weights-{checkpoint:07}.h5")
+    with span("weights_load"):
+        gen.load_weights(weights_fn)
+
+    if network_const_input is None:
+        wrapper = None
+    elif split_first_block:
+        wrapper = SplitFirstBlockGenerator
+    else:
+        wrapper = CachedConstantsGenerator
+
+    with span("model_build"):
+        if tile_size is not None:
+            assert network_const_input is not None, "tiled inference needs network_const_input"
+            gen = TiledGenerator(gen, network_const_input, tile_size, tile_halo, wrapper, tile_workers)
+        elif wrapper is not None:
+            gen = wrapper(gen, network_const_input)
+    return gen, noise_channels
 
 
 # In[5]:
 
 
-def create_output_file(nc_out_path):
+def create_output_file(nc_out_path, ensemble_members, first_member=0, compression="zlib", complevel=4,
+                       chunk_members=1, packing="float32"):
+    '''
+    Create the GAN_*.nc file nc_out_path for ensemble_members members,
+    numbered from first_member+1.  The precipitation is compressed with
+    compression, e.g. "zlib" or "zstd", or None, at complevel, and stored in
+    chunks of chunk_members members, packed as described in packing.py.
+    '''
+    chunk_members = min(chunk_members, ensemble_members)
     netcdf_dict = {}
     rootgrp = nc.Dataset(nc_out_path, "w", format="NETCDF4")
     netcdf_dict["rootgrp"] = rootgrp
@@ -166,22 +252,30 @@ def create_output_file(nc_out_path):
 
     ensemble_data = rootgrp.createVariable("member", "i4", ("member",))
     ensemble_data.units = "ensemble member"
-    ensemble_data[:] = range(1, ensemble_members+1)
+    ensemble_data[:] = range(first_member+1, first_member+ensemble_members+1)
 
     netcdf_dict["time_data"] = rootgrp.createVariable("time", "f4", ("time",))
     netcdf_dict["time_data"].units = "hours since 1900-01-01 00:00:00.0"
 
     netcdf_dict["valid_time_data"] = rootgrp.createVariable("fcst_valid_time", "f4",
-                                                            ("time", "valid_time"))
+                                                            ("time", "valid_time"),
+                                                            chunksizes=(1, 4))  # netCDF's default chunks are 16 MB
     netcdf_dict["valid_time_data"].units = "hours since 1900-01-01 00:00:00.0"
 
-    netcdf_dict["precipitation"] = rootgrp.createVariable("precipitation", "f4",
+    netcdf_dict["precipitation"] = rootgrp.createVariable("precipitation", packed_dtype(packing),
                                                           ("time", "member", "valid_time",
                                                            "latitude", "longitude"),
-                                                          compression="zlib",
-                                                          chunksizes=(1, 1, 1, len(latitude), len(longitude)))
+                                                          compression=compression,
+                                                          complevel=complevel,
+                                                          chunksizes=(1, chunk_members, 1, len(latitude), len(longitude)))
     netcdf_dict["precipitation"].units = "mm/h"
     netcdf_dict["precipitation"].long_name = "Precipitation"
+    set_packing(netcdf_dict["precipitation"], packing)
+
+    # For writer.EnsembleWriter
+    netcdf_dict["ensemble_members"] = ensemble_members
+    netcdf_dict["chunk_members"] = chunk_members
+    netcdf_dict["packing"] = packing
 
     return netcdf_dict
 
@@ -189,130 +283,368 @@ def create_output_file(nc_out_path):
 # In[6]:
 
 
-# Open input netCDF file to get the times
-nc_in_path = os.path.join(input_folder, input_file)
-nc_in = nc.Dataset(nc_in_path, mode="r")
-start_times = nc_in["time"][:]
-valid_times = nc_in["valid_time"][:]
-# nc_in.close()
-
-# The datetime corresponding to this start time
-d = datetime(1900,1,1) + timedelta(hours=int(start_times[0]))
-
-# Create output netCDF file
-pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)
-nc_out_path = os.path.join(output_folder, f"GAN_{d.year}{d.month:02d}{d.day:02d}_00Z_v{valid_time_num}.nc")
-netcdf_dict = create_output_file(nc_out_path)
-netcdf_dict["time_data"][0] = start_times[0]
-
-# copy across valid_time from input file
-# For 7x 24h forecasts with lead times of 6, 30, 54, 78, 102, 126, 150 hours
-in_time_idx = ([1,5,9,13,17,21,25],)
-valid_time_forecast = valid_times[in_time_idx[0][valid_time_num]]
-netcdf_dict["valid_time_data"][0,:] = valid_time_forecast
-
-# For each valid time
-#for valid_time_num in range(len(valid_times_forecast)):
-if (True): 
-    
-    # the contents of the next loop are v. similar to load_fcst from data.py,
-    # but not quite the same, since that has different assumptions on how the
-    # forecast data is stored.  TODO: unify the data normalisation between these?
-    field_arrays = []
-    for field in all_fcst_fields:
+def period_windows(all_data, valid_time_nums):
+    '''
+    The five time steps of each of the 24-hour periods valid_time_nums,
+    len(valid_time_nums) x 5 x lat x lon, from all_data, where period
+    valid_time_num has all_data[valid_time_num*4:valid_time_num*4+5].  The
+    periods share their first and last steps, so when every period up to the
+    last is wanted this is a view of all_data rather than a copy.
+    '''
+    num_periods = (len(all_data) - 1) // 4
+    windows = np.lib.stride_tricks.as_strided(all_data, shape=(num_periods, 5) + all_data.shape[1:],
+                                              strides=(4*all_data.strides[0],) + all_data.strides, writeable=False)
+    if np.array_equal(valid_time_nums, np.arange(num_periods)):
+        return windows
+    return windows[valid_time_nums]
+
+
+def load_fcst_inputs(nc_in, valid_time_nums):
+    '''
+    Returns the normalised network inputs, len(valid_time_nums) x lat x lon x 2*len(all_fcst_fields),
+    for the 24-hour periods valid_time_nums read from the open IFS file nc_in.
+    Each variable is read once, covering all of the requested periods.
+    '''
+    valid_time_nums = np.asarray(valid_time_nums)
+    num_periods = valid_time_nums.max() + 1
+
+    # Period valid_time_num uses time steps valid_time_num*4+1 to valid_time_num*4+5,
+    # so the last step of one period is the first step of the next.
+    channels = None  # 2*len(all_fcst_fields) x len(valid_time_nums) x lat x lon, allocated once the grid size is known
+    for f, field in enumerate(all_fcst_fields):
         # Original:
         # nc_in[field] has shape 1 x 50 x 29 x 384 x 352
         # corresponding to n_forecasts x n_ensemble_members x n_valid_times x n_lats x n_lons
         # Ensemble mean:
         # nc_in[field] has shape len(nc_in["time"]) x 29 x 384 x 352
-            
-        # Open input netCDF file
-        # input_file = f"{field}.nc"
-        # nc_in_path = os.path.join(input_folder, input_file)
-        # nc_in = nc.Dataset(nc_in_path, mode="r")
-        all_data_mean = nc_in[f"{field}_ensemble_mean"]
-        all_data_sd = nc_in[f"{field}_ensemble_standard_deviation"]
-
-        if field in accumulated_fields:
-            # For a 24h forecast, and a 6h lead time
-            #data1 = np.mean(all_data_mean[idx, 1:5, :, :], axis=0)            # Mean of the accumulations
-            #data2 = np.sqrt(np.mean(all_data_sd[idx, 1:5, :, :]**2, axis=0))  # RMS of the standard deviations
-            # For a 24h forecast, and a 30h lead time
-            #data1 = np.mean(all_data_mean[idx, 5:9, :, :], axis=0)            # Mean of the accumulations
-            #data2 = np.sqrt(np.mean(all_data_sd[idx, 5:9, :, :]**2, axis=0))  # RMS of the standard deviations
-            # For a particular valid time
-            data1 = np.mean(all_data_mean[valid_time_num*4+1:valid_time_num*4+5, :, :], axis=0)            # Mean of the accumulations
-            data2 = np.sqrt(np.mean(all_data_sd[valid_time_num*4+1:valid_time_num*4+5, :, :]**2, axis=0))  # RMS of the standard deviations
-            data = np.stack([data1, data2], axis=-1)
 
-        else:
-            # return mean and std computed using the trapezium rule
-            # For a 24h forecast, and a 6h lead time
-            # temp_data_mean = all_data_mean[idx, 1:6, :, :]
-            # temp_data_var = all_data_sd[idx, 1:6, :, :]**2  # Convert to variances
-            # For a 24h forecast, and a 30h lead time
-            # temp_data_mean = all_data_mean[idx, 5:10, :, :]
-            # temp_data_var = all_data_sd[idx, 5:10, :, :]**2  # Convert to variances
-            # For a particular valid time
-            temp_data_mean = all_data_mean[valid_time_num*4+1:valid_time_num*4+6, :, :]
-            temp_data_var = all_data_sd[valid_time_num*4+1:valid_time_num*4+6, :, :]**2  # Convert to variances
-            
-            data1 = (temp_data_mean[0, :, :]/2 + np.sum(temp_data_mean[1:4,:,:], axis=0) + temp_data_mean[4,:,:]/2)/4
-            data2 = (temp_data_var[0, :, :]/2 + np.sum(temp_data_var[1:4,:,:], axis=0) + temp_data_var[4,:,:]/2)/4
-            data = np.stack([data1, np.sqrt(data2)], axis=-1)
-        
-        # perform normalisation on forecast data
-        if field in nonnegative_fields:
-            data = np.maximum(data, 0.0)  # eliminate any data weirdness/regridding issues
-
-        if field in ["tp", "cp"]:
-            # precip is measured in metres, so multiply to get mm
-            data *= 1000
-            data /= HOURS  # convert to mm/hr
-        elif field in accumulated_fields:
-            # for all other accumulated fields [just ssr for us]
-            data /= (HOURS*3600)  # convert from a 6-hr difference to a per-second rate
-
-        if field in ["tp", "cp"]:
-            data = logprec(data, True)
-        else:
-            # apply transformation to make fields O(1), based on historical
-            # forecast data from one of the training years
-            if field in ["mcc"]:
-                # already 0-1
-                pass
-            elif field in ["sp", "t2m"]:
-                # these are bounded well away from zero, so subtract mean from ens mean (but NOT from ens sd!)
-                data[:, :, 0] -= fcst_norm[field]["mean"]
-                data /= fcst_norm[field]["std"]
-            elif field in nonnegative_fields:
-                data /= fcst_norm[field]["max"]
-            else:
-                # winds
-                data /= max(-fcst_norm[field]["min"], fcst_norm[field]["max"])
-    
-        field_arrays.append(data)
-    
-    network_fcst_input = np.concatenate(field_arrays, axis=-1)  # lat x lon x 2*len(all_fcst_fields)
-    network_fcst_input = np.expand_dims(network_fcst_input, axis=0)  # 1 x lat x lon x 2*len(...)
-    
-    noise_shape = network_fcst_input.shape[1:-1] + (noise_channels,)
-    noise_gen = NoiseGenerator(noise_shape, batch_size=1)
-    progbar = Progbar(ensemble_members)
-    for ii in range(ensemble_members):
-        gan_inputs = [network_fcst_input, network_const_input, noise_gen()]
-        gan_prediction = gen.predict(gan_inputs, verbose=False)  # 1 x lat x lon x 1
-        netcdf_dict["precipitation"][0, ii, 0, :, :] = denormalise(gan_prediction[0, :, :, 0])
-        progbar.add(1)
-
-netcdf_dict["rootgrp"].close()
-
-# Close the ECMWF forecasts NetCDF file
-nc_in.close()
-
-
-# In[ ]:
+        # Read every step needed in one go: all_data[i] is time step i+1
+        with span("ifs_read"):
+            all_data_mean = np.asarray(nc_in[f"{field}_ensemble_mean"][1:num_periods*4+2, :, :])
+            all_data_sd = np.asarray(nc_in[f"{field}_ensemble_standard_deviation"][1:num_periods*4+2, :, :])
+        with span("normalise"):
+            if channels is None:
+                channels = np.empty((2*len(all_fcst_fields), len(valid_time_nums)) + all_data_mean.shape[1:],
+                                    dtype=np.float32)
+            set_fcst_channels(channels, f, field, period_windows(all_data_mean, valid_time_nums),
+                              period_windows(all_data_sd, valid_time_nums))
+
+    # perform normalisation on forecast data, as data.load_fcst_batch does
+    with span("normalise"):
+        normalise_fcst(channels, all_fcst_fields, log_precip=True, norm=fcst_norm)
+        network_fcst_inputs = channels_last(channels)  # len(valid_time_nums) x lat x lon x 2*len(all_fcst_fields)
+    return network_fcst_inputs
+
+
+# In[7]:
+
+
+def generate_ensemble(gen, network_fcst_input, network_const_input, noise_channels,
+                      ensemble_members, member_batch_size, writer, netcdf_dicts, counts=None, noise_keys=None,
+                      first_member=0, quantiles=None, convergence=None, count_in_graph=False):
+    '''
+    Generate up to ensemble_members members for each of the N valid times in
+    network_fcst_input (N x lat x lon x channels), all using the same
+    generator, and write them, with the EnsembleWriter writer, to
+    netcdf_dicts[i]["precipitation"][0, :, 0, :, :].  If netcdf_dicts is
+    None the members are not stored.  If counts, a list of N
+    bins x lat x lon arrays, is given the histogram counts of the members
+    are added to them.  If noise_keys, a list of N keys, is given the noise
+    of each member depends only on the key of its valid time and the member
+    number, and the members made are numbers first_member onwards.  If
+    quantiles, a list of N EnsembleQuantiles, is given the members are added
+    to them.  If convergence, a list of N ConvergenceMonitors of counts, is
+    given no more members are made for a valid time once its monitor finds
+    that they have converged.  If count_in_graph is True the members are
+    only added to counts, binned by gen.count in the generator's graph, see
+    inference.py.
+    Returns the number of members made for each valid time.
+    '''
+    num_inputs = network_fcst_input.shape[0]
+    members_made = [ensemble_members] * num_inputs
+    active = list(range(num_inputs))  # the valid times still being generated
+    tiled = None  # the valid times that fcst_batch is tiled for
 
+    noise_shape = network_fcst_input.shape[1:-1] + (noise_channels,)
+    if noise_keys is None:
+        noise_gen = NoiseGenerator(noise_shape)
+    else:
+        noise_gens = [NoiseGenerator(noise_shape, key=noise_key) for noise_key in noise_keys]
 
+    progbar = Progbar(ensemble_members)
+    ii = 0
+    while ii < ensemble_members and active:
+        if active != tiled:
+            # member_batch_size is the number of members per gen.predict
+            # call, shared between the valid times being generated
+            members_per_input = max(1, member_batch_size // len(active))
+
+            # Tile the conditioning inputs once, so that several ensemble
+            # members can be generated by each gen.predict call. Successive
+            # noise batches draw the same random stream as one member at a
+            # time would.
+            fcst_batch = np.repeat(network_fcst_input[active], members_per_input, axis=0)
+            const_batch = np.repeat(network_const_input, len(active)*members_per_input, axis=0)
+            tiled = active
+
+        # the last batch may be smaller than members_per_input
+        batch_size = min(members_per_input, ensemble_members - ii)
+        num_batch = len(active)*batch_size
+
+        # batch index k*batch_size + j is member ii+j of valid time active[k]
+        batch_idx = (members_per_input*np.arange(len(active))[:, None] + np.arange(batch_size)).ravel()
+        if noise_keys is None:
+            noise_gen.batch_size = num_batch
+            noise = noise_gen()
+        else:
+            noise = np.concatenate([noise_gens[i].members(first_member+ii, first_member+ii+batch_size)
+                                    for i in active])
+        gan_inputs = [fcst_batch[batch_idx], const_batch[:num_batch], noise]
+        if count_in_graph:
+            with span("predict", members=num_batch):
+                batch_counts = gen.count(gan_inputs, num_groups=len(active))  # N x bins x lat x lon
+            for k, i in enumerate(active):
+                counts[i] += batch_counts[k].astype(counts[i].dtype)
+        else:
+            with span("predict", members=num_batch):
+                gan_prediction = gen.predict(gan_inputs, batch_size=num_batch, verbose=False)  # (N*batch_size) x lat x lon x 1
+            for k, i in enumerate(active):
+                with span("denormalise"):
+                    precip = denormalise(gan_prediction[k*batch_size:(k+1)*batch_size, :, :, 0])
+                if netcdf_dicts is not None:
+                    writer.write_members(netcdf_dicts[i], 0, ii, pack_precipitation(precip, netcdf_dicts[i]["packing"]))
+                if counts is not None:
+                    add_counts(counts[i], precip)
+                if quantiles is not None:
+                    quantiles[i].add(ii, precip)
+        ii += batch_size
+        progbar.add(batch_size)
+
+        if convergence is not None:
+            with span("convergence"):
+                converged = [i for i in active if convergence[i].converged(ii)]
+            for i in converged:
+                members_made[i] = ii
+            active = [i for i in active if i not in converged]
+    if ii < ensemble_members:
+        progbar.update(ii, finalize=True)
+    return members_made
+
+
+# In[8]:
+
+
+def forecast_date(generators, network_const_input, valid_time_nums, time_str, fcst_params, members=None):
+    '''
+    Run the forecasts for valid_time_nums initialised at 00Z on time_str (YYYYMMDD),
+    writing GAN_<date>_00Z_v<valid_time_num>.nc to the output folder given in fcst_params
+    and/or the histogram counts files to the counts folder.
+    generators maps each (model_folder, checkpoint) in lead_time_models that is
+    needed to the (gen, noise_channels) returned by load_generator.
+    If members, (start, stop), is given only those ensemble members are made
+    and the files are written as shards, see shards.py.
+    Returns the number of members made for each valid time, which is less
+    than ensemble_members where they converge with adaptive_members, see
+    convergence.py.
+    '''
+    input_folder = fcst_params["INPUT"]["folder"]
+    output_folder = fcst_params["OUTPUT"]["folder"]
+    ensemble_members = fcst_params["OUTPUT"]["ensemble_members"]
+    member_batch_size = fcst_params["OUTPUT"]["member_batch_size"]
+    write_ensemble = fcst_params["OUTPUT"]["write_ensemble"]
+    write_counts = fcst_params["OUTPUT"]["write_counts"]
+    counts_folder = fcst_params["OUTPUT"]["counts_folder"]
+    reproducible_noise = fcst_params["OUTPUT"]["reproducible_noise"]
+    compression = fcst_params["OUTPUT"]["compression"]
+    complevel = fcst_params["OUTPUT"]["complevel"]
+    chunk_members = fcst_params["OUTPUT"]["chunk_members"]
+    packing = fcst_params["OUTPUT"]["packing"]
+    write_quantiles = fcst_params["OUTPUT"]["write_quantiles"]
+    num_quantiles = fcst_params["OUTPUT"]["num_quantiles"]
+    adaptive_members = fcst_params["OUTPUT"]["adaptive_members"]
+
+    if members is None:
+        first_member = 0
+        out_path = lambda path: path
+    else:
+        assert reproducible_noise, "shards need reproducible_noise: True in forecast.yaml"
+        assert 0 <= members[0] < members[1] <= ensemble_members, f"members {members} not in the ensemble"
+        assert not adaptive_members, "shards need adaptive_members: False in forecast.yaml"
+        first_member = members[0]
+        ensemble_members = members[1] - members[0]
+        out_path = lambda path: shard_path(path, members)
+
+    #input_file = fcst_params["INPUT"]["file"]
+    # Instead of reading input_file from forecast.yaml, get it from the command line
+    input_file = f"IFS_{time_str}_00Z.nc"
+
+    # Open input netCDF file to get the times
+    nc_in_path = os.path.join(input_folder, input_file)
+    with span("ifs_read"):
+        nc_in = nc.Dataset(nc_in_path, mode="r")
+        start_times = nc_in["time"][:]
+        valid_times = nc_in["valid_time"][:]
+
+    # The datetime corresponding to this start time
+    d = datetime(1900,1,1) + timedelta(hours=int(start_times[0]))
+
+    # All of the network inputs, read from the IFS file in one pass
+    network_fcst_inputs = load_fcst_inputs(nc_in, valid_time_nums)
+
+    # Close the ECMWF forecasts NetCDF file
+    nc_in.close()
+
+    # For 7x 24h forecasts with lead times of 6, 30, 54, 78, 102, 126, 150 hours
+    in_time_idx = ([1,5,9,13,17,21,25],)
+    valid_time_forecasts = [valid_times[in_time_idx[0][valid_time_num]] for valid_time_num in valid_time_nums]
+
+    # Create output netCDF files
+    if write_ensemble:
+        netcdf_dicts = []
+        for valid_time_num, valid_time_forecast in zip(valid_time_nums, valid_time_forecasts):
+            nc_out_path = out_path(os.path.join(output_folder, f"GAN_{d.year}{d.month:02d}{d.day:02d}_00Z_v{valid_time_num}.nc"))
+            pathlib.Path(os.path.dirname(nc_out_path)).mkdir(parents=True, exist_ok=True)
+            netcdf_dict = create_output_file(nc_out_path, ensemble_members, first_member,
+                                             compression, complevel, chunk_members, packing)
+            netcdf_dict["time_data"][0] = start_times[0]
+
+            # copy across valid_time from input file
+            netcdf_dict["valid_time_data"][0,:] = valid_time_forecast
+            netcdf_dicts.append(netcdf_dict)
+
+    # The members are compressed and written on a background thread, while
+    # the next ones are generated
+    writer = EnsembleWriter(fcst_params["OUTPUT"]["write_queue"])
+    members_made = [None] * len(valid_time_nums)
+
+    # When only the counts are written the members can be binned in the
+    # generators' graphs, so that they are not copied back from TensorFlow
+    count_in_graph = fcst_params["MODEL"]["count_in_graph"] and not write_ensemble and \
+        not (write_quantiles and members is None)
+    if count_in_graph:
+        assert all(hasattr(gen, "count") for gen, _ in generators.values()), \
+            "count_in_graph needs Keras or exported generators, not quantised or tiled ones"
+
+    # Valid times that use the same model are generated together
+    for model in dict.fromkeys(lead_time_models[v] for v in valid_time_nums):
+        idx = [i for i, v in enumerate(valid_time_nums) if lead_time_models[v] == model]
+        print(f"Valid times {[valid_time_nums[i] for i in idx]} using model in {model[0]} checkpoint {model[1]}.")
+        gen, noise_channels = generators[model]
+
+        # Only the counts of the valid times being generated are held, as
+        # bins x lat x lon, and they are written as soon as they are complete
+        if write_counts:
+            counts = [np.zeros((len(bin_spec_1h)-1, len(latitude), len(longitude)), dtype=np.uint16) for _ in idx]
+        else:
+            counts = None
+
+        # adaptive_members needs write_counts, as write_ensemble is False
+        if adaptive_members:
+            convergence = [ConvergenceMonitor(valid_time_counts, fcst_params["OUTPUT"]["min_members"],
+                                              fcst_params["OUTPUT"]["check_members"],
+                                              fcst_params["OUTPUT"]["convergence_tolerance"],
+                                              fcst_params["OUTPUT"]["converged_fraction"])
+                           for valid_time_counts in counts]
+        else:
+            convergence = None
 
+        # As are the members for the quantile summaries.  They need every
+        # member, so shard_forecast.py makes them from the merged GAN_*.nc
+        # files instead.
+        if write_quantiles and members is None:
+            quantiles = [EnsembleQuantiles(ensemble_members, (len(latitude), len(longitude))) for _ in idx]
+        else:
+            quantiles = None
 
+        # The noise of each valid time is keyed by the date, hour and lead time
+        if reproducible_noise:
+            noise_keys = [(int(f"{d.year}{d.month:02d}{d.day:02d}"), 0, valid_time_nums[i]*24+6) for i in idx]
+        else:
+            noise_keys = None
+
+        made = generate_ensemble(gen, network_fcst_inputs[idx], network_const_input, noise_channels,
+                                 ensemble_members, member_batch_size,
+                                 writer, [netcdf_dicts[i] for i in idx] if write_ensemble else None,
+                                 counts=counts, noise_keys=noise_keys, first_member=first_member,
+                                 quantiles=quantiles, convergence=convergence, count_in_graph=count_in_graph)
+        for i, num_members in zip(idx, made):
+            members_made[i] = num_members
+        if adaptive_members:
+            print(f"Members made for valid times {[valid_time_nums[i] for i in idx]}: {made}")
+
+        if write_counts:
+            writer.wait()  # netCDF files are only used by one thread at a time
+            for i, valid_time_counts in zip(idx, counts):
+                counts_path = out_path(os.path.join(counts_folder, f"{d.year}",
+                                                    f"counts_{d.year}{d.month:02d}{d.day:02d}_00_{valid_time_nums[i]*24+6}h.nc"))
+                pathlib.Path(os.path.dirname(counts_path)).mkdir(parents=True, exist_ok=True)
+                with span("netcdf_write", file="counts"):
+                    write_counts_file(counts_path, latitude, longitude, start_times[0],
+                                      valid_time_forecasts[i], valid_time_counts, members_made[i])
+
+        if quantiles is not None:
+            writer.wait()
+            for i, summary in zip(idx, quantiles):
+                gan_path = os.path.join(output_folder, f"GAN_{d.year}{d.month:02d}{d.day:02d}_00Z_v{valid_time_nums[i]}.nc")
+                pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)
+                quantiles_dict = create_quantiles_file(quantiles_path(gan_path), latitude, longitude, start_times[0],
+                                                       [valid_time_forecasts[i]], num_quantiles, members_made[i],
+                                                       False, compression, complevel)
+                with span("quantiles"):
+                    quantiles_dict["precipitation"][0, :, 0] = summary.quantiles(num_quantiles, members_made[i])
+                    quantiles_dict["rootgrp"].close()
+
+    if write_ensemble:
+        for netcdf_dict in netcdf_dicts:
+            writer.submit(netcdf_dict["rootgrp"].close)
+    writer.close()
+    return members_made
+
+
+# In[9]:
+
+
+if __name__ == "__main__":
+    # Get the valid time numbers from the command line
+    if sys.argv[1] == "all":
+        valid_time_nums = sorted(lead_time_models)
+    else:
+        valid_time_nums = [int(v) for v in sys.argv[1].split(",")]
+
+    # Get the date from the command line argument
+    time_str = sys.argv[2]
+
+    # Optionally only make some of the ensemble members
+    if len(sys.argv) > 3:
+        members = tuple(int(m) for m in sys.argv[3].split(":"))
+    else:
+        members = None
+
+    if any(v not in lead_time_models for v in valid_time_nums):
+        print("ERROR: valid_time_num (1st argument) can be 0,1,2,3,4,5,6, a comma separated list of these, or all")
+        sys.exit(1)
+
+    read_config.set_gpu_mode()  # set up whether to use GPU, and mem alloc mode
+    fcst_params = load_fcst_params()
+    start_timing(fcst_params, "forecast_date.py",
+                 fcst_params["OUTPUT"]["ensemble_members"] if members is None else members[1] - members[0],
+                 date=time_str, valid_time_nums=valid_time_nums, members=members)
+
+    network_const_input = load_hires_constants(batch_size=1)  # 1 x lats x lons x 2
+
+    # Load each model that is needed once
+    generators = {}
+    for valid_time_num in valid_time_nums:
+        model_folder, checkpoint = lead_time_models[valid_time_num]
+        if (model_folder, checkpoint) not in generators:
+            print(f"Using model in {model_folder} checkpoint {checkpoint}.")
+            generators[(model_folder, checkpoint)] = load_generator(model_folder, checkpoint, network_const_input,
+                                                                    fcst_params["MODEL"]["split_first_block"],
+                                                                    fcst_params["MODEL"]["use_export"],
+                                                                    fcst_params["MODEL"]["quantised"],
+                                                                    fcst_params["MODEL"]["tile_size"],
+                                                                    fcst_params["MODEL"]["tile_halo"],
+                                                                    fcst_params["MODEL"]["tile_workers"])
+
+    members_made = forecast_date(generators, network_const_input, valid_time_nums, time_str, fcst_params, members)
+    end_run(members_made=members_made)
@@ -0,0 +1,142 @@
+# Long-lived forecast worker.
+#
+# Loads the cGAN generators for every lead time once and then runs forecast
+# jobs placed in a queue directory, so that TensorFlow start-up, model
+# construction and weight loading are paid once per deployment rather than
+# once per forecast.
+#
+# Usage:
+#    python forecast_worker.py
+#    python forecast_worker.py --queue_dir ../../forecast_queue --poll_interval 5
+#
+# Jobs are JSON files named <name>.job in the queue directory, e.g.
+#    {"date": "20250210", "valid_time_nums": [0, 1, 2, 3, 4, 5, 6]}
+# or, for a single valid time,
+#    {"date": "20250210", "valid_time_num": 3}
+# Add "members": [START, STOP] to a job to only make ensemble members START
+# to STOP-1, written as shards (see shards.py and shard_forecast.py).
+# A job is claimed by renaming it to <name>.running and is renamed to
+# <name>.done or <name>.failed (containing the traceback) when finished.
+# While the worker is running its process id is kept in worker.pid in the
+# queue directory; run_forecast.py uses this to send jobs here instead of
+# starting a new forecast_date.py process.  If a job takes too long
+# run_forecast.py withdraws it, by removing <name>.running, and runs the
+# forecast itself; the worker then discards the job when it finishes.
+
+import argparse
+import glob
+import json
+import os
+import pathlib
+import signal
+import sys
+import time
+import traceback
+
+import read_config
+from timing import end_run
+from data import load_hires_constants
+from forecast_date import lead_time_models, load_fcst_params, load_generator, forecast_date, start_timing
+
+
+def claim_next_job(queue_dir):
+    # Oldest job first.  os.rename is atomic, so if several workers share a
+    # queue directory only one of them can claim each job.
+    for job_path in sorted(glob.glob(os.path.join(queue_dir, "*.job")), key=os.path.getmtime):
+        running_path = job_path[:-len(".job")] + ".running"
+        try:
+            os.rename(job_path, running_path)
+        except FileNotFoundError:
+            continue
+        return running_path
+    return None
+
+
+def finish_job(running_path, finished_path):
+    # Rename a job when it has finished, unless it has been withdrawn
+    try:
+        os.rename(running_path, finished_path)
+    except FileNotFoundError:
+        print(f"Job {os.path.basename(running_path)} was withdrawn")
+
+
+def run_worker(queue_dir, poll_interval):
+    pathlib.Path(queue_dir).mkdir(parents=True, exist_ok=True)
+    pid_path = os.path.join(queue_dir, "worker.pid")
+
+    read_config.set_gpu_mode()  # set up whether to use GPU, and mem alloc mode
+    fcst_params = load_fcst_params()  # the model options are only read at startup
+
+    start_timing(fcst_params, "forecast_worker.py startup", None)
+    network_const_input = load_hires_constants(batch_size=1)  # 1 x lats x lons x 2
+
+    # Several lead times share a checkpoint, so only load each one once
+    generators = {}
+    for model_folder, checkpoint in lead_time_models.values():
+        if (model_folder, checkpoint) not in generators:
+            print(f"Loading model in {model_folder} checkpoint {checkpoint}.")
+            generators[(model_folder, checkpoint)] = load_generator(model_folder, checkpoint, network_const_input,
+                                                                    fcst_params["MODEL"]["split_first_block"],
+                                                                    fcst_params["MODEL"]["use_export"],
+                                                                    fcst_params["MODEL"]["quantised"],
+                                                                    fcst_params["MODEL"]["tile_size"],
+                                                                    fcst_params["MODEL"]["tile_halo"],
+                                                                    fcst_params["MODEL"]["tile_workers"])
+    end_run()
+
+    # Exit cleanly on SIGTERM (e.g. from kill or systemd), so worker.pid is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    with open(pid_path, "w") as f:
+        f.write(str(os.getpid()))
+    print(f"Waiting for jobs in {queue_dir}")
+
+    try:
+        while True:
+            running_path = claim_next_job(queue_dir)
+            if running_path is None:
+                time.sleep(poll_interval)
+                continue
+
+            job_root = running_path[:-len(".running")]
+            try:
+                with open(running_path, "r") as f:
+                    job = json.load(f)
+                print(f"Running job {os.path.basename(job_root)}: {job}")
+
+                if "valid_time_nums" in job:
+                    valid_time_nums = [int(v) for v in job["valid_time_nums"]]
+                else:
+                    valid_time_nums = [int(job["valid_time_num"])]
+
+                # forecast.yaml is read for every job, so the ensemble size
+                # etc. can be changed without restarting the worker.
+                fcst_params = load_fcst_params()
+                members = tuple(job["members"]) if "members" in job else None
+                start_timing(fcst_params, "forecast_worker.py",
+                             fcst_params["OUTPUT"]["ensemble_members"] if members is None else members[1] - members[0],
+                             date=job["date"], valid_time_nums=valid_time_nums, members=members,
+                             job=os.path.basename(job_root))
+                members_made = forecast_date(generators, network_const_input,
+                                             valid_time_nums, job["date"], fcst_params, members)
+                end_run(members_made=members_made)
+            except Exception:
+                end_run(failed=True)
+                traceback.print_exc()
+                if os.path.isfile(running_path):
+                    with open(running_path, "a") as f:
+                        f.write("\n" + traceback.format_exc())
+                finish_job(running_path, job_root + ".failed")
+            else:
+                finish_job(running_path, job_root + ".done")
+    finally:
+        os.remove(pid_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep the cGAN generators loaded and run forecast jobs from a queue directory.")
+    parser.add_argument("--queue_dir", help="Directory that jobs are submitted to", default="../../forecast_queue", type=str)
+    parser.add_argument("--poll_interval", help="Seconds to wait between checks for new jobs", default=5, type=float)
+    args = parser.parse_args()
+
+    run_worker(args.queue_dir, args.poll_interval)
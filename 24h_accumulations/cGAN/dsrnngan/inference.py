@@ -0,0 +1,460 @@
+# Faster inference-only versions of a trained generator.
+#
+# These wrap a generator built by models.generator (GAN mode) and give the
+# same results, with the same predict() interface, while avoiding work that
+# is repeated for every ensemble member.  The models are called directly in
+# a tf.function, which has less overhead per call than Model.predict.
+#
+# export_generator and ExportedGenerator save a generator as a SavedModel
+# for fixed image sizes, optionally compiled with XLA, and load it again
+# without rebuilding the Keras model.
+#
+# quantise_generator and TFLiteGenerator do the same for quantised TFLite
+# models, made by quantise_generator.py.
+#
+# TiledGenerator runs a generator on overlapping tiles of the domain, to
+# reduce the memory it needs.
+#
+# The Keras and exported wrappers also have count(), which denormalises and
+# bins the members in the same graph as the generator, so that only the
+# histogram counts, rather than every member, are copied back from
+# TensorFlow.  The counts are those of counts.add_counts, except where
+# TensorFlow's 10**x rounds a member across a bin edge.
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import concatenate, Add, Concatenate, Conv2D, Input, UpSampling2D
+from tensorflow.keras.models import Model
+
+from blocks import Conv2DPadding
+from counts import bin_spec_1h, count_edges
+
+
+def bin_counts(prediction, num_groups, edges, top):
+    '''
+    In the graph, the histogram counts of the generator output prediction
+    (samples x lat x lon x 1), denormalised as data.denormalise, with the
+    bins given by counts.count_edges.  The samples are split into num_groups
+    consecutive groups of the same size, which are binned separately, giving
+    num_groups x len(edges) x lat x lon int32 counts.
+    '''
+    precip = tf.minimum(tf.pow(10.0, prediction[..., 0]) - 1.0, 100.0)
+    precip = tf.reshape(precip, tf.concat([[num_groups, -1], tf.shape(precip)[1:]], axis=0))
+    # The number of members >= each bin edge, as in counts.add_counts
+    num_ge = [tf.reduce_sum(tf.cast(precip >= edges[e], tf.int32), axis=1) for e in range(edges.shape[0])]
+    num_ge.append(tf.reduce_sum(tf.cast(precip > top, tf.int32), axis=1))
+    num_ge = tf.stack(num_ge, axis=1)
+    return num_ge[:, :-1] - num_ge[:, 1:]
+
+
+class CachedConstantsGenerator(object):
+    '''
+    The generator with the constant branch, const_upscale_block applied to
+    the hi-res constants, evaluated once rather than for every member.
+    '''
+    def __init__(self, gen, network_const_input):
+        # The first concatenate joins the lo-res inputs, the upscaled
+        # constants and the noise
+        first_concat = [layer for layer in gen.layers if isinstance(layer, Concatenate)][0]
+        upscaled_const = first_concat.input[1]
+
+        # Evaluate the constant branch once
+        const_model = Model(inputs=gen.inputs[1], outputs=upscaled_const)
+        self.network_const_input = network_const_input
+        self.upscaled_const_input = const_model.predict(network_const_input, verbose=False)
+
+        # The rest of the generator, with the upscaled constants as an input.
+        # The raw constants are still needed by the hi-res concatenate.
+        lo_res_inputs, const_inputs, noise_inputs = gen.inputs
+        self.model = Model(inputs=[lo_res_inputs, upscaled_const, const_inputs, noise_inputs],
+                           outputs=gen.output)
+
+        self._upscaled_const_batch = self.upscaled_const_input
+        self._model_fn = tf.function(lambda *x: self.model(list(x), training=False), reduce_retracing=True)
+        self._count_fn = tf.function(lambda num_groups, edges, top, *x:
+                                     bin_counts(self.model(list(x), training=False), num_groups, edges, top),
+                                     reduce_retracing=True)
+
+    def _run_model(self, model_inputs, batch_size):
+        # Same as self.model.predict(model_inputs, batch_size=batch_size)
+        num_samples = model_inputs[0].shape[0]
+        if batch_size is None:
+            batch_size = num_samples
+        outputs = [self._model_fn(*[x[ii:ii+batch_size] for x in model_inputs]).numpy()
+                   for ii in range(0, num_samples, batch_size)]
+        return np.concatenate(outputs)
+
+    def _model_inputs(self, inputs):
+        # The inputs of self.model for [lo_res_inputs, const_inputs, noise_inputs]
+        lo_res_inputs, const_inputs, noise_inputs = inputs
+        assert np.array_equal(const_inputs[0], self.network_const_input[0]), \
+            "constants differ from those the generator was set up with"
+
+        # Keep the tiled upscaled constants for the largest batch seen
+        num_samples = lo_res_inputs.shape[0]
+        if self._upscaled_const_batch.shape[0] < num_samples:
+            self._upscaled_const_batch = np.repeat(self.upscaled_const_input, num_samples, axis=0)
+
+        return [lo_res_inputs, self._upscaled_const_batch[:num_samples], const_inputs, noise_inputs]
+
+    def predict(self, inputs, batch_size=None, verbose=False):
+        '''
+        Same as gen.predict([lo_res_inputs, const_inputs, noise_inputs]), where
+        each element of const_inputs is the network_const_input given to __init__.
+        '''
+        return self._run_model(self._model_inputs(inputs), batch_size)
+
+    def count(self, inputs, num_groups=1, bins=bin_spec_1h):
+        '''
+        The histogram counts, num_groups x len(bins)-1 x lat x lon, of the
+        members predict(inputs) gives, denormalised, with the samples split
+        into num_groups consecutive groups of the same size.  The samples
+        are run as one batch.
+        '''
+        edges, top = count_edges(bins, np.float32)
+        return self._count_fn(num_groups, edges, top, *self._model_inputs(inputs)).numpy()
+
+
+def _sliced_conv(conv_layer, channels, use_bias):
+    '''
+    Returns a function applying the convolution in conv_layer, a Conv2D or
+    blocks.Conv2DPadding, to only the input channels given by the slice
+    channels.  Summing these over all of the input channels gives the
+    original convolution.
+    '''
+    if isinstance(conv_layer, Conv2DPadding):
+        if conv_layer.padding == 'reflect':
+            pad, conv = conv_layer.padref, conv_layer.convval
+        elif conv_layer.padding == 'symmetric':
+            pad, conv = conv_layer.symref, conv_layer.convval
+        else:
+            pad, conv = None, conv_layer.convsam
+    else:
+        pad, conv = None, conv_layer
+
+    kernel = conv.kernel.numpy()[:, :, channels, :]
+    weights = [kernel, conv.bias.numpy()] if use_bias else [kernel]
+    sliced = Conv2D(filters=conv.filters,
+                    kernel_size=conv.kernel_size,
+                    strides=conv.strides,
+                    padding=conv.padding,
+                    dilation_rate=conv.dilation_rate,
+                    use_bias=use_bias)
+
+    def apply(x):
+        if pad is not None:
+            x = pad(x)
+        x = sliced(x)  # builds the layer, so its weights can be set
+        sliced.set_weights(weights)
+        return x
+    return apply
+
+
+class SplitFirstBlockGenerator(CachedConstantsGenerator):
+    '''
+    As CachedConstantsGenerator, but the first residual block's convolutions
+    are split by input channel.  The contribution of the lo-res inputs and the
+    constants is the same for every ensemble member, so it is computed once
+    per forecast input, and only the contribution of the noise is computed
+    for each member.  The results differ from the generator by rounding only.
+    '''
+    def __init__(self, gen, network_const_input, max_cached_inputs=8):
+        super(SplitFirstBlockGenerator, self).__init__(gen, network_const_input)
+
+        # Find the first residual block from the tensors of the original
+        # generator (node 0 of each layer)
+        first_concat = [layer for layer in gen.layers if isinstance(layer, Concatenate)][0]
+        first_add = [layer for layer in gen.layers if isinstance(layer, Add)][0]
+        lo_res_inputs, upscaled_const, noise_inputs = first_concat.get_input_at(0)
+        conv_out, skip_out = first_add.get_input_at(0)
+        conv2 = conv_out._keras_history.layer
+        relu2 = conv2.get_input_at(0)._keras_history.layer
+        conv1 = relu2.get_input_at(0)._keras_history.layer
+        relu1 = conv1.get_input_at(0)._keras_history.layer
+        skip_conv = skip_out._keras_history.layer
+        assert isinstance(conv1, Conv2DPadding) and isinstance(conv2, Conv2DPadding), \
+            "first residual block does not have the expected layers"
+        assert isinstance(skip_conv, Conv2D) and skip_conv.get_input_at(0) is first_concat.get_output_at(0), \
+            "first residual block needs a 1x1 convolution on its skip connection (forceconv)"
+
+        # Input channels [0, num_invariant) are the same for every member,
+        # the rest are noise
+        num_invariant = lo_res_inputs.shape[-1] + upscaled_const.shape[-1]
+        invariant_channels = slice(0, num_invariant)
+        noise_channels = slice(num_invariant, None)
+
+        # Member-invariant part, including the biases
+        lo_res = Input(shape=lo_res_inputs.shape[1:], name="lo_res_inputs")
+        upscaled = Input(shape=upscaled_const.shape[1:], name="upscaled_const_inputs")
+        conditioning = concatenate([lo_res, upscaled])
+        invariant_conv = _sliced_conv(conv1, invariant_channels, use_bias=True)(relu1(conditioning))
+        invariant_skip = _sliced_conv(skip_conv, invariant_channels, use_bias=True)(conditioning)
+        self.invariant_model = Model(inputs=[lo_res, upscaled], outputs=[invariant_conv, invariant_skip])
+
+        # Per-member part: add the noise contributions and finish the block,
+        # then run the rest of the generator
+        invariant_conv_in = Input(shape=invariant_conv.shape[1:], name="invariant_conv")
+        invariant_skip_in = Input(shape=invariant_skip.shape[1:], name="invariant_skip")
+        const = Input(shape=gen.inputs[1].shape[1:], name="hi_res_inputs")
+        noise = Input(shape=noise_inputs.shape[1:], name="noise_input")
+        x = Add()([invariant_conv_in, _sliced_conv(conv1, noise_channels, use_bias=False)(relu1(noise))])
+        x = conv2(relu2(x))
+        x_in = Add()([invariant_skip_in, _sliced_conv(skip_conv, noise_channels, use_bias=False)(noise)])
+        x = Add()([x, x_in])
+        rest_model = Model(inputs=[first_add.get_output_at(0), gen.inputs[1]], outputs=gen.output)
+        self.model = Model(inputs=[invariant_conv_in, invariant_skip_in, const, noise],
+                           outputs=rest_model([x, const]))
+
+        # Member-invariant parts of recently seen lo-res inputs
+        self.max_cached_inputs = max_cached_inputs
+        self._cached_inputs = []
+
+    def _invariant(self, lo_res_input):
+        # lo_res_input is one sample, lat x lon x channels
+        for cached_input, invariant in self._cached_inputs:
+            if np.array_equal(cached_input, lo_res_input):
+                return invariant
+        invariant = self.invariant_model.predict([lo_res_input[None], self.upscaled_const_input], verbose=False)
+        self._cached_inputs.append((lo_res_input.copy(), invariant))
+        if len(self._cached_inputs) > self.max_cached_inputs:
+            self._cached_inputs.pop(0)
+        return invariant
+
+    def _model_inputs(self, inputs):
+        # The inputs of self.model for [lo_res_inputs, const_inputs, noise_inputs]
+        lo_res_inputs, const_inputs, noise_inputs = inputs
+        assert np.array_equal(const_inputs[0], self.network_const_input[0]), \
+            "constants differ from those the generator was set up with"
+
+        # The samples in a batch are usually several members with the same
+        # lo-res input, so only compare with the cache when it changes
+        invariant_convs, invariant_skips = [], []
+        for i in range(lo_res_inputs.shape[0]):
+            if i == 0 or not np.array_equal(lo_res_inputs[i], lo_res_inputs[i-1]):
+                invariant_conv, invariant_skip = self._invariant(lo_res_inputs[i])
+            invariant_convs.append(invariant_conv)
+            invariant_skips.append(invariant_skip)
+
+        return [np.concatenate(invariant_convs), np.concatenate(invariant_skips), const_inputs, noise_inputs]
+
+
+def export_generator(gen, export_path, height, width, jit_compile=False):
+    '''
+    Save the generator gen as a SavedModel in export_path, with a generate
+    function for inputs of height x width grid points and any batch size.
+    If jit_compile is True the function is compiled with XLA when it is
+    first called for each batch size.  This is not always faster: on CPU
+    the TensorFlow convolutions can be quicker than XLA's.
+    '''
+    lo_res_inputs, const_inputs, noise_inputs = gen.inputs
+    input_signature = [tf.TensorSpec((None, height, width) + tuple(x.shape[-1:]), tf.float32, name=x.name)
+                       for x in (lo_res_inputs, const_inputs, noise_inputs)]
+
+    module = tf.Module()
+    module.gen = gen
+    module.generate = tf.function(lambda lo_res_inputs, hi_res_inputs, noise_input:
+                                  gen([lo_res_inputs, hi_res_inputs, noise_input], training=False),
+                                  input_signature=input_signature, jit_compile=jit_compile)
+    tf.saved_model.save(module, export_path, signatures={"serving_default": module.generate})
+
+
+class ExportedGenerator(object):
+    '''
+    A generator saved by export_generator, with the same predict() interface
+    as the Keras generator.
+    '''
+    def __init__(self, export_path):
+        self.model = tf.saved_model.load(export_path)
+        self._count_fn = tf.function(lambda num_groups, edges, top, *x:
+                                     bin_counts(self.model.generate(*x), num_groups, edges, top),
+                                     reduce_retracing=True)
+
+    def predict(self, inputs, batch_size=None, verbose=False):
+        '''
+        Same as gen.predict([lo_res_inputs, const_inputs, noise_inputs]).
+        '''
+        num_samples = inputs[0].shape[0]
+        if batch_size is None:
+            batch_size = num_samples
+        outputs = [self.model.generate(*[tf.constant(x[ii:ii+batch_size], dtype=tf.float32) for x in inputs]).numpy()
+                   for ii in range(0, num_samples, batch_size)]
+        return np.concatenate(outputs)
+
+    def count(self, inputs, num_groups=1, bins=bin_spec_1h):
+        '''
+        As CachedConstantsGenerator.count.
+        '''
+        edges, top = count_edges(bins, np.float32)
+        return self._count_fn(num_groups, edges, top,
+                              *[tf.constant(x, dtype=tf.float32) for x in inputs]).numpy()
+
+
+def quantise_generator(gen, height, width, mode, calibration_inputs=None):
+    '''
+    Convert the generator gen to a TFLite model for inputs of height x width
+    grid points and any batch size, and return the model as bytes.  mode is
+        "dynamic" - int8 weights, with float32 activations
+        "int8"    - int8 weights and activations, with the activation ranges
+                    calibrated on calibration_inputs, a list of
+                    [lo_res_inputs, const_inputs, noise_inputs] batches
+        "float16" - float16 weights
+    The inputs and output of the model are float32 in every mode.
+    '''
+    assert mode in ("dynamic", "int8", "float16"), f"unknown quantisation mode {mode}"
+    assert mode != "int8" or calibration_inputs, "int8 quantisation needs calibration inputs"
+
+    input_signature = [tf.TensorSpec((None, height, width) + tuple(x.shape[-1:]), tf.float32, name=x.name)
+                       for x in gen.inputs]
+    generate = tf.function(lambda lo_res_inputs, hi_res_inputs, noise_input:
+                           gen([lo_res_inputs, hi_res_inputs, noise_input], training=False),
+                           input_signature=input_signature)
+
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([generate.get_concrete_function()], gen)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == "int8":
+        # The calibration inputs are matched to the model inputs by name
+        input_names = [x.name for x in input_signature]
+        converter.representative_dataset = lambda: ({name: np.asarray(x, dtype=np.float32)
+                                                     for name, x in zip(input_names, inputs)}
+                                                    for inputs in calibration_inputs)
+    return converter.convert()
+
+
+class TFLiteGenerator(object):
+    '''
+    A TFLite generator made by quantise_generator, with the same predict()
+    interface as the Keras generator.
+    '''
+    def __init__(self, tflite_path, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=tflite_path, num_threads=num_threads)
+        self._runner = self.interpreter.get_signature_runner()
+        self.noise_channels = int(self._runner.get_input_details()["noise_input"]["shape_signature"][-1])
+
+    def predict(self, inputs, batch_size=None, verbose=False):
+        '''
+        Same as gen.predict([lo_res_inputs, const_inputs, noise_inputs]).
+        '''
+        num_samples = inputs[0].shape[0]
+        if batch_size is None:
+            batch_size = num_samples
+        outputs = []
+        for ii in range(0, num_samples, batch_size):
+            lo_res_inputs, const_inputs, noise_inputs = [np.asarray(x[ii:ii+batch_size], dtype=np.float32) for x in inputs]
+            # the runner resizes the inputs to each batch size
+            output, = self._runner(lo_res_inputs=lo_res_inputs,
+                                   hi_res_inputs=const_inputs,
+                                   noise_input=noise_inputs).values()
+            outputs.append(output)
+        return np.concatenate(outputs)
+
+
+def receptive_halo(gen):
+    '''
+    The number of lo-res grid points on each side of a point that the
+    generator's output there can depend on, through its padded convolutions
+    and bilinear upsampling.  A tile of the domain with at least this much
+    overlap added to each side gives the same output in its interior as the
+    whole domain.  The constant branch's convolutions have stride equal to
+    their size, so do not spread information between lo-res grid points.
+    '''
+    halo = 0.0
+    scale = 1  # hi-res grid points per lo-res grid point at this layer
+    for layer in gen.layers:
+        if isinstance(layer, Conv2DPadding):
+            halo += layer.dilation * (layer.kernel_size[0] - 1) // 2 / scale
+        elif isinstance(layer, UpSampling2D) and layer.size[0] > 1:
+            halo += 1 / scale  # bilinear interpolation uses the neighbouring points
+            scale *= layer.size[0]
+    return int(np.ceil(halo))
+
+
+def tile_slices(size, tile_size, halo):
+    '''
+    Split range(size) into tiles of tile_size points, the last possibly
+    smaller, and extend each by halo points on both sides where possible.
+    Returns a list of (outer, inner, core) slices: the extended tile, its
+    core within the extended tile, and the core within range(size).
+    '''
+    slices = []
+    for core_start in range(0, size, tile_size):
+        core_stop = min(core_start + tile_size, size)
+        outer_start = max(core_start - halo, 0)
+        outer_stop = min(core_stop + halo, size)
+        slices.append((slice(outer_start, outer_stop),
+                       slice(core_start - outer_start, core_stop - outer_start),
+                       slice(core_start, core_stop)))
+    return slices
+
+
+class TiledGenerator(object):
+    '''
+    The generator run separately on overlapping tiles of the domain, so that
+    the memory it needs grows with the tile size rather than the domain size.
+
+    Each tile is tile_size lo-res grid points square (or tile_size = (height,
+    width)), plus a halo of overlapping points on each side that is
+    discarded from the output.  With the default halo, the generator's
+    receptive field, the output is the same as the whole domain's up to
+    rounding; a smaller halo is faster but leaves errors along the seams,
+    which validate_tiles.py measures.
+
+    If wrapper is given, e.g. CachedConstantsGenerator, each tile runs the
+    generator wrapper(gen, tile_constants).  With max_workers > 1 the tiles
+    are run in parallel threads.
+    '''
+    def __init__(self, gen, network_const_input, tile_size, halo=None, wrapper=None, max_workers=1):
+        if isinstance(tile_size, int):
+            tile_size = (tile_size, tile_size)
+        if halo is None:
+            halo = receptive_halo(gen)
+        self.halo = halo
+        self.max_workers = max_workers
+
+        # hi-res grid points per lo-res grid point
+        self.scale = int(np.prod([layer.size[0] for layer in gen.layers if isinstance(layer, UpSampling2D)]))
+        height, width = network_const_input.shape[1] // self.scale, network_const_input.shape[2] // self.scale
+
+        self.network_const_input = network_const_input
+        self.tiles = []
+        for rows in tile_slices(height, tile_size[0], halo):
+            for cols in tile_slices(width, tile_size[1], halo):
+                outer = (self._hi_res(rows[0]), self._hi_res(cols[0]))
+                tile_gen = gen if wrapper is None else wrapper(gen, network_const_input[:, outer[0], outer[1]])
+                self.tiles.append((rows, cols, tile_gen))
+
+    def _hi_res(self, lo_res_slice):
+        return slice(lo_res_slice.start*self.scale, lo_res_slice.stop*self.scale)
+
+    def _predict_tile(self, tile, inputs, outputs, batch_size):
+        (rows, inner_rows, core_rows), (cols, inner_cols, core_cols), tile_gen = tile
+        lo_res_inputs, const_inputs, noise_inputs = inputs
+        hi_res_rows, hi_res_cols = self._hi_res(rows), self._hi_res(cols)
+        tile_output = tile_gen.predict([lo_res_inputs[:, rows, cols],
+                                        const_inputs[:, hi_res_rows, hi_res_cols],
+                                        noise_inputs[:, rows, cols]],
+                                       batch_size=batch_size, verbose=False)
+        outputs[:, self._hi_res(core_rows), self._hi_res(core_cols)] = \
+            tile_output[:, self._hi_res(inner_rows), self._hi_res(inner_cols)]
+
+    def predict(self, inputs, batch_size=None, verbose=False):
+        '''
+        Same as gen.predict([lo_res_inputs, const_inputs, noise_inputs]), where
+        each element of const_inputs is the network_const_input given to __init__.
+        '''
+        const_inputs = inputs[1]
+        assert np.array_equal(const_inputs[0], self.network_const_input[0]), \
+            "constants differ from those the generator was set up with"
+
+        num_samples = inputs[0].shape[0]
+        outputs = np.empty((num_samples,) + const_inputs.shape[1:3] + (1,), dtype=np.float32)
+        if self.max_workers > 1:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(lambda tile: self._predict_tile(tile, inputs, outputs, batch_size), self.tiles))
+        else:
+            for tile in self.tiles:
+                self._predict_tile(tile, inputs, outputs, batch_size)
+        return outputs
@@ -2,14 +2,59 @@ import numpy as np
 
 
 class NoiseGenerator(object):
-    def __init__(self, noise_shapes, batch_size=32, random_seed=None):
+    '''
+    Makes batches of standard normal noise, batch_size x noise_shapes.
+
+    By default successive calls draw from one RandomState stream, seeded
+    with random_seed.  If key, a tuple of non-negative integers such as
+    (init date, hour, lead time), is given the noise instead comes from the
+    counter-based Philox generator and each ensemble member's noise depends
+    only on the key and the member index.  Any range of members can then be
+    made independently, and repeatably, with members(), and successive calls
+    return members 0, 1, 2, ... in turn.
+    '''
+    def __init__(self, noise_shapes, batch_size=32, random_seed=None, key=None):
         self.noise_shapes = noise_shapes
         self.batch_size = batch_size
         self.prng = np.random.RandomState(seed=random_seed)
 
+        self.key = key
+        if key is not None:
+            # The 128 bit Philox key, from all of the integers in key
+            self.philox_key = np.random.SeedSequence(list(key)).generate_state(2, dtype=np.uint64)
+            # Each member uses its own block of the Philox stream, of one
+            # 64 bit value per noise value.  Philox makes 4 values per counter.
+            self.member_size = int(np.prod(noise_shapes))
+            self.counters_per_member = -(-self.member_size // 4)
+            self.next_member = 0
+
+    def members(self, start, stop):
+        '''
+        The noise for ensemble members start to stop-1, (stop-start) x noise_shapes.
+        Only for a generator with a key.
+        '''
+        assert self.key is not None, "members() needs a NoiseGenerator with a key"
+        num_members = stop - start
+        bit_generator = np.random.Philox(key=self.philox_key,
+                                         counter=[start*self.counters_per_member, 0, 0, 0])
+        raw = bit_generator.random_raw(num_members*4*self.counters_per_member)
+        raw = raw.reshape(num_members, -1)[:, :2*(-(-self.member_size // 2))]
+
+        # Uniform values in (0, 1], from the top 53 bits, then normal values
+        # in pairs by the Box-Muller transform
+        u = ((raw >> np.uint64(11)) + 1) * 2.0**-53
+        r = np.sqrt(-2.0 * np.log(u[:, 0::2]))
+        theta = 2.0 * np.pi * u[:, 1::2]
+        n = np.stack([r*np.cos(theta), r*np.sin(theta)], axis=-1).reshape(num_members, -1)
+        return n[:, :self.member_size].reshape((num_members,) + tuple(self.noise_shapes)).astype(np.float32)
+
     def noise(self, shape, mean, std):
-        shape = (self.batch_size,) + shape
-        n = self.prng.randn(*shape).astype(np.float32)
+        if self.key is not None:
+            n = self.members(self.next_member, self.next_member + self.batch_size)
+            self.next_member += self.batch_size
+        else:
+            shape = (self.batch_size,) + shape
+            n = self.prng.randn(*shape).astype(np.float32)
         # n = np.zeros(shape, dtype=np.float32)
         if std != 1.0:
             n *= std
@@ -1,10 +1,8 @@
 import os
 import pickle
 
-import cartopy.crs as ccrs
 import matplotlib as mpl
 import numpy as np
-import seaborn as sns
 from matplotlib.colors import ListedColormap
 from matplotlib import pyplot as plt
 from matplotlib import colorbar, colors, gridspec
@@ -38,6 +36,8 @@ def plot_img_log(img, value_range=(0.01, 5), extent=None):
 
 
 def plot_img_log_coastlines(img, value_range_precip=(0.01, 5), cmap='viridis', extent=None, alpha=0.8):
+    import cartopy.crs as ccrs  # cartopy and seaborn are only imported where they are used
+
     plt.imshow(np.maximum(img, 1e-6),
                interpolation='nearest',
                norm=colors.LogNorm(*value_range_precip),
@@ -497,6 +497,8 @@ def plot_preds(pred_files,
     num_rows = len(preds_to_plot)
     plt.figure(figsize=(1.5*num_cols, 1.5*num_rows), dpi=300)
     linewidth = 0.4
+    import cartopy.crs as ccrs
+    import seaborn as sns
     cmap = ListedColormap(sns.color_palette(palette, 256))
     cmap.set_under('white')
     cmap.set_bad('black')
@@ -568,6 +570,8 @@ def plot_comparison(files,
     num_rows = len(comp_to_plot)
     plt.figure(figsize=(1.5*num_cols, 1.5*num_rows), dpi=300)
     linewidth = 0.4
+    import cartopy.crs as ccrs
+    import seaborn as sns
     cmap = ListedColormap(sns.color_palette(palette, 256))
     cmap.set_under('white')
     cmap.set_bad('black')
@@ -1,11 +1,13 @@
+import functools
 import math
 import os
 import sys
 import yaml
 
-import tensorflow as tf
-
 
+# The configuration files are read once per process, so the functions that
+# read them are memoised.  Their results are shared, so should not be changed.
+@functools.lru_cache(maxsize=None)
 def read_config():
     config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'local_config.yaml')
     try:
@@ -22,6 +24,7 @@ def read_config():
         sys.exit(1)
 
 
+@functools.lru_cache(maxsize=None)
 def get_data_paths():
     data_config_paths = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_paths.yaml')
 
@@ -43,6 +46,8 @@ def get_data_paths():
 
 
 def set_gpu_mode():
+    import tensorflow as tf  # only needed here, and slow to import
+
     lc = read_config()
     if lc['use_gpu']:
         os.environ.pop('CUDA_VISIBLE_DEVICES', None)  # remove environment variable (if it doesn't exist, nothing happens)
@@ -67,6 +72,7 @@ def set_gpu_mode():
         os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
 
+@functools.lru_cache(maxsize=None)
 def read_downscaling_factor():
     df_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downscaling_factor.yaml')
     try:
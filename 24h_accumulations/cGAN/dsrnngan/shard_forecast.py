@@ -0,0 +1,137 @@
+# Run a forecast as several shards of ensemble members in parallel, then
+# merge them into the files that a single forecast_date.py would write
+#
+# Usage:
+#    python shard_forecast.py all YYYYMMDD --shards 4
+# runs 4 forecast_date.py processes on this machine, and
+#    python shard_forecast.py all YYYYMMDD --shards 8 --queue_dir ../../forecast_queue
+# sends 8 jobs to the forecast_worker.py processes using that queue
+# directory.  The workers can be on several machines if the queue, output and
+# counts directories are on a file system that they all share.
+#    python shard_forecast.py all YYYYMMDD --merge_only
+# merges shards that have already been made.
+# As for forecast_date.py, "all" can instead be a comma separated list of
+# valid time numbers.
+#
+# reproducible_noise must be True in forecast.yaml, so that the shards make
+# the same members as a single forecast.  With write_quantiles the summaries
+# are made from the merged GAN_*.nc files, so they are the same as those of a
+# single forecast with packing "float32", but differ by the rounding of the
+# members with the other packings, see quantiles.summarise_file.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from forecast_date import lead_time_models, load_fcst_params, create_output_file
+from shards import member_ranges, find_shards, merge_gan_shards, merge_counts_shards
+from quantiles import summarise_file
+
+
+def run_local(valid_time_nums, time_str, members_list):
+    # Run a forecast_date.py process for each member range, sharing the CPU
+    # cores between them
+    env = dict(os.environ)
+    threads = str(max(1, os.cpu_count() // len(members_list)))
+    env.setdefault("OMP_NUM_THREADS", threads)
+    env.setdefault("TF_NUM_INTRAOP_THREADS", threads)
+    valid_time_str = ",".join(str(v) for v in valid_time_nums)
+    processes = [subprocess.Popen(["python", "forecast_date.py", valid_time_str, time_str, f"{start}:{stop}"], env=env)
+                 for start, stop in members_list]
+    return all(process.wait() == 0 for process in processes)
+
+
+def run_queue(queue_dir, valid_time_nums, time_str, members_list, poll_interval):
+    # Send a job for each member range to the forecast workers and wait for
+    # them all to finish
+    job_roots = []
+    for start, stop in members_list:
+        job_root = os.path.join(queue_dir, f"{time_str}_m{start:04d}-{stop:04d}_{os.getpid()}")
+        # Write then rename, so that a worker never sees a partly written job
+        with open(job_root + ".tmp", "w") as f:
+            json.dump({"date": time_str, "valid_time_nums": valid_time_nums, "members": [start, stop]}, f)
+        os.rename(job_root + ".tmp", job_root + ".job")
+        job_roots.append(job_root)
+
+    while True:
+        failed = [job_root for job_root in job_roots if os.path.isfile(job_root + ".failed")]
+        if failed:
+            print(f"Shards failed, see {', '.join(job_root + '.failed' for job_root in failed)}")
+            return False
+        if all(os.path.isfile(job_root + ".done") for job_root in job_roots):
+            for job_root in job_roots:
+                os.remove(job_root + ".done")
+            return True
+        time.sleep(poll_interval)
+
+
+def merge(valid_time_nums, time_str, fcst_params):
+    # Merge the shards of the GAN_*.nc and counts_*.nc files, and delete them
+    ensemble_members = fcst_params["OUTPUT"]["ensemble_members"]
+
+    paths = []
+    for valid_time_num in valid_time_nums:
+        if fcst_params["OUTPUT"]["write_counts"]:
+            path = os.path.join(fcst_params["OUTPUT"]["counts_folder"], time_str[0:4],
+                                f"counts_{time_str}_00_{valid_time_num*24+6}h.nc")
+            shards = find_shards(path, ensemble_members)
+            merge_counts_shards(shards, path)
+            paths += [shard for _, shard in shards]
+
+        if fcst_params["OUTPUT"]["write_ensemble"]:
+            path = os.path.join(fcst_params["OUTPUT"]["folder"], f"GAN_{time_str}_00Z_v{valid_time_num}.nc")
+            shards = find_shards(path, ensemble_members)
+            netcdf_dict = create_output_file(path, ensemble_members, 0, fcst_params["OUTPUT"]["compression"],
+                                             fcst_params["OUTPUT"]["complevel"], fcst_params["OUTPUT"]["chunk_members"],
+                                             fcst_params["OUTPUT"]["packing"])
+            merge_gan_shards(shards, netcdf_dict)
+            netcdf_dict["rootgrp"].close()
+            if fcst_params["OUTPUT"]["write_quantiles"]:
+                summarise_file(path, fcst_params["OUTPUT"]["num_quantiles"], fcst_params["OUTPUT"]["compression"],
+                               fcst_params["OUTPUT"]["complevel"])
+            paths += [shard for _, shard in shards]
+
+    for path in paths:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run a 24h cGAN forecast as shards of ensemble members and merge them.")
+    parser.add_argument("valid_time_nums", help="Valid time numbers, 0-6 separated by commas, or all", type=str)
+    parser.add_argument("date", help="Initialisation date, YYYYMMDD", type=str)
+    parser.add_argument("--shards", help="Number of shards", default=1, type=int)
+    parser.add_argument("--queue_dir", help="Send the shards to the forecast workers of this queue directory")
+    parser.add_argument("--poll_interval", help="Seconds to wait between checks on the workers", default=5, type=float)
+    parser.add_argument("--merge_only", help="Only merge shards that have already been made", action="store_true")
+    args = parser.parse_args()
+
+    if args.valid_time_nums == "all":
+        valid_time_nums = sorted(lead_time_models)
+    else:
+        valid_time_nums = [int(v) for v in args.valid_time_nums.split(",")]
+    if any(v not in lead_time_models for v in valid_time_nums):
+        parser.error("valid_time_nums can be 0,1,2,3,4,5,6, a comma separated list of these, or all")
+
+    fcst_params = load_fcst_params()
+    if not fcst_params["OUTPUT"]["reproducible_noise"]:
+        print("ERROR: shards need reproducible_noise: True in forecast.yaml")
+        sys.exit(1)
+    if fcst_params["OUTPUT"]["write_quantiles"] and not fcst_params["OUTPUT"]["write_ensemble"]:
+        print("ERROR: the quantiles of shards are made from the merged GAN_*.nc files, so need write_ensemble: True")
+        sys.exit(1)
+
+    if not args.merge_only:
+        members_list = member_ranges(fcst_params["OUTPUT"]["ensemble_members"], args.shards)
+        print(f"Running members {members_list}")
+        if args.queue_dir is None:
+            done = run_local(valid_time_nums, args.date, members_list)
+        else:
+            done = run_queue(args.queue_dir, valid_time_nums, args.date, members_list, args.poll_interval)
+        if not done:
+            sys.exit(1)
+
+    merge(valid_time_nums, args.date, fcst_params)
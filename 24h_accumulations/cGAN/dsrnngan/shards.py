@@ -0,0 +1,92 @@
+# Splitting a forecast ensemble into shards of members, and merging them.
+#
+# A shard is the members START to STOP-1 of a forecast, made by
+#    python forecast_date.py ... START:STOP
+# or a forecast_worker.py job with "members": [START, STOP].  A shard writes
+# its part of each GAN_*.nc and counts_*.nc file to a file of the same name,
+# with _mSTART-STOP added, in a shards directory next to where the whole file
+# would be.  merge_gan_shards and merge_counts_shards then make the files a
+# single process would have written.  The noise must depend only on the
+# member (reproducible_noise: True in forecast.yaml) for them to be the same.
+#
+# shard_forecast.py runs the shards and merges them.
+
+import glob
+import os
+import re
+
+import netCDF4 as nc
+import numpy as np
+
+from counts import write_counts_file
+
+
+def member_ranges(ensemble_members, num_shards):
+    # Split range(ensemble_members) into num_shards contiguous (start, stop)
+    # ranges, as equal in size as possible
+    edges = [ensemble_members * i // num_shards for i in range(num_shards + 1)]
+    return [(start, stop) for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+
+
+def shard_path(path, members):
+    # Where the shard of the file path for members (start, stop) is written
+    folder, file_name = os.path.split(path)
+    root, ext = os.path.splitext(file_name)
+    return os.path.join(folder, "shards", f"{root}_m{members[0]:04d}-{members[1]:04d}{ext}")
+
+
+def find_shards(path, ensemble_members):
+    '''
+    Returns the shards of the file path, sorted by member, after checking
+    that they hold members 0 to ensemble_members-1 once each.
+    '''
+    folder, file_name = os.path.split(path)
+    root, ext = os.path.splitext(file_name)
+    shards = []
+    for shard in glob.glob(os.path.join(folder, "shards", f"{glob.escape(root)}_m*-*{ext}")):
+        match = re.fullmatch(re.escape(root) + r"_m(\d+)-(\d+)" + re.escape(ext), os.path.basename(shard))
+        if match is not None:
+            shards.append(((int(match.group(1)), int(match.group(2))), shard))
+    shards.sort()
+
+    next_member = 0
+    for (start, stop), shard in shards:
+        assert start == next_member, f"shards of {path} do not hold members {next_member} to {start-1} once each"
+        next_member = stop
+    assert next_member == ensemble_members, \
+        f"shards of {path} hold {next_member} of {ensemble_members} members"
+    return shards
+
+
+def merge_gan_shards(shards, netcdf_dict):
+    '''
+    Copy the members in shards, a list of ((start, stop), path) from
+    find_shards, to the output file netcdf_dict made by create_output_file.
+    '''
+    for (start, stop), shard in shards:
+        with nc.Dataset(shard, "r") as nc_shard:
+            netcdf_dict["time_data"][0] = nc_shard["time"][0]
+            netcdf_dict["valid_time_data"][0, :] = nc_shard["fcst_valid_time"][0, :]
+            for valid_time_idx in range(nc_shard["precipitation"].shape[2]):
+                netcdf_dict["precipitation"][0, start:stop, valid_time_idx, :, :] = \
+                    nc_shard["precipitation"][0, :, valid_time_idx, :, :]
+
+
+def merge_counts_shards(shards, path):
+    # Add up the histogram counts in shards, a list of ((start, stop), path)
+    # from find_shards, and write them to path
+    counts = None
+    num_members = 0
+    for _, shard in shards:
+        with nc.Dataset(shard, "r") as nc_shard:
+            if counts is None:
+                latitude = np.array(nc_shard["latitude"][:])
+                longitude = np.array(nc_shard["longitude"][:])
+                time = np.array(nc_shard["time"][:])
+                valid_time = np.array(nc_shard["valid_time"][:])
+                bins = np.array(nc_shard["bins"][:])
+                # bin zero is not stored
+                counts = np.zeros((len(bins)+1, len(latitude), len(longitude)), dtype=np.uint16)
+            counts[1:] += np.array(nc_shard["counts"][:]).astype(np.uint16)
+            num_members += int(nc_shard["counts"].num_members)
+    write_counts_file(path, latitude, longitude, time, valid_time, counts, num_members)
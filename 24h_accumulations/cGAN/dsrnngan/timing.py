@@ -0,0 +1,162 @@
+# Timing the stages of the forecasts.
+#
+# forecast_date.py and forecast_worker.py time each stage of a forecast with
+# span(): reading the IFS file, building and normalising the network inputs,
+# building the generator and loading its weights, each gen.predict call,
+# denormalising the members, and writing and waiting for the netCDF files.
+# The spans between start_run and end_run are kept in memory, and end_run
+# appends them to the run log, a JSON-lines file with one line per run that
+# also gives the host, the script, the ensemble size and the options in
+# forecast.yaml.  Outside a run span() does nothing.
+#
+# Usage:
+#    python timing.py ../../forecast_timing.jsonl [--last 20] [--members 1000] [--host HOST]
+#
+# summarises the runs in the run log, those of each script apart: for each
+# stage, the 50th and 95th percentiles over the runs of the time each run
+# spent in it, slowest first, so that a stage that has become slower, or
+# takes most of the time, stands out.  Spans on the writer thread overlap
+# the others, so the stages need not add up to the run's time.
+
+import argparse
+import contextlib
+import json
+import os
+import pathlib
+import socket
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+_run = None  # the run being timed, see start_run
+
+
+def start_run(log_path, **info):
+    '''
+    Start timing a run, to be appended to the run log log_path by end_run.
+    info, e.g. the script, ensemble size and configuration, is stored with
+    the run and must be JSON serialisable.  If log_path is None the run is
+    not timed.
+    '''
+    global _run
+    if log_path is None:
+        _run = None
+        return
+    _run = {"log_path": log_path, "start": time.perf_counter(), "spans": [],
+            "record": {"time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                       "host": socket.gethostname(), "pid": os.getpid(), **info}}
+
+
+@contextlib.contextmanager
+def span(stage, **info):
+    # Time the code in the with block as a span of stage, with info stored
+    # alongside.  May be used from several threads.
+    run = _run
+    if run is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stop = time.perf_counter()
+        run["spans"].append({"stage": stage, "start": round(start - run["start"], 6),
+                             "seconds": round(stop - start, 6), **info})
+
+
+def end_run(**info):
+    '''
+    Append the run started by start_run to its run log, as one line, with
+    its total time and info.  Spans from other threads should be finished
+    first, e.g. by EnsembleWriter.close().
+    '''
+    global _run
+    run, _run = _run, None
+    if run is None:
+        return
+    record = {**run["record"], **info, "seconds": round(time.perf_counter() - run["start"], 6),
+              "spans": run["spans"]}
+    try:
+        pathlib.Path(os.path.dirname(os.path.abspath(run["log_path"]))).mkdir(parents=True, exist_ok=True)
+        # One write of the whole line, so that runs appended by other
+        # processes at the same time are not mixed up
+        with open(run["log_path"], "a") as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+    except OSError as e:
+        print(f"WARNING: could not write the run log {run['log_path']}: {e}")
+
+
+def read_runs(log_paths):
+    # The runs in the run logs log_paths, in order
+    runs = []
+    for log_path in log_paths:
+        with open(log_path) as f:
+            for line_num, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    runs.append(json.loads(line))
+                except ValueError:
+                    print(f"WARNING: skipping unreadable line {line_num} of {log_path}")
+    return runs
+
+
+def stage_times(runs):
+    '''
+    The time each run spent in each stage, as {stage: array of seconds},
+    with 0 for runs without the stage, and the mean number of spans of each
+    stage per run.
+    '''
+    totals = {}
+    counts = {}
+    for r, run in enumerate(runs):
+        for s in run["spans"]:
+            totals.setdefault(s["stage"], np.zeros(len(runs)))[r] += s["seconds"]
+            counts[s["stage"]] = counts.get(s["stage"], 0) + 1
+    return totals, {stage: counts[stage]/len(runs) for stage in counts}
+
+
+def print_summary(runs):
+    # The percentiles of the time spent in each stage by runs, slowest first
+    totals, spans_per_run = stage_times(runs)
+    run_seconds = np.array([run["seconds"] for run in runs])
+    print(f"{'stage':16s} {'spans/run':>10s} {'p50 s':>10s} {'p95 s':>10s} {'p50 %':>7s}")
+    for stage in sorted(totals, key=lambda stage: np.percentile(totals[stage], 50), reverse=True):
+        p50, p95 = np.percentile(totals[stage], [50, 95])
+        print(f"{stage:16s} {spans_per_run[stage]:10.1f} {p50:10.3f} {p95:10.3f} "
+              f"{100*p50/np.percentile(run_seconds, 50):7.1f}")
+    p50, p95 = np.percentile(run_seconds, [50, 95])
+    print(f"{'run':16s} {'':10s} {p50:10.3f} {p95:10.3f}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Summarise the time spent in each stage of the timed forecasts.")
+    parser.add_argument("run_logs", help="JSON-lines run logs written by the forecast scripts", nargs="+")
+    parser.add_argument("--last", help="Only the last this many runs of each script", default=None, type=int)
+    parser.add_argument("--members", help="Only runs of this ensemble size", default=None, type=int)
+    parser.add_argument("--host", help="Only runs on this host", default=None, type=str)
+    args = parser.parse_args()
+
+    # Failed runs stop part way, so would make the stages look faster
+    runs = [run for run in read_runs(args.run_logs) if not run.get("failed")]
+    if args.members is not None:
+        runs = [run for run in runs if run.get("ensemble_members") == args.members]
+    if args.host is not None:
+        runs = [run for run in runs if run.get("host") == args.host]
+    if not runs:
+        print("No runs found")
+        sys.exit(1)
+
+    # The runs of each script, e.g. forecast_worker.py, are summarised apart,
+    # as they time different stages
+    for script in dict.fromkeys(run.get("script") for run in runs):
+        script_runs = [run for run in runs if run.get("script") == script]
+        if args.last is not None:
+            script_runs = script_runs[-args.last:]
+        print(f"{script}: {len(script_runs)} runs on {len(set(run.get('host') for run in script_runs))} hosts, "
+              f"{script_runs[0]['time']} to {script_runs[-1]['time']}")
+        print_summary(script_runs)
+        print()
@@ -0,0 +1,132 @@
+# Measure the error from running the cGAN generator on tiles of the domain
+# (tile_size and tile_halo in forecast.yaml) instead of the whole domain
+#
+# Usage:
+#    python validate_tiles.py --test IFS_FILE [IFS_FILE ...] --tile_size 64 128 [--halo 0 4 8]
+# e.g.
+#    python validate_tiles.py --test ../../IFS_forecast_data/IFS_20241022_00Z.nc --tile_size 96 192
+#
+# For each model in lead_time_models, or the one given by --model_folder and
+# --checkpoint, and each tile size and halo (by default the generator's
+# receptive field) the members made on tiles are compared with the same
+# members, with the same noise, made on the whole domain, for each valid time
+# the model is used for in the --test files.  The report gives, in mm/h,
+#    - the largest difference anywhere
+#    - the mean difference near the seams, within a receptive field of the
+#      edge of a tile, and elsewhere
+# and the time per ensemble member.  A halo of at least the receptive field
+# should only give rounding differences.
+
+import argparse
+import os
+
+import numpy as np
+
+import read_config
+from data import load_hires_constants
+from noise import NoiseGenerator
+from forecast_date import lead_time_models, load_fcst_params, build_generator
+from inference import CachedConstantsGenerator, TiledGenerator, receptive_halo
+from quantise_generator import load_inputs, generate_members
+
+
+def seam_mask(height, width, tile_size, distance):
+    # True at the grid points within distance of an edge between two tiles
+    mask = np.zeros((height, width), dtype=bool)
+    for edge in range(tile_size, height, tile_size):
+        mask[max(edge - distance, 0):edge + distance, :] = True
+    for edge in range(tile_size, width, tile_size):
+        mask[:, max(edge - distance, 0):edge + distance] = True
+    return mask
+
+
+def compare_tiles(gen, tiled_gen, network_fcst_inputs, network_const_input, noise_channels, seams,
+                  ensemble_members, member_batch_size):
+    '''
+    Returns the largest difference between the members made by gen and
+    tiled_gen, the mean difference where seams is True and elsewhere, and the
+    time per member of each generator.
+    '''
+    noise_shape = network_fcst_inputs.shape[1:-1] + (noise_channels,)
+    max_diff = 0.0
+    sum_diff = np.zeros(2)
+    seconds_per_member = np.zeros(2)
+    for i, network_fcst_input in enumerate(network_fcst_inputs):
+        noise = NoiseGenerator(noise_shape, batch_size=ensemble_members, random_seed=i)()
+        precip, seconds = zip(*[generate_members(g, network_fcst_input, network_const_input, noise, member_batch_size)
+                                for g in (gen, tiled_gen)])
+        diff = np.abs(precip[1] - precip[0])
+        max_diff = max(max_diff, diff.max())
+        sum_diff += [diff[:, seams].mean() if seams.any() else 0.0, diff[:, ~seams].mean()]
+        seconds_per_member += seconds
+
+    num_cases = len(network_fcst_inputs)
+    return max_diff, sum_diff / num_cases, seconds_per_member / num_cases
+
+
+def validate_model(model_folder, checkpoint, valid_time_nums, network_const_input, member_batch_size, args):
+    # Compare the tiled and whole domain forecasts of one model on
+    # valid_time_nums, returning the lines of the report
+    print(f"Using model in {model_folder} checkpoint {checkpoint}.")
+    gen, noise_channels = build_generator(model_folder)
+    gen.load_weights(os.path.join(model_folder, "models", f"gen_weights-{checkpoint:07}.h5"))
+    receptive_field = receptive_halo(gen)
+    halos = [receptive_field] if args.halo is None else args.halo
+
+    network_fcst_inputs = load_inputs(args.test, valid_time_nums)
+    height, width = network_fcst_inputs.shape[1:3]
+    full_gen = CachedConstantsGenerator(gen, network_const_input)
+
+    report = [f"Model in {model_folder} checkpoint {checkpoint}, receptive field {receptive_field} grid points",
+              f"Valid times: {valid_time_nums}",
+              f"{len(network_fcst_inputs)} test valid times, {args.members} ensemble members",
+              "",
+              f"{'tile':>6} {'halo':>6} {'tiles':>6} {'max |diff|':>12} {'seam mean':>12} {'other mean':>12} "
+              f"{'s/member':>9} {'whole s/member':>15}"]
+    for tile_size in args.tile_size:
+        seams = seam_mask(height, width, tile_size, receptive_field)
+        scale = network_const_input.shape[1] // height
+        seams = np.kron(seams, np.ones((scale, scale), dtype=bool))  # on the hi-res grid
+        for halo in halos:
+            print(f"Tile size {tile_size}, halo {halo}")
+            tiled_gen = TiledGenerator(gen, network_const_input, tile_size, halo, CachedConstantsGenerator)
+            max_diff, mean_diff, seconds_per_member = compare_tiles(full_gen, tiled_gen, network_fcst_inputs,
+                                                                    network_const_input, noise_channels, seams,
+                                                                    args.members, member_batch_size)
+            report.append(f"{tile_size:6d} {halo:6d} {len(tiled_gen.tiles):6d} {max_diff:12.3e} {mean_diff[0]:12.3e} "
+                          f"{mean_diff[1]:12.3e} {seconds_per_member[1]:9.3f} {seconds_per_member[0]:15.3f}")
+    return report + [""]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare the cGAN forecasts made on tiles with those made on the whole domain.")
+    parser.add_argument("--test", help="IFS files to compare the forecasts on", nargs="+", required=True)
+    parser.add_argument("--tile_size", help="Tile sizes, in lo-res grid points", nargs="+", type=int, required=True)
+    parser.add_argument("--halo", help="Halos, default the generator's receptive field", nargs="+", type=int)
+    parser.add_argument("--model_folder", help="Model folder, default every model in lead_time_models")
+    parser.add_argument("--checkpoint", help="Checkpoint, default every model in lead_time_models", type=int)
+    parser.add_argument("--members", help="Ensemble members compared for each valid time", default=4, type=int)
+    args = parser.parse_args()
+
+    if (args.model_folder is None) != (args.checkpoint is None):
+        parser.error("--model_folder and --checkpoint must be given together")
+
+    # The valid times that each model is tested on
+    if args.model_folder is None:
+        models_to_validate = {model: [v for v in lead_time_models if lead_time_models[v] == model]
+                              for model in dict.fromkeys(lead_time_models.values())}
+    else:
+        models_to_validate = {(args.model_folder, args.checkpoint): list(lead_time_models)}
+
+    fcst_params = load_fcst_params()
+    member_batch_size = fcst_params["OUTPUT"]["member_batch_size"]
+
+    read_config.set_gpu_mode()  # set up whether to use GPU, and mem alloc mode
+
+    network_const_input = load_hires_constants(batch_size=1)  # 1 x lats x lons x 2
+    report = [f"Test files: {' '.join(args.test)}", ""]
+    for (model_folder, checkpoint), valid_time_nums in models_to_validate.items():
+        report += validate_model(model_folder, checkpoint, valid_time_nums, network_const_input,
+                                 member_batch_size, args)
+    print("\n".join(report))
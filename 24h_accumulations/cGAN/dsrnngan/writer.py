@@ -0,0 +1,120 @@
+# Writing the GAN_*.nc files on a background thread.
+#
+# Compressing the ensemble members as they are written takes the generator's
+# time if it is done in the same thread.  EnsembleWriter does the writes on a
+# thread of its own, fed by a bounded queue, so that the compression overlaps
+# with the generation of the next members, and collects the members into
+# whole chunks of the file before writing them.
+#
+# The netCDF library is not thread-safe, even for different files.  Once an
+# EnsembleWriter is writing to a file every access to the file should go
+# through it, including closing the file, and other netCDF files should only
+# be used after EnsembleWriter.wait().
+#
+# The writes are timed as netcdf_write spans, and the waits for them as
+# write_wait spans, see timing.py.
+
+import queue
+import threading
+
+import numpy as np
+
+from timing import span
+
+
+class EnsembleWriter(object):
+    '''
+    Runs writes to netCDF files, in the order they are given, on a
+    background thread.  At most max_queue writes wait for the thread; after
+    that the caller waits too.  If max_queue is 0 the writes are done
+    directly, in the calling thread.  An error in a write is raised by the
+    next call to the writer.
+    '''
+    def __init__(self, max_queue=4):
+        self._pending = {}
+        self._error = None
+        if max_queue > 0:
+            self._queue = queue.Queue(maxsize=max_queue)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        else:
+            self._queue = None
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            function, args = task
+            # After an error the remaining writes are skipped
+            if self._error is None:
+                try:
+                    with span("netcdf_write"):
+                        function(*args)
+                except Exception as e:
+                    self._error = e
+            self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, function, *args):
+        # Call function(*args) on the writer thread, after the writes before it
+        self._check()
+        if self._queue is None:
+            with span("netcdf_write"):
+                function(*args)
+        else:
+            try:
+                self._queue.put_nowait((function, args))
+            except queue.Full:
+                with span("write_wait"):
+                    self._queue.put((function, args))
+
+    def write(self, var, key, value):
+        # var[key] = value on the writer thread
+        self.submit(var.__setitem__, key, value)
+
+    def write_members(self, netcdf_dict, valid_time_idx, start, precip):
+        '''
+        Write precip, ensemble members start onwards as members x lat x lon,
+        to netcdf_dict["precipitation"][0, :, valid_time_idx, :, :], where
+        netcdf_dict was made by create_output_file.  The members must be
+        given in order.  They are held until they fill whole chunks of the
+        variable, so that each chunk is compressed and written once.
+        '''
+        precip_var = netcdf_dict["precipitation"]
+        key = (id(precip_var), valid_time_idx)
+        pending_start, pending = self._pending.get(key, (start, []))
+        assert pending_start + sum(len(p) for p in pending) == start, "members must be written in order"
+        pending.append(precip)
+
+        stop = start + len(precip)
+        chunk_members = netcdf_dict["chunk_members"]
+        write_stop = stop if stop == netcdf_dict["ensemble_members"] else stop // chunk_members * chunk_members
+        if write_stop > pending_start:
+            block = np.concatenate(pending) if len(pending) > 1 else pending[0]
+            num_written = write_stop - pending_start
+            self.write(precip_var, (0, slice(pending_start, write_stop), valid_time_idx), block[:num_written])
+            pending = [block[num_written:]] if num_written < len(block) else []
+            pending_start = write_stop
+        self._pending[key] = (pending_start, pending)
+
+    def wait(self):
+        # Wait until every write given so far is done
+        if self._queue is not None:
+            with span("write_wait"):
+                self._queue.join()
+        self._check()
+
+    def close(self):
+        '''
+        Wait for every write to finish, and stop the writer thread.
+        '''
+        if self._queue is not None:
+            self._queue.put(None)
+            with span("write_wait"):
+                self._thread.join()
+            self._queue = None
+        self._check()
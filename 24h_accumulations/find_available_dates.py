@@ -7,10 +7,14 @@
 # Day objects contain time objects
 # time objects hold a list of valid times
 
+import argparse
 import os
 import numpy as np
 import json
 
+parser = argparse.ArgumentParser(description="Write available_dates.json listing the 24h counts files.")
+parser.parse_args()
+
 # The directory with the counts data in
 counts_dir = "../interface/view_forecasts/data/counts_24h"
 
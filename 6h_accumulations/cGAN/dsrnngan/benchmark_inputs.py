@@ -0,0 +1,112 @@
+# Time the building of the network inputs from an IFS file, by
+# data.set_fcst_channels and data.normalise_fcst as used by forecast_date.py
+# and the training DataGenerator, against the per-field code they replaced.
+#
+# Usage:
+#    python benchmark_inputs.py ../../IFS_forecast_data/IFS_20241022_00Z.nc [--repeats 5]
+#
+# The fields are read from the file once, so the times are of the array
+# operations alone, for the 4 valid times of a forecast.  The largest
+# difference between the two inputs should be float32 rounding.
+
+import argparse
+import time
+
+import netCDF4 as nc
+import numpy as np
+
+from data import HOURS, all_fcst_fields, accumulated_fields, nonnegative_fields, fcst_norm, logprec
+from data import set_fcst_channels, normalise_fcst, channels_last
+
+
+def build_input_slow(means, sds):
+    '''
+    The network input, 1 x lat x lon x 4*len(all_fcst_fields), from the
+    ensemble means and standard deviations (2 x lat x lon) of each field at
+    the start and end of the 6 hour block, as load_fcst_input used to make
+    it, one field at a time.
+    '''
+    field_arrays = []
+    for field in all_fcst_fields:
+        temp_mean = means[field]
+        temp_std = sds[field]
+        if field in accumulated_fields:
+            zeros = np.zeros(temp_mean[0].shape)
+            data = np.stack([temp_mean[0], temp_std[0], zeros, zeros], axis=-1)  # lat x lon x 4
+        else:
+            data = np.stack([temp_mean[0], temp_std[0], temp_mean[1], temp_std[1]], axis=-1)  # lat x lon x 4
+
+        if field in nonnegative_fields:
+            data = np.maximum(data, 0.0)  # eliminate any data weirdness/regridding issues
+
+        if field in ["tp", "cp"]:
+            data *= 1000
+            data /= HOURS  # convert to mm/hr
+        elif field in accumulated_fields:
+            data /= (HOURS*3600)  # convert from a 6-hr difference to a per-second rate
+
+        if field in ["tp", "cp"]:
+            data = logprec(data, True)
+        elif field in ["mcc"]:
+            pass
+        elif field in ["sp", "t2m"]:
+            data[:, :, 0] -= fcst_norm[field]["mean"]
+            data[:, :, 2] -= fcst_norm[field]["mean"]
+            data /= fcst_norm[field]["std"]
+        elif field in nonnegative_fields:
+            data /= fcst_norm[field]["max"]
+        else:
+            data /= max(-fcst_norm[field]["min"], fcst_norm[field]["max"])
+
+        field_arrays.append(data)
+
+    return np.expand_dims(np.concatenate(field_arrays, axis=-1), axis=0)
+
+
+def build_input(means, sds):
+    # As build_input_slow, using the code shared with training
+    shape = means[all_fcst_fields[0]].shape[1:]
+    channels = np.empty((4*len(all_fcst_fields), 1) + shape, dtype=np.float32)
+    for f, field in enumerate(all_fcst_fields):
+        set_fcst_channels(channels, f, field, means[field], sds[field])
+    normalise_fcst(channels, all_fcst_fields, log_precip=True, norm=fcst_norm)
+    return channels_last(channels)
+
+
+def best_time(function, repeats):
+    # The shortest of repeats calls of function, and its result
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time the building of the cGAN network inputs.")
+    parser.add_argument("ifs_file", help="IFS_*.nc file")
+    parser.add_argument("--repeats", help="Repeats of each timing, the shortest is reported", default=5, type=int)
+    args = parser.parse_args()
+
+    nc_in = nc.Dataset(args.ifs_file, mode="r")
+    num_valid_times = 4
+    means = {field: np.array(nc_in[f"{field}_ensemble_mean"][:num_valid_times+1]) for field in all_fcst_fields}
+    sds = {field: np.array(nc_in[f"{field}_ensemble_standard_deviation"][:num_valid_times+1])
+           for field in all_fcst_fields}
+    nc_in.close()
+
+    total_slow = total = 0.0
+    max_diff = 0.0
+    for out_time_idx in range(num_valid_times):
+        block_means = {field: means[field][out_time_idx:out_time_idx+2] for field in all_fcst_fields}
+        block_sds = {field: sds[field][out_time_idx:out_time_idx+2] for field in all_fcst_fields}
+        time_slow, input_slow = best_time(lambda: build_input_slow(block_means, block_sds), args.repeats)
+        time_new, input_new = best_time(lambda: build_input(block_means, block_sds), args.repeats)
+        total_slow += time_slow
+        total += time_new
+        max_diff = max(max_diff, np.abs(input_new - input_slow).max())
+
+    print(f"Per-field: {total_slow*1000:.1f} ms  Shared: {total*1000:.1f} ms  "
+          f"Speed-up: {total_slow/total:.1f}x  Largest difference: {max_diff:.2e}")
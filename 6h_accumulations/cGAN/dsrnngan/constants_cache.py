@@ -0,0 +1,134 @@
+# A cache of the hi-res constants and the forecast normalisation.
+#
+# Every forecast process needs the orography and land-sea mask, read from
+# elev.nc and lsm.nc with xarray, and the normalisation table in
+# FCSTNorm<year>.pkl.  cached_array keeps each of these as a .npy file next
+# to its sources, converted once, and maps it read-only, so processes start
+# faster and processes on the same machine share the pages of the cache.
+#
+# Each cache file has a .json manifest with CACHE_VERSION and the
+# modification time, size and SHA-256 hash of each source file.  A source
+# with a different modification time or size is hashed again, and the cache
+# is rebuilt if the hash differs too, or its manifest updated if not.
+# Change CACHE_VERSION when the contents of a cache change, e.g. a different
+# normalisation of the constants.
+# If the cache cannot be written, e.g. the folder is read-only, the arrays
+# are used without it.
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CACHE_VERSION = 1
+
+
+def cache_path(folder, name):
+    # The cache file of name in folder, for this CACHE_VERSION
+    return os.path.join(folder, f"{name}_cache_v{CACHE_VERSION}.npy")
+
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def source_record(path):
+    stat = os.stat(path)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha256": file_hash(path)}
+
+
+def manifest_path(npy_path):
+    return os.path.splitext(npy_path)[0] + ".json"
+
+
+def cache_is_valid(npy_path, source_paths):
+    '''
+    Whether npy_path was made by this CACHE_VERSION from the current
+    contents of source_paths.  Sources are only hashed if their modification
+    time or size has changed, and if the hash has not changed the new
+    modification time and size are written to the manifest, so they are not
+    hashed again.
+    '''
+    try:
+        with open(manifest_path(npy_path)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if manifest.get("version") != CACHE_VERSION or not os.path.isfile(npy_path):
+        return False
+    records = manifest.get("sources", {})
+    if sorted(records) != sorted(os.path.basename(path) for path in source_paths):
+        return False
+    touched = False
+    for path in source_paths:
+        record = records[os.path.basename(path)]
+        stat = os.stat(path)
+        if (stat.st_mtime_ns, stat.st_size) != (record["mtime_ns"], record["size"]):
+            if file_hash(path) != record["sha256"]:
+                return False
+            record["mtime_ns"], record["size"] = stat.st_mtime_ns, stat.st_size
+            touched = True
+    if touched:
+        try:
+            write_manifest(npy_path, records)
+        except OSError:
+            pass  # hashed again next time
+    return True
+
+
+def write_manifest(npy_path, records):
+    # Write the manifest of npy_path, with the source records, to a
+    # temporary file renamed into place
+    tmp_path = f"{manifest_path(npy_path)}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": CACHE_VERSION, "sources": records}, f, indent=1)
+    os.replace(tmp_path, manifest_path(npy_path))
+
+
+def write_cache(npy_path, source_paths, array):
+    # Write array and its manifest, each to a temporary file renamed into
+    # place, so that other processes only see whole files
+    records = {os.path.basename(path): source_record(path) for path in source_paths}
+    tmp_path = f"{npy_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, npy_path)
+    write_manifest(npy_path, records)
+
+
+def cached_array(npy_path, source_paths, build):
+    '''
+    The array made by build() from the files source_paths, mapped read-only
+    from the cache npy_path, which is written first if it is missing or
+    out of date.
+    '''
+    if not cache_is_valid(npy_path, source_paths):
+        array = build()
+        try:
+            write_cache(npy_path, source_paths, array)
+        except OSError as e:
+            print(f"WARNING: could not write the cache {npy_path}: {e}")
+            return array
+    return np.load(npy_path, mmap_mode="r")
+
+
+# The statistics of each field in the normalisation table
+norm_stats = ("min", "max", "mean", "std")
+
+
+def norm_to_array(norm):
+    # The normalisation dictionary, norm[field][stat], as a structured array
+    # with a row for each field, keeping the type of each statistic
+    dtype = [("field", f"U{max(len(field) for field in norm)}")]
+    dtype += [(stat, np.result_type(*[norm[field][stat] for field in norm])) for stat in norm_stats]
+    return np.array([(field,) + tuple(norm[field][stat] for stat in norm_stats) for field in norm], dtype=dtype)
+
+
+def array_to_norm(array):
+    # The normalisation dictionary from norm_to_array(norm)
+    return {str(row["field"]): {stat: row[stat] for stat in norm_stats} for row in array}
@@ -0,0 +1,59 @@
+# Stopping the ensemble of a valid time once more members would not change
+# its probabilities, for adaptive_members: True in forecast.yaml.
+#
+# The members of each valid time are generated in batches and binned into
+# the histogram counts as they are made, see counts.py.  Once min_members
+# have been made, and then every check_members members, the probability of
+# exceeding each bin edge, the thresholds shown by the interface, is found at
+# every grid point from the counts and compared with that at the previous
+# check.  When it has changed by at most tolerance, at every edge, at
+# converged_fraction of the grid points, no more members are made for the
+# valid time; otherwise they stop at ensemble_members.  On dry days most
+# grid points have no rain in any member, so this happens long before 1000
+# members.  The percentiles used by ELR move with the probabilities, so
+# settle at the same time.
+#
+# The counts files record the members made as counts.num_members, and the
+# quantile summaries as ensemble_members.  The number made differs between
+# valid times, and between reruns unless reproducible_noise is True, so the
+# GAN_*.nc files, which have a fixed member dimension, and the shards are not
+# written in this mode.
+
+import numpy as np
+
+
+def exceedance_probabilities(counts, num_members):
+    # The fraction of the num_members members binned in counts
+    # (bins x lat x lon) at or above each bin edge but the first and last,
+    # (bins-1) x lat x lon
+    num_ge = np.cumsum(counts[:0:-1], axis=0, dtype=np.int32)[::-1]
+    return num_ge.astype(np.float32) / num_members
+
+
+class ConvergenceMonitor(object):
+    '''
+    Decides when enough members of one valid time have been binned into
+    counts (bins x lat x lon), as described above.
+    '''
+    def __init__(self, counts, min_members, check_members, tolerance, converged_fraction):
+        self.counts = counts
+        self.min_members = min_members
+        self.check_members = check_members
+        self.tolerance = tolerance
+        self.converged_fraction = converged_fraction
+        self.probabilities = None  # at the last check
+        self.checked_members = 0
+
+    def converged(self, num_members):
+        # Whether the num_members members binned into counts so far are enough
+        if num_members < self.min_members:
+            return False
+        if self.probabilities is not None and num_members - self.checked_members < self.check_members:
+            return False
+        probabilities = exceedance_probabilities(self.counts, num_members)
+        previous, self.probabilities, self.checked_members = self.probabilities, probabilities, num_members
+        if previous is None:
+            return False
+        change = np.abs(probabilities - previous).max(axis=0)
+        fraction = np.count_nonzero(change <= self.tolerance) / change.size
+        return fraction >= self.converged_fraction
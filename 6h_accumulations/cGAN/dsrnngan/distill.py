@@ -0,0 +1,294 @@
+# Distil a trained cGAN generator, the teacher, into a narrower generator,
+# the student, that is cheaper to run on CPU, and report how well the
+# student's ensembles match the teacher's
+#
+# Usage:
+#    python distill.py STUDENT_FOLDER --ifs IFS_FILE [IFS_FILE ...] [--eval_ifs IFS_FILE [IFS_FILE ...]]
+# e.g.
+#    python distill.py ../ICPAC-big-ensmeansd-f32 --filters_gen 32 \
+#                      --ifs ../../IFS_forecast_data/IFS_202410*_00Z.nc \
+#                      --eval_ifs ../../IFS_forecast_data/IFS_20241101_00Z.nc
+#
+# The teacher is the model in forecast.yaml, or the one given by
+# --model_folder and --checkpoint.  The student has the teacher's
+# architecture with --filters_gen filters in place of the teacher's
+# filters_gen, so it has roughly (filters_gen/teacher filters_gen)^2 of the
+# multiply-adds, though it saves less time than that on CPU: a student with
+# a quarter of the filters takes about a quarter of the time in the 6h
+# forecasts.  No observations are needed: the student is trained on the network
+# inputs of every valid time of the forecasts in the --ifs files, as
+# forecast_date.py makes them, to match the teacher's ensemble rather than
+# the truth.  At each step --batch_size random --patch_size patches of one
+# input are taken, the teacher makes --teacher_members samples of each, and
+# the student an ensemble of --student_members.  The loss is the content loss
+# --CL_type of wloss.py, by default the CRPS, of the student's ensemble
+# against each of the teacher's samples, averaged over the samples.  The
+# CRPS is a proper score, so it is smallest when the student's ensemble has
+# the distribution of the teacher's.  There is no discriminator.
+#
+# The student is saved like a model trained by main.py:
+# STUDENT_FOLDER/setup_params.yaml is the teacher's, with the student's
+# filters_gen and a DISTILL section recording how it was made, the weights
+# are saved every --steps_per_checkpoint steps to
+# STUDENT_FOLDER/models/gen_weights-SAMPLES.h5, and the losses to
+# STUDENT_FOLDER/log.txt.  To forecast with the student set folder and
+# checkpoint in the MODEL section of forecast.yaml.
+#
+# If --eval_ifs files are given, which should not be training files, the
+# final student and, for comparison, the teacher itself are evaluated with
+# evaluation.eval_one_chkpt on every valid time in them, with an
+# independent teacher sample in place of the observations.  The CRPS, RMSE,
+# ensemble mean RMSE, RALSD, MAE and the fraction of grid points where the
+# teacher sample is below (OPL) or above (OPR) every member are written to
+# STUDENT_FOLDER/eval_distill.txt in the format of evaluation.py, with the
+# seconds taken per full domain ensemble member.  The teacher's line is the
+# best the student can do.
+
+import argparse
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+import yaml
+from tensorflow.keras.layers import Input
+from tensorflow.keras.models import Model
+from tensorflow.keras.optimizers.legacy import Adam
+from tensorflow.python.keras.utils import generic_utils
+
+import read_config
+from data import load_hires_constants
+from forecast_date import load_fcst_params, build_generator
+from noise import NoiseGenerator
+from quantise_generator import load_inputs
+from wloss import CL_chooser
+
+
+def save_student_params(teacher_folder, student_folder, filters_gen, distill_params):
+    # Write the setup_params.yaml of the student, which build_generator reads
+    with open(os.path.join(teacher_folder, "setup_params.yaml"), "r") as f:
+        setup_params = yaml.safe_load(f)
+    setup_params["GENERATOR"]["filters_gen"] = filters_gen
+    setup_params["SETUP"]["log_folder"] = student_folder
+    setup_params["DISTILL"] = distill_params
+    os.makedirs(os.path.join(student_folder, "models"), exist_ok=True)
+    with open(os.path.join(student_folder, "setup_params.yaml"), "w") as outfile:
+        yaml.dump(setup_params, outfile, default_flow_style=False)
+
+
+def teacher_sample_loss(CLtype, teacher_members):
+    # The content loss CLtype of the student's ensemble, stacked as
+    # members x batch x lat x lon x 1, against each of the teacher samples
+    # along the last axis of y_true, averaged over the samples
+    CLfn = CL_chooser(CLtype)
+
+    def loss(y_true, y_pred):
+        return tf.add_n([CLfn(y_true[..., k:k+1], y_pred) for k in range(teacher_members)]) / teacher_members
+    return loss
+
+
+class Distiller(object):
+    '''
+    Trains student to match the ensembles of teacher on patches of
+    network_fcst_inputs (N x lat x lon x channels) and network_const_input
+    (1 x lat x lon x 2), as described above.
+    '''
+    def __init__(self, teacher, student, noise_channels, network_fcst_inputs, network_const_input, CLtype="CRPS",
+                 teacher_members=8, student_members=4, patch_size=64, batch_size=4, learning_rate=1e-4, seed=0):
+        self.teacher = teacher
+        self.student = student
+        self.network_fcst_inputs = network_fcst_inputs
+        self.network_const_input = network_const_input
+        self.teacher_members = teacher_members
+        self.student_members = student_members
+        self.patch_size = patch_size
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+        self.noise_gen = NoiseGenerator((patch_size, patch_size, noise_channels), batch_size=batch_size,
+                                        random_seed=seed)
+
+        cond_in = Input(shape=(None, None, network_fcst_inputs.shape[-1]))
+        const_in = Input(shape=(None, None, network_const_input.shape[-1]))
+        noise_in = [Input(shape=(None, None, noise_channels)) for ii in range(student_members)]
+        preds = tf.stack([student([cond_in, const_in, noise_in[ii]]) for ii in range(student_members)])
+        self.student_trainer = Model(inputs=[cond_in, const_in] + noise_in, outputs=preds, name="student_trainer")
+        self.student_trainer.compile(loss=teacher_sample_loss(CLtype, teacher_members),
+                                     optimizer=Adam(learning_rate=learning_rate, beta_1=0.0, beta_2=0.999))
+
+    def patches(self):
+        # batch_size random patches of one random input, and of the constants
+        i = self.rng.integers(len(self.network_fcst_inputs))
+        _, lats, lons, _ = self.network_fcst_inputs.shape
+        y = self.rng.integers(lats - self.patch_size + 1, size=self.batch_size)
+        x = self.rng.integers(lons - self.patch_size + 1, size=self.batch_size)
+        cond = np.stack([self.network_fcst_inputs[i, y[b]:y[b]+self.patch_size, x[b]:x[b]+self.patch_size]
+                         for b in range(self.batch_size)])
+        const = np.stack([self.network_const_input[0, y[b]:y[b]+self.patch_size, x[b]:x[b]+self.patch_size]
+                          for b in range(self.batch_size)])
+        return cond, const
+
+    def train(self, num_steps, show_progress=True):
+        # Train for num_steps batches, returning the mean loss
+        if show_progress:
+            progbar = generic_utils.Progbar(num_steps*self.batch_size)
+        losses = []
+        for kk in range(num_steps):
+            cond, const = self.patches()
+            # batch x lat x lon x 1 x teacher_members
+            teacher_samples = np.stack([self.teacher.predict([cond, const, self.noise_gen()], verbose=False)
+                                        for ii in range(self.teacher_members)], axis=-1)
+            noise_list = [self.noise_gen() for ii in range(self.student_members)]
+            loss = self.student_trainer.train_on_batch([cond, const] + noise_list, teacher_samples)
+            losses.append(loss)
+            if show_progress:
+                progbar.add(self.batch_size, values=[("loss", loss)])
+        return np.mean(losses)
+
+
+def teacher_truth(teacher, network_fcst_inputs, network_const_input, noise_channels, seed):
+    # The data generator for evaluation.eval_one_chkpt, with one teacher
+    # sample for each input in place of the observations.  The same seed
+    # gives the same samples.
+    noise_gen = NoiseGenerator(network_fcst_inputs.shape[1:-1] + (noise_channels,), batch_size=1, random_seed=seed)
+    for network_fcst_input in network_fcst_inputs:
+        inputs = {'lo_res_inputs': network_fcst_input[None],
+                  'hi_res_inputs': network_const_input}
+        truth = teacher.predict([inputs['lo_res_inputs'], network_const_input, noise_gen()], verbose=False)
+        outputs = {'output': truth[..., 0],
+                   'mask': np.zeros(truth.shape[:-1], dtype=bool)}
+        yield inputs, outputs
+
+
+def seconds_per_member(gen, network_fcst_input, network_const_input, noise_channels, member_batch_size):
+    # The time gen takes to make each ensemble member of the full domain, in
+    # batches of member_batch_size, after a first batch to warm up
+    noise_gen = NoiseGenerator(network_fcst_input.shape[1:-1] + (noise_channels,), batch_size=member_batch_size)
+    gen_inputs = [np.repeat(network_fcst_input, member_batch_size, axis=0),
+                  np.repeat(network_const_input, member_batch_size, axis=0)]
+    gen.predict(gen_inputs + [noise_gen()], batch_size=member_batch_size, verbose=False)
+    start_time = time.time()
+    gen.predict(gen_inputs + [noise_gen()], batch_size=member_batch_size, verbose=False)
+    return (time.time() - start_time) / member_batch_size
+
+
+def evaluate_distillation(generators, noise_channels, network_fcst_inputs, network_const_input, ensemble_size,
+                          add_noise, noise_factor, member_batch_size, log_fname, seed=0):
+    '''
+    Evaluate each (name, gen) of generators with evaluation.eval_one_chkpt
+    against a teacher sample, from teacher_truth, for each of
+    network_fcst_inputs, and write a line of scores for each to log_fname.
+    The teacher is the first of generators.
+    '''
+    import evaluation
+
+    teacher = generators[0][1]
+    evaluation.log_line(log_fname, f"Number of images: {len(network_fcst_inputs)}")
+    evaluation.log_line(log_fname, f"Samples per image: {ensemble_size}")
+    evaluation.log_line(log_fname, "Generator CRPS CRPS_max_4 CRPS_max_16 CRPS_avg_4 CRPS_avg_16 RMSE EMRMSE RALSD "
+                                   "MAE OPL OPR seconds_per_member")
+    for name, gen in generators:
+        print(f"Evaluating {name}")
+        arrays, crps, other = evaluation.eval_one_chkpt(mode="GAN",
+                                                        gen=gen,
+                                                        data_gen=teacher_truth(teacher, network_fcst_inputs,
+                                                                               network_const_input, noise_channels,
+                                                                               seed),
+                                                        noise_channels=noise_channels,
+                                                        latent_variables=1,
+                                                        num_images=len(network_fcst_inputs),
+                                                        add_noise=add_noise,
+                                                        ensemble_size=ensemble_size,
+                                                        noise_factor=noise_factor)
+        ranks, lowress, hiress = arrays
+        OPL, OPR = evaluation.rank_OP(ranks)
+        CRPS_pixel = np.asarray(crps['no_pooling']).mean()
+        CRPS_max_4 = np.asarray(crps['max_4']).mean()
+        CRPS_max_16 = np.asarray(crps['max_16']).mean()
+        CRPS_avg_4 = np.asarray(crps['avg_4']).mean()
+        CRPS_avg_16 = np.asarray(crps['avg_16']).mean()
+
+        mae = other['mae'].mean()
+        rmse = np.sqrt(other['mse'].mean())
+        emrmse = np.sqrt(other['emmse'].mean())
+        ralsd = np.nanmean(other['ralsd'])
+        seconds = seconds_per_member(gen, network_fcst_inputs[:1], network_const_input, noise_channels,
+                                     member_batch_size)
+
+        evaluation.log_line(log_fname, f"{name} {CRPS_pixel:.6f} {CRPS_max_4:.6f} {CRPS_max_16:.6f} {CRPS_avg_4:.6f} "
+                                       f"{CRPS_avg_16:.6f} {rmse:.6f} {emrmse:.6f} {ralsd:.6f} {mae:.6f} {OPL:.6f} "
+                                       f"{OPR:.6f} {seconds:.4f}")
+
+    # Blank line afterwards for ease of reading
+    evaluation.log_line(log_fname, "")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Distil a cGAN generator into a narrower one.")
+    parser.add_argument("student_folder", help="Folder to save the student in")
+    parser.add_argument("--ifs", help="IFS files to train the student on", nargs="+", required=True)
+    parser.add_argument("--eval_ifs", help="IFS files to evaluate the student on", nargs="+", default=[])
+    parser.add_argument("--model_folder", help="Teacher model folder, default from forecast.yaml")
+    parser.add_argument("--checkpoint", help="Teacher checkpoint, default from forecast.yaml", type=int)
+    parser.add_argument("--filters_gen", help="Filters of the student", default=32, type=int)
+    parser.add_argument("--CL_type", help="Loss against each teacher sample", default="CRPS",
+                        choices=["CRPS", "CRPS_phys", "ensmeanMSE", "ensmeanMSE_phys"])
+    parser.add_argument("--teacher_members", help="Teacher samples of each patch", default=8, type=int)
+    parser.add_argument("--student_members", help="Student ensemble members for each patch", default=4, type=int)
+    parser.add_argument("--patch_size", help="Size of the patches trained on, in grid points", default=64, type=int)
+    parser.add_argument("--batch_size", help="Patches in each step", default=4, type=int)
+    parser.add_argument("--learning_rate", help="Learning rate of the student", default=1e-4, type=float)
+    parser.add_argument("--num_samples", help="Patches to train on in total", default=64000, type=int)
+    parser.add_argument("--steps_per_checkpoint", help="Steps between saving the student", default=400, type=int)
+    parser.add_argument("--eval_members", help="Ensemble members evaluated for each valid time", default=10, type=int)
+    parser.add_argument("--seed", help="Seed of the patches and noise", default=0, type=int)
+    args = parser.parse_args()
+
+    fcst_params = load_fcst_params()
+    teacher_folder = fcst_params["MODEL"]["folder"] if args.model_folder is None else args.model_folder
+    teacher_checkpoint = fcst_params["MODEL"]["checkpoint"] if args.checkpoint is None else args.checkpoint
+    member_batch_size = fcst_params["OUTPUT"]["member_batch_size"]
+
+    read_config.set_gpu_mode()  # set up whether to use GPU, and mem alloc mode
+
+    print(f"Distilling model in {teacher_folder} checkpoint {teacher_checkpoint}.")
+    teacher, noise_channels = build_generator(teacher_folder)
+    teacher.load_weights(os.path.join(teacher_folder, "models", f"gen_weights-{teacher_checkpoint:07}.h5"))
+
+    distill_params = {"teacher_folder": teacher_folder,
+                      "teacher_checkpoint": teacher_checkpoint,
+                      "ifs_files": args.ifs}
+    distill_params.update({arg: getattr(args, arg) for arg in ("CL_type", "teacher_members", "student_members",
+                                                              "patch_size", "batch_size", "learning_rate")})
+    save_student_params(teacher_folder, args.student_folder, args.filters_gen, distill_params)
+    student, _ = build_generator(args.student_folder)
+
+    network_const_input = load_hires_constants(batch_size=1)  # 1 x lats x lons x 2
+    distiller = Distiller(teacher, student, noise_channels, load_inputs(args.ifs, fcst_params), network_const_input,
+                          CLtype=args.CL_type, teacher_members=args.teacher_members,
+                          student_members=args.student_members, patch_size=args.patch_size,
+                          batch_size=args.batch_size, learning_rate=args.learning_rate, seed=args.seed)
+
+    log_file = os.path.join(args.student_folder, "log.txt")
+    with open(log_file, "w") as f:
+        print("training_samples,distill_loss", file=f)
+    training_samples = 0
+    while training_samples < args.num_samples:
+        print(f"Training samples {training_samples} of {args.num_samples}")
+        loss = distiller.train(args.steps_per_checkpoint)
+        training_samples += args.steps_per_checkpoint * args.batch_size
+        with open(log_file, "a") as f:
+            print(f"{training_samples},{loss:.6f}", file=f)
+        gen_weights_file = os.path.join(args.student_folder, "models", f"gen_weights-{training_samples:07d}.h5")
+        student.save_weights(gen_weights_file)
+        print(f"Saved {gen_weights_file}")
+
+    if args.eval_ifs:
+        with open(os.path.join(teacher_folder, "setup_params.yaml"), "r") as f:
+            eval_params = yaml.safe_load(f)["EVAL"]
+        evaluate_distillation([(f"teacher-{teacher_checkpoint}", teacher), (f"student-{training_samples}", student)],
+                              noise_channels, load_inputs(args.eval_ifs, fcst_params), network_const_input,
+                              args.eval_members, eval_params["add_postprocessing_noise"],
+                              eval_params["postprocessing_noise_factor"], member_batch_size,
+                              os.path.join(args.student_folder, "eval_distill.txt"), seed=args.seed)
+        print(f"Evaluation saved to {os.path.join(args.student_folder, 'eval_distill.txt')}")
@@ -0,0 +1,46 @@
+# Export a cGAN generator as a SavedModel for forecast_date.py
+#
+# Usage:
+#    python export_generator.py                        # the model in forecast.yaml
+#    python export_generator.py MODEL_FOLDER CHECKPOINT
+#    python export_generator.py --xla                  # compile with XLA
+#
+# The generator is saved in MODEL_FOLDER/models/gen_export-CHECKPOINT, with
+# a generate function for the ICPAC region.  forecast_date.py and
+# forecast_worker.py load it, instead of building the Keras model and
+# loading the weights, when use_export is True in forecast.yaml.
+# Check that --xla is faster on the machine running the forecasts before
+# using it.
+
+import argparse
+
+import read_config
+from forecast_date import latitude, longitude, load_fcst_params, build_generator, exported_generator_path
+from inference import export_generator
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Export a cGAN generator as a SavedModel.")
+    parser.add_argument("model_folder", help="Model folder, default from forecast.yaml", nargs="?")
+    parser.add_argument("checkpoint", help="Checkpoint, default from forecast.yaml", nargs="?", type=int)
+    parser.add_argument("--xla", help="Compile the generator with XLA", action="store_true")
+    args = parser.parse_args()
+
+    if args.model_folder is None:
+        fcst_params = load_fcst_params()
+        model_folder = fcst_params["MODEL"]["folder"]
+        checkpoint = fcst_params["MODEL"]["checkpoint"]
+    elif args.checkpoint is None:
+        parser.error("the checkpoint must be given with the model folder")
+    else:
+        model_folder = args.model_folder
+        checkpoint = args.checkpoint
+
+    read_config.set_gpu_mode()  # set up whether to use GPU, and mem alloc mode
+
+    print(f"Exporting model in {model_folder} checkpoint {checkpoint}.")
+    gen, noise_channels = build_generator(model_folder)
+    gen.load_weights(f"{model_folder}/models/gen_weights-{checkpoint:07}.h5")
+    export_path = exported_generator_path(model_folder, checkpoint)
+    export_generator(gen, export_path, len(latitude), len(longitude), jit_compile=args.xla)
+    print(f"Saved to {export_path}")
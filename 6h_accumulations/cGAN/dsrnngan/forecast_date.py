@@ -9,6 +9,19 @@
 # A more robust version of this script would parse the latitudes, longitudes, and
 # forecast time info from the input file.
 # The forecast data fields must match those defined in data.all_fcst_fields
+#
+# Usage:
+#    python forecast_date.py YYYYMMDD HH
+#    python forecast_date.py YYYYMMDD HH START:STOP
+#
+# With START:STOP only ensemble members START to STOP-1 are made, and they
+# are written to the shards directories described in shards.py.
+#
+# The functions below are also used by forecast_worker.py, which keeps the
+# generator loaded between forecasts.
+#
+# The time taken by each stage is appended to the run log timing_log in
+# forecast.yaml; see timing.py to summarise it.
 
 import sys
 import os
@@ -19,98 +32,176 @@ import netCDF4 as nc
 import numpy as np
 from tensorflow.keras.utils import Progbar
 
-from data import HOURS, all_fcst_fields, accumulated_fields, nonnegative_fields, fcst_norm, logprec, denormalise, load_hires_constants
+from data import HOURS, all_fcst_fields, fcst_norm, denormalise, load_hires_constants, set_fcst_channels, normalise_fcst, channels_last
 import read_config
 from noise import NoiseGenerator
-from setupmodel import setup_model
+from counts import bin_spec_1h, add_counts, write_counts_file
+from convergence import ConvergenceMonitor
+from shards import shard_path
+from writer import EnsembleWriter
+from ifs_reader import IFSReader
+from timing import span, start_run, end_run
+from packing import packed_dtype, set_packing, pack_precipitation
+from quantiles import EnsembleQuantiles, quantiles_path, create_quantiles_file
+import models
+from inference import CachedConstantsGenerator, SplitFirstBlockGenerator, ExportedGenerator, TFLiteGenerator, \
+    TiledGenerator
 
 from datetime import datetime, timedelta
 
-# Get the date from the command line argument
-time_str = sys.argv[1]
-# year = int(time_str[0:4])
-# month = int(time_str[4:6])
-# day = int(time_str[6:8])
-hour = int(sys.argv[2])
-
 # %%
 # Define the latitude and longitude arrays for later
 latitude = np.arange(-13.65, 24.7, 0.1)
 longitude = np.arange(19.15, 54.3, 0.1)
 
 # Some setup
-read_config.set_gpu_mode()  # set up whether to use GPU, and mem alloc mode
 data_paths = read_config.get_data_paths()  # need the constants directory
 downscaling_steps = read_config.read_downscaling_factor()["steps"]
 assert fcst_norm is not None
 
+
 # %%
-# Open and parse forecast.yaml
-#fcstyaml_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "forecast.yaml")
-fcstyaml_path = "forecast.yaml"
-with open(fcstyaml_path, "r") as f:
-    try:
-        fcst_params = yaml.safe_load(f)
-    except yaml.YAMLError as exc:
-        print(exc)
+def load_fcst_params(fcstyaml_path="forecast.yaml"):
+    # Open and parse forecast.yaml
+    with open(fcstyaml_path, "r") as f:
+        try:
+            fcst_params = yaml.safe_load(f)
+        except yaml.YAMLError as exc:
+            print(exc)
+
+    assert fcst_params["INPUT"]["start_hour"] % HOURS == 0, f"start_hour must be divisible by {HOURS}"
+    assert fcst_params["INPUT"]["end_hour"] % HOURS == 0, f"end_hour must be divisible by {HOURS}"
+    assert fcst_params["OUTPUT"]["member_batch_size"] >= 1, "member_batch_size must be at least 1"
+    assert fcst_params["OUTPUT"]["write_ensemble"] or fcst_params["OUTPUT"]["write_counts"], \
+        "at least one of write_ensemble and write_counts must be True"
+    assert not (fcst_params["OUTPUT"]["adaptive_members"] and fcst_params["OUTPUT"]["write_ensemble"]), \
+        "adaptive_members needs write_ensemble: False, as GAN_*.nc has a fixed number of members"
+    return fcst_params
+
+
+def start_timing(fcst_params, script, ensemble_members, **info):
+    # Start timing a run of script that makes ensemble_members members, in
+    # the run log given in fcst_params, see timing.py
+    start_run(fcst_params["OUTPUT"]["timing_log"], script=script, ensemble_members=ensemble_members,
+              config={section: fcst_params[section] for section in ("MODEL", "OUTPUT")}, **info)
+
 
 # %%
-model_folder = fcst_params["MODEL"]["folder"]
-checkpoint = fcst_params["MODEL"]["checkpoint"]
-input_folder = fcst_params["INPUT"]["folder"]
-
-#input_file = fcst_params["INPUT"]["file"]
-# Instead of reading input_file from forecast.yaml, get it from the command line
-input_file = f"IFS_{time_str}_{hour:02d}Z.nc"
-
-start_hour = fcst_params["INPUT"]["start_hour"]
-end_hour = fcst_params["INPUT"]["end_hour"]
-output_folder = fcst_params["OUTPUT"]["folder"]
-ensemble_members = fcst_params["OUTPUT"]["ensemble_members"]
-
-assert start_hour % HOURS == 0, f"start_hour must be divisible by {HOURS}"
-assert end_hour % HOURS == 0, f"end_hour must be divisible by {HOURS}"
-
-# Open and parse GAN config file
-config_path = os.path.join(model_folder, "setup_params.yaml")
-with open(config_path, "r") as f:
-    try:
-        setup_params = yaml.safe_load(f)
-    except yaml.YAMLError as exc:
-        print(exc)
-
-mode = setup_params["GENERAL"]["mode"]
-arch = setup_params["MODEL"]["architecture"]
-padding = setup_params["MODEL"]["padding"]
-filters_gen = setup_params["GENERATOR"]["filters_gen"]
-noise_channels = setup_params["GENERATOR"]["noise_channels"]
-latent_variables = setup_params["GENERATOR"]["latent_variables"]
-filters_disc = setup_params["DISCRIMINATOR"]["filters_disc"]  # TODO: avoid setting up discriminator in forecast mode?
-constant_fields = 2
-
-assert mode == "GAN", "standalone forecast script only for GAN, not VAE-GAN or deterministic model"
-
-# Set up pre-trained GAN
-weights_fn = os.path.join(model_folder, "models", f"gen_weights-{checkpoint:07}.h5")
-input_channels = 4*len(all_fcst_fields)
-
-model = setup_model(mode=mode,
-                    arch=arch,
-                    downscaling_steps=downscaling_steps,
-                    input_channels=input_channels,
-                    constant_fields=constant_fields,
-                    filters_gen=filters_gen,
-                    filters_disc=filters_disc,
-                    noise_channels=noise_channels,
-                    latent_variables=latent_variables,
-                    padding=padding)
-gen = model.gen
-gen.load_weights(weights_fn)
-
-network_const_input = load_hires_constants(batch_size=1)  # 1 x lats x lons x 2
+def build_generator(model_folder):
+    '''
+    Set up the generator described by setup_params.yaml in model_folder,
+    without the discriminator and optimisers that are only needed for
+    training.  Returns the generator and the number of noise channels it
+    expects.
+    '''
+    # Open and parse GAN config file
+    config_path = os.path.join(model_folder, "setup_params.yaml")
+    with open(config_path, "r") as f:
+        try:
+            setup_params = yaml.safe_load(f)
+        except yaml.YAMLError as exc:
+            print(exc)
+
+    mode = setup_params["GENERAL"]["mode"]
+    arch = setup_params["MODEL"]["architecture"]
+    padding = setup_params["MODEL"]["padding"]
+    filters_gen = setup_params["GENERATOR"]["filters_gen"]
+    noise_channels = setup_params["GENERATOR"]["noise_channels"]
+    constant_fields = 2
+
+    assert mode == "GAN", "standalone forecast script only for GAN, not VAE-GAN or deterministic model"
+    assert arch in ("normal", "forceconv", "forceconv-long"), f"unknown architecture {arch}"
+
+    input_channels = 4*len(all_fcst_fields)
+    gen = models.generator(mode=mode,
+                           arch=arch,
+                           downscaling_steps=downscaling_steps,
+                           input_channels=input_channels,
+                           constant_fields=constant_fields,
+                           filters_gen=filters_gen,
+                           noise_channels=noise_channels,
+                           padding=padding)
+    return gen, noise_channels
+
+
+def exported_generator_path(model_folder, checkpoint):
+    # Where export_generator.py saves the generator for this checkpoint
+    return os.path.join(model_folder, "models", f"gen_export-{checkpoint:07}")
+
+
+def quantised_generator_path(model_folder, checkpoint, mode):
+    # Where quantise_generator.py saves the generator for this checkpoint
+    return os.path.join(model_folder, "models", f"gen_{mode}-{checkpoint:07}.tflite")
+
+
+def load_generator(model_folder, checkpoint, network_const_input=None, split_first_block=False, use_export=False,
+                   quantised=None, tile_size=None, tile_halo=None, tile_workers=1):
+    '''
+    Set up the pre-trained generator in model_folder and load the weights
+    saved at the given checkpoint.  Returns the generator and the number of
+    noise channels it expects.
+    If network_const_input is given the generator's constant branch is
+    evaluated once, for these constants, instead of in every predict call.
+    If split_first_block is also True the part of the first residual block
+    that does not depend on the noise is computed once per forecast input.
+    If use_export is True and export_generator.py has saved this checkpoint,
+    the saved generator is loaded instead and the other options are ignored.
+    If quantised is "dynamic", "int8" or "float16" the TFLite generator made
+    by quantise_generator.py with that mode is loaded instead.
+    If tile_size is given the generator is run on tiles of the domain, with
+    tile_halo grid points of overlap (by default its receptive field), using
+    tile_workers threads; see inference.TiledGenerator.  This also needs
+    network_const_input.
+    '''
+    if quantised is not None:
+        tflite_path = quantised_generator_path(model_folder, checkpoint, quantised)
+        assert os.path.isfile(tflite_path), f"{tflite_path} not found, run quantise_generator.py {quantised} first"
+        with span("weights_load"):
+            gen = TFLiteGenerator(tflite_path)
+        return gen, gen.noise_channels
+
+    export_path = exported_generator_path(model_folder, checkpoint)
+    if use_export:
+        if os.path.isdir(export_path):
+            with span("weights_load"):
+                gen = ExportedGenerator(export_path)
+            noise_channels = int(gen.model.generate.input_signature[2].shape[-1])
+            return gen, noise_channels
+        print(f"No exported generator in {export_path}, building the Keras model instead.")
+
+    # Set up pre-trained GAN
+    with span("model_build"):
+        gen, noise_channels = build_generator(model_folder)
+    weights_fn = os.path.join(model_folder, "models", f"gen_weights-{checkpoint:07}.h5")
+    with span("weights_load"):
+        gen.load_weights(weights_fn)
+
+    if network_const_input is None:
+        wrapper = None
+    elif split_first_block:
+        wrapper = SplitFirstBlockGenerator
+    else:
+        wrapper = CachedConstantsGenerator
+
+    with span("model_build"):
+        if tile_size is not None:
+            assert network_const_input is not None, "tiled inference needs network_const_input"
+            gen = TiledGenerator(gen, network_const_input, tile_size, tile_halo, wrapper, tile_workers)
+        elif wrapper is not None:
+            gen = wrapper(gen, network_const_input)
+    return gen, noise_channels
+
 
 # %%
-def create_output_file(nc_out_path):
+def create_output_file(nc_out_path, ensemble_members, first_member=0, compression="zlib", complevel=4,
+                       chunk_members=1, packing="float32"):
+    '''
+    Create the GAN_*.nc file nc_out_path for ensemble_members members,
+    numbered from first_member+1.  The precipitation is compressed with
+    compression, e.g. "zlib" or "zstd", or None, at complevel, and stored in
+    chunks of chunk_members members, packed as described in packing.py.
+    '''
+    chunk_members = min(chunk_members, ensemble_members)
     netcdf_dict = {}
     rootgrp = nc.Dataset(nc_out_path, "w", format="NETCDF4")
     netcdf_dict["rootgrp"] = rootgrp
@@ -140,7 +231,7 @@ def create_output_file(nc_out_path):
                                            "i4",
                                            ("member",))
     ensemble_data.units = "ensemble member"
-    ensemble_data[:] = range(1, ensemble_members+1)
+    ensemble_data[:] = range(first_member+1, first_member+ensemble_members+1)
 
     netcdf_dict["time_data"] = rootgrp.createVariable("time",
                                                       "f4",
@@ -149,136 +240,309 @@ def create_output_file(nc_out_path):
 
     netcdf_dict["valid_time_data"] = rootgrp.createVariable("fcst_valid_time",
                                                             "f4",
-                                                            ("time", "valid_time"))
+                                                            ("time", "valid_time"),
+                                                            chunksizes=(1, 4))  # netCDF's default chunks are 16 MB
     netcdf_dict["valid_time_data"].units = "hours since 1900-01-01 00:00:00.0"
 
     netcdf_dict["precipitation"] = rootgrp.createVariable("precipitation",
-                                                          "f4",
+                                                          packed_dtype(packing),
                                                           ("time", "member", "valid_time",
                                                            "latitude", "longitude"),
-                                                          compression="zlib",
-                                                          chunksizes=(1, 1, 1, len(latitude), len(longitude)))
+                                                          compression=compression,
+                                                          complevel=complevel,
+                                                          chunksizes=(1, chunk_members, 1, len(latitude), len(longitude)))
     netcdf_dict["precipitation"].units = "mm h**-1"
     netcdf_dict["precipitation"].long_name = "Precipitation"
+    set_packing(netcdf_dict["precipitation"], packing)
+
+    # For writer.EnsembleWriter
+    netcdf_dict["ensemble_members"] = ensemble_members
+    netcdf_dict["chunk_members"] = chunk_members
+    netcdf_dict["packing"] = packing
 
     return netcdf_dict
 
-# %%
-input_file
 
 # %%
-# Open input netCDF file to get the times
-nc_in_path = os.path.join(input_folder, input_file)
-print(f"IFS: {nc_in_path}")
-nc_in = nc.Dataset(nc_in_path, mode="r")
-start_times = [nc_in["time"][0]]
-valid_times = nc_in["valid_time"][:]
-d = datetime(1900,1,1) + timedelta(hours=int(start_times[0]))
-print(f"{d.year}-{d.month:02}-{d.day:02}")
-
-# %%
-# Create output netCDF file
-pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)
-nc_out_path = os.path.join(output_folder, f"GAN_{d.year}{d.month:02}{d.day:02}_{hour:02d}Z.nc")
-
-netcdf_dict = create_output_file(nc_out_path)
-netcdf_dict["time_data"][0] = start_times[0]
-
-# loop over time chunks. output forecasts may not start from hour 0, so
-# generate output and input valid time indices using enumerate(...)
-for out_time_idx, in_time_idx in enumerate(range(start_hour//HOURS, end_hour//HOURS)):
-    # copy across valid_time from input file
-    netcdf_dict["valid_time_data"][0, out_time_idx] = valid_times[out_time_idx]
-    field_arrays = []
-
-    # the contents of the next loop are v. similar to load_fcst from data.py,
-    # but not quite the same, since that has different assumptions on how the
-    # forecast data is stored.  TODO: unify the data normalisation between these?
-    for field in all_fcst_fields:
+def load_fcst_input(ifs, out_time_idx):
+    '''
+    Returns the normalised network input, 1 x lat x lon x 4*len(all_fcst_fields),
+    for the 6-hour block starting at out_time_idx in the IFS file read by
+    ifs, an ifs_reader.IFSReader.
+    '''
+    channels = np.empty((4*len(all_fcst_fields), 1, len(latitude), len(longitude)), dtype=np.float32)
+
+    for f, field in enumerate(all_fcst_fields):
         # Original:
         # nc_in[field] has shape 1 x 50 x 29 x 384 x 352
         # corresponding to n_forecasts x n_ensemble_members x n_valid_times x n_lats x n_lons
         # Ensemble mean:
         # nc_in[field] has shape len(nc_in["time"]) x 29 x 384 x 352
-        
-        # Open input netCDF file
-        #input_file = f"{field}.nc"
-        #input_file = 'IFS_20180606_00Z.nc'
-        input_file = f'IFS_{d.year}{d.month:02}{d.day:02}_{hour:02d}Z.nc'
-        nc_in_path = os.path.join(input_folder, input_file)
-        nc_in = nc.Dataset(nc_in_path, mode="r")
-        
-        # grab start and end of 6-hour block in one operation
-        temp_mean = nc_in[f"{field}_ensemble_mean"][out_time_idx:out_time_idx+2, :, :]  # 2 x lat x lon
-        temp_start_mean = temp_mean[0, :, :]  # lat x lon, start of timestep
-        temp_end_mean = temp_mean[1, :, :]  # lat x lon, end of timestep
-
-        temp_std = nc_in[f"{field}_ensemble_standard_deviation"][out_time_idx:out_time_idx+2, :, :]  # 2 x lat x lon
-        temp_start_std = temp_std[0, :, :]  # lat x lon, start of timestep
-        temp_end_std = temp_std[1, :, :]  # lat x lon, end of timestep
-
-        nc_in.close()
-        
+
+        # grab start and end of 6-hour block, 2 x lat x lon each
+        with span("ifs_read"):
+            mean, sd = ifs.fcst_steps(field, out_time_idx, out_time_idx+2)
+
         # return 4 channels per field
-        if field in accumulated_fields:
-            zeros = np.zeros(temp_start_mean.shape)
-            data = np.stack([temp_start_mean,
-                             temp_start_std,
-                             zeros,
-                             zeros],
-                             axis=-1)  # lat x lon x 4
-        else:
-            data = np.stack([temp_start_mean,
-                             temp_start_std,
-                             temp_end_mean,
-                             temp_end_std],
-                             axis=-1)  # lat x lon x 4
-        
-        # perform normalisation on forecast data
-        if field in nonnegative_fields:
-            data = np.maximum(data, 0.0)  # eliminate any data weirdness/regridding issues
-
-        if field in ["tp", "cp"]:
-            # precip is measured in metres, so multiply to get mm
-            data *= 1000
-            data /= HOURS  # convert to mm/hr
-        elif field in accumulated_fields:
-            # for all other accumulated fields [just ssr for us]
-            data /= (HOURS*3600)  # convert from a 6-hr difference to a per-second rate
-
-        if field in ["tp", "cp"]:
-            data = logprec(data, True)
-        else:
-            # apply transformation to make fields O(1), based on historical
-            # forecast data from one of the training years
-            if field in ["mcc"]:
-                # already 0-1
-                pass
-            elif field in ["sp", "t2m"]:
-                # these are bounded well away from zero, so subtract mean from ens mean (but NOT from ens sd!)
-                data[:, :, 0] -= fcst_norm[field]["mean"]
-                data[:, :, 2] -= fcst_norm[field]["mean"]
-                data /= fcst_norm[field]["std"]
-            elif field in nonnegative_fields:
-                data /= fcst_norm[field]["max"]
-            else:
-                # winds
-                data /= max(-fcst_norm[field]["min"], fcst_norm[field]["max"])
-
-        field_arrays.append(data)
-
-    network_fcst_input = np.concatenate(field_arrays, axis=-1)  # lat x lon x 4*len(all_fcst_fields)
-    network_fcst_input = np.expand_dims(network_fcst_input, axis=0)  # 1 x lat x lon x 4*len(...)
+        with span("normalise"):
+            set_fcst_channels(channels, f, field, mean, sd)
+
+    # perform normalisation on forecast data, as for training
+    with span("normalise"):
+        normalise_fcst(channels, all_fcst_fields, log_precip=True, norm=fcst_norm)
+        network_fcst_input = channels_last(channels)  # 1 x lat x lon x 4*len(...)
+    return network_fcst_input
 
+
+# %%
+def generate_ensemble(gen, network_fcst_input, network_const_input, noise_channels,
+                      ensemble_members, member_batch_size, writer, netcdf_dict, out_time_idx, counts=None,
+                      noise_key=None, first_member=0, quantiles=None, convergence=None, count_in_graph=False):
+    '''
+    Generate up to ensemble_members members for one valid time and write them,
+    with the EnsembleWriter writer, to
+    netcdf_dict["precipitation"][0, :, out_time_idx, :, :].  If netcdf_dict
+    is None the members are not stored.  If counts (bins x lat x lon) is
+    given the histogram counts of the members are added to it.  If noise_key
+    is given each member's noise depends only on it and the member number,
+    and the members made are numbers first_member onwards.  If quantiles, a
+    list of EnsembleQuantiles, is given the members are added to each.  If
+    convergence, a ConvergenceMonitor of counts, is given no more members
+    are made once it finds that they have converged.  If count_in_graph is
+    True the members are only added to counts, binned by gen.count in the
+    generator's graph, see inference.py.
+    Returns the number of members made.
+    '''
     noise_shape = network_fcst_input.shape[1:-1] + (noise_channels,)
-    noise_gen = NoiseGenerator(noise_shape, batch_size=1)
+    noise_gen = NoiseGenerator(noise_shape, batch_size=member_batch_size, key=noise_key)
+    if noise_key is not None:
+        noise_gen.next_member = first_member
+
+    # Tile the conditioning inputs once, so that several ensemble members can
+    # be generated by each gen.predict call. Successive noise batches draw the
+    # same random stream as one member at a time would.
+    fcst_batch = np.repeat(network_fcst_input, member_batch_size, axis=0)
+    const_batch = np.repeat(network_const_input, member_batch_size, axis=0)
+
     progbar = Progbar(ensemble_members)
-    for ii in range(ensemble_members):
-        gan_inputs = [network_fcst_input, network_const_input, noise_gen()]
-        gan_prediction = gen.predict(gan_inputs, verbose=False)  # 1 x lat x lon x 1
-        netcdf_dict["precipitation"][0, ii, out_time_idx, :, :] = denormalise(gan_prediction[0, :, :, 0])
-        progbar.add(1)
+    for ii in range(0, ensemble_members, member_batch_size):
+        # the last batch may be smaller than member_batch_size
+        batch_size = min(member_batch_size, ensemble_members - ii)
+        noise_gen.batch_size = batch_size
+        gan_inputs = [fcst_batch[:batch_size], const_batch[:batch_size], noise_gen()]
+        if count_in_graph:
+            with span("predict", members=batch_size):
+                counts += gen.count(gan_inputs)[0].astype(counts.dtype)  # 1 x bins x lat x lon
+            progbar.add(batch_size)
+        else:
+            with span("predict", members=batch_size):
+                gan_prediction = gen.predict(gan_inputs, batch_size=batch_size, verbose=False)  # batch_size x lat x lon x 1
+            with span("denormalise"):
+                precip = denormalise(gan_prediction[:, :, :, 0])
+            if netcdf_dict is not None:
+                writer.write_members(netcdf_dict, out_time_idx, ii, pack_precipitation(precip, netcdf_dict["packing"]))
+            if counts is not None:
+                add_counts(counts, precip)
+            if quantiles is not None:
+                for summary in quantiles:
+                    summary.add(ii, precip)
+            progbar.add(batch_size)
+        if convergence is not None:
+            with span("convergence"):
+                converged = convergence.converged(ii + batch_size)
+            if converged and ii + batch_size < ensemble_members:
+                progbar.update(ii + batch_size, finalize=True)
+                print(f"Converged after {ii + batch_size} members")
+                return ii + batch_size
+    return ensemble_members
 
-netcdf_dict["rootgrp"].close()
+
+# %%
+def forecast_date(gen, noise_channels, network_const_input, time_str, hour, fcst_params, members=None):
+    '''
+    Run the forecast initialised at time_str (YYYYMMDD) and hour, writing
+    GAN_<date>_<hour>Z.nc to the output folder given in fcst_params and/or
+    the histogram counts files to the counts folder.
+    If members, (start, stop), is given only those ensemble members are made
+    and the files are written as shards, see shards.py.
+    Returns the number of members made at each valid time, which is less
+    than ensemble_members where they converge with adaptive_members, see
+    convergence.py.
+    '''
+    input_folder = fcst_params["INPUT"]["folder"]
+    start_hour = fcst_params["INPUT"]["start_hour"]
+    end_hour = fcst_params["INPUT"]["end_hour"]
+    output_folder = fcst_params["OUTPUT"]["folder"]
+    ensemble_members = fcst_params["OUTPUT"]["ensemble_members"]
+    member_batch_size = fcst_params["OUTPUT"]["member_batch_size"]
+    write_ensemble = fcst_params["OUTPUT"]["write_ensemble"]
+    write_counts = fcst_params["OUTPUT"]["write_counts"]
+    counts_folder = fcst_params["OUTPUT"]["counts_folder"]
+    reproducible_noise = fcst_params["OUTPUT"]["reproducible_noise"]
+    compression = fcst_params["OUTPUT"]["compression"]
+    complevel = fcst_params["OUTPUT"]["complevel"]
+    chunk_members = fcst_params["OUTPUT"]["chunk_members"]
+    packing = fcst_params["OUTPUT"]["packing"]
+    write_quantiles = fcst_params["OUTPUT"]["write_quantiles"]
+    num_quantiles = fcst_params["OUTPUT"]["num_quantiles"]
+    adaptive_members = fcst_params["OUTPUT"]["adaptive_members"]
+
+    if members is None:
+        first_member = 0
+        out_path = lambda path: path
+    else:
+        assert reproducible_noise, "shards need reproducible_noise: True in forecast.yaml"
+        assert 0 <= members[0] < members[1] <= ensemble_members, f"members {members} not in the ensemble"
+        assert not adaptive_members, "shards need adaptive_members: False in forecast.yaml"
+        first_member = members[0]
+        ensemble_members = members[1] - members[0]
+        out_path = lambda path: shard_path(path, members)
+
+    # Instead of reading input_file from forecast.yaml, get it from the command line
+    input_file = f"IFS_{time_str}_{hour:02d}Z.nc"
+
+    # Open input netCDF file, once for the times and every valid time's fields
+    nc_in_path = os.path.join(input_folder, input_file)
+    print(f"IFS: {nc_in_path}")
+    num_valid_times = end_hour//HOURS - start_hour//HOURS
+    with span("ifs_read"):
+        ifs = IFSReader(nc_in_path, num_valid_times+1)
+        start_times = [ifs.nc_in["time"][0]]
+        valid_times = ifs.nc_in["valid_time"][:]
+    d = datetime(1900,1,1) + timedelta(hours=int(start_times[0]))
+    print(f"{d.year}-{d.month:02}-{d.day:02}")
+
+    # Create output netCDF file
+    if write_ensemble:
+        nc_out_path = out_path(os.path.join(output_folder, f"GAN_{d.year}{d.month:02}{d.day:02}_{hour:02d}Z.nc"))
+        pathlib.Path(os.path.dirname(nc_out_path)).mkdir(parents=True, exist_ok=True)
+
+        netcdf_dict = create_output_file(nc_out_path, ensemble_members, first_member,
+                                         compression, complevel, chunk_members, packing)
+        netcdf_dict["time_data"][0] = start_times[0]
+    else:
+        netcdf_dict = None
+
+    # The quantile summary needs every member, so shard_forecast.py makes it
+    # from the merged GAN_*.nc file instead
+    if write_quantiles and members is None:
+        gan_path = os.path.join(output_folder, f"GAN_{d.year}{d.month:02}{d.day:02}_{hour:02d}Z.nc")
+        pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)
+        quantiles_dict = create_quantiles_file(quantiles_path(gan_path), latitude, longitude, start_times[0],
+                                               valid_times[:num_valid_times], num_quantiles, ensemble_members,
+                                               True, compression, complevel)
+        # The members at each valid time, and their means over the valid times
+        quantiles = [EnsembleQuantiles(ensemble_members, (len(latitude), len(longitude))),
+                     EnsembleQuantiles(ensemble_members, (len(latitude), len(longitude)), 1.0/num_valid_times)]
+    else:
+        quantiles = None
+
+    # The members are compressed and written on a background thread, while
+    # the next ones are generated
+    writer = EnsembleWriter(fcst_params["OUTPUT"]["write_queue"])
+    members_made = []
+
+    # When only the counts are written the members can be binned in the
+    # generator's graph, so that they are not copied back from TensorFlow
+    count_in_graph = fcst_params["MODEL"]["count_in_graph"] and not write_ensemble and quantiles is None
+    if count_in_graph:
+        assert hasattr(gen, "count"), "count_in_graph needs a Keras or exported generator, not a quantised or tiled one"
+
+    # loop over time chunks. output forecasts may not start from hour 0, so
+    # generate output and input valid time indices using enumerate(...)
+    for out_time_idx, in_time_idx in enumerate(range(start_hour//HOURS, end_hour//HOURS)):
+        if write_ensemble:
+            # copy across valid_time from input file
+            writer.write(netcdf_dict["valid_time_data"], (0, out_time_idx), valid_times[out_time_idx])
+
+        if write_counts:
+            counts = np.zeros((len(bin_spec_1h)-1, len(latitude), len(longitude)), dtype=np.uint16)
+        else:
+            counts = None
+
+        # adaptive_members needs write_counts, as write_ensemble is False
+        if adaptive_members:
+            convergence = ConvergenceMonitor(counts, fcst_params["OUTPUT"]["min_members"],
+                                             fcst_params["OUTPUT"]["check_members"],
+                                             fcst_params["OUTPUT"]["convergence_tolerance"],
+                                             fcst_params["OUTPUT"]["converged_fraction"])
+        else:
+            convergence = None
+
+        writer.wait()  # netCDF files are only used by one thread at a time
+        network_fcst_input = load_fcst_input(ifs, out_time_idx)
+
+        if reproducible_noise:
+            noise_key = (int(f"{d.year}{d.month:02}{d.day:02}"), hour, start_hour+out_time_idx*HOURS)
+        else:
+            noise_key = None
+
+        members_made.append(generate_ensemble(gen, network_fcst_input, network_const_input, noise_channels,
+                                              ensemble_members, member_batch_size,
+                                              writer, netcdf_dict, out_time_idx, counts=counts, noise_key=noise_key,
+                                              first_member=first_member, quantiles=quantiles,
+                                              convergence=convergence, count_in_graph=count_in_graph))
+
+        if write_counts:
+            counts_path = out_path(os.path.join(counts_folder, f"{d.year}",
+                                                f"counts_{d.year}{d.month:02}{d.day:02}_{hour:02d}_{start_hour+out_time_idx*HOURS}h.nc"))
+            pathlib.Path(os.path.dirname(counts_path)).mkdir(parents=True, exist_ok=True)
+            writer.wait()
+            with span("netcdf_write", file="counts"):
+                write_counts_file(counts_path, latitude, longitude, start_times[0],
+                                  valid_times[out_time_idx], counts, members_made[-1])
+
+        if quantiles is not None:
+            writer.wait()
+            with span("quantiles"):
+                quantiles_dict["precipitation"][0, :, out_time_idx] = quantiles[0].quantiles(num_quantiles,
+                                                                                             members_made[-1])
+            quantiles[0].reset()
+
+    if quantiles is not None:
+        writer.wait()
+        # Only the members made at every valid time have a daily mean
+        with span("quantiles"):
+            quantiles_dict["daily_precipitation"][0] = quantiles[1].quantiles(num_quantiles, min(members_made))
+            if adaptive_members:
+                quantiles_dict["rootgrp"].ensemble_members = members_made
+                quantiles_dict["rootgrp"].daily_ensemble_members = min(members_made)
+            quantiles_dict["rootgrp"].close()
+
+    if write_ensemble:
+        writer.submit(netcdf_dict["rootgrp"].close)
+    writer.close()
+    ifs.close()
+    return members_made
 
 
+# %%
+if __name__ == "__main__":
+    # Get the date from the command line argument
+    time_str = sys.argv[1]
+    hour = int(sys.argv[2])
+
+    # Optionally only make some of the ensemble members
+    if len(sys.argv) > 3:
+        members = tuple(int(m) for m in sys.argv[3].split(":"))
+    else:
+        members = None
+
+    read_config.set_gpu_mode()  # set up whether to use GPU, and mem alloc mode
+    fcst_params = load_fcst_params()
+    start_timing(fcst_params, "forecast_date.py",
+                 fcst_params["OUTPUT"]["ensemble_members"] if members is None else members[1] - members[0],
+                 date=time_str, hour=hour, members=members)
+    network_const_input = load_hires_constants(batch_size=1)  # 1 x lats x lons x 2
+    gen, noise_channels = load_generator(fcst_params["MODEL"]["folder"],
+                                         fcst_params["MODEL"]["checkpoint"],
+                                         network_const_input,
+                                         fcst_params["MODEL"]["split_first_block"],
+                                         fcst_params["MODEL"]["use_export"],
+                                         fcst_params["MODEL"]["quantised"],
+                                         fcst_params["MODEL"]["tile_size"],
+                                         fcst_params["MODEL"]["tile_halo"],
+                                         fcst_params["MODEL"]["tile_workers"])
+
+    members_made = forecast_date(gen, noise_channels, network_const_input, time_str, hour, fcst_params, members)
+    end_run(members_made=members_made)
@@ -0,0 +1,65 @@
+# Reading the IFS input files of the forecasts.
+#
+# The network input for a valid time needs the time steps at the start and
+# end of its 6h block, of every field.  Opening the file for each field and
+# valid time, and reading two steps at a time, opens and parses the file
+# 2*len(all_fcst_fields) times per forecast, and reads the step shared by
+# consecutive valid times twice.  IFSReader opens the file once, reads each
+# variable's time steps for every valid time in one go, and keeps them.
+
+import netCDF4 as nc
+import numpy as np
+
+
+class IFSReader(object):
+    '''
+    Reads the variables of the IFS file nc_in_path, opened once.  The first
+    read of a variable covers num_steps time steps from the first one asked
+    for (all of the steps if num_steps is None), rounded out to whole chunks
+    of the variable, and later reads within those steps are taken from
+    memory.  The netCDF file is read by the thread calling read, see
+    writer.py.
+    '''
+    def __init__(self, nc_in_path, num_steps=None):
+        self.path = nc_in_path
+        self.nc_in = nc.Dataset(nc_in_path, mode="r")
+        self.num_steps = num_steps
+        self._steps = {}  # name -> (first time step, steps x lat x lon)
+
+    def _window(self, var, start, stop):
+        # The time steps to read for steps start to stop-1 of var
+        num_times = var.shape[0]
+        if self.num_steps is None:
+            start, stop = 0, num_times
+        else:
+            stop = max(stop, min(start + self.num_steps, num_times))
+        chunking = var.chunking()
+        if chunking != "contiguous":
+            start = start // chunking[0] * chunking[0]
+            stop = min(-(-stop // chunking[0]) * chunking[0], num_times)
+        return start, stop
+
+    def read(self, name, start, stop):
+        # Time steps start to stop-1 of the variable name, steps x lat x lon
+        first, steps = self._steps.get(name, (0, None))
+        if steps is None or start < first or stop > first + len(steps):
+            var = self.nc_in[name]
+            first, read_stop = self._window(var, start, stop)
+            steps = np.asarray(var[first:read_stop])
+            self._steps[name] = (first, steps)
+        return steps[start-first:stop-first]
+
+    def fcst_steps(self, field, start, stop):
+        # The ensemble mean and standard deviation of field at time steps start to stop-1
+        return (self.read(f"{field}_ensemble_mean", start, stop),
+                self.read(f"{field}_ensemble_standard_deviation", start, stop))
+
+    def close(self):
+        self._steps.clear()
+        self.nc_in.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,118 @@
+# Check that the modules used by the steps that do not run the cGAN, such as
+# the histogram counts, the quantile summaries and data.get_dates, import
+# quickly and without TensorFlow or the other slow packages.
+#
+# The scripts in entry_scripts, run by run_forecast.py after the forecasts,
+# are checked in the same way.
+#
+# Usage:
+#    python import_budget.py [--budget 0.5]
+#
+# Each module is imported by a new Python process run with -X importtime,
+# which reports how long each import takes, and each script is run with
+# --help from its own directory.  The check fails, listing the slowest
+# imports, if a module or script takes longer than the budget in seconds or
+# imports one of heavy_packages, and the script then exits with status 1.
+
+import argparse
+import os
+import subprocess
+import sys
+
+light_modules = ["data", "read_config", "constants_cache", "counts", "packing", "quantiles", "shards", "writer",
+                 "noise", "crps", "timing", "ifs_reader", "convergence"]
+
+# Relative to this directory
+entry_scripts = ["../../forecast2histogram_lowRAM.py", "../../find_available_dates.py"]
+
+heavy_packages = ["tensorflow", "keras", "xarray", "matplotlib", "cartopy", "seaborn"]
+
+
+def parse_import_times(stderr):
+    '''
+    The imports reported by -X importtime in stderr, in the order they
+    finished, as a list of (package, time of the package itself, time
+    including its imports, whether it was imported directly).
+    '''
+    # Each line is "import time: self [us] | cumulative | package", with the
+    # package indented by its depth, and listed after the packages it imports
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, package = line[len("import time:"):].split("|")
+        imports.append((package.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6, not package.startswith("  ")))
+    return imports
+
+
+def import_times(module):
+    '''
+    The times, in seconds, taken to import module and each of the packages
+    it imports, in a new Python process, as
+    {package: (time of the package itself, time including its imports)}.
+    The imports made by Python as it starts are left out.
+    '''
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+    times = {}
+    for package, self_time, cumulative_time, direct in parse_import_times(result.stderr):
+        times[package] = (self_time, cumulative_time)
+        if direct:
+            if package == module:
+                return times
+            times = {}  # imported as Python starts, not by module
+    raise RuntimeError(f"no import time found for {module}")
+
+
+def script_import_times(script):
+    '''
+    The times, in seconds, taken by the imports of script when it is run with
+    --help from its own directory, as for import_times, with the total time
+    as script.
+    '''
+    # Python imports the same packages as it starts whatever it runs
+    startup = subprocess.run([sys.executable, "-X", "importtime", "-c", "pass"], capture_output=True, text=True)
+    started = {package for package, _, _, direct in parse_import_times(startup.stderr) if direct}
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+    result = subprocess.run([sys.executable, "-X", "importtime", os.path.basename(path), "--help"],
+                            cwd=os.path.dirname(path), capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{script} --help failed:\n{result.stderr[-2000:]}")
+    times = {}
+    total = 0.0
+    for package, self_time, cumulative_time, direct in parse_import_times(result.stderr):
+        if direct and package in started:
+            times = {}  # imported as Python starts, not by script
+            continue
+        times[package] = (self_time, cumulative_time)
+        if direct:
+            total += cumulative_time
+    times[script] = (0.0, total)
+    return times
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check the import times of the lightweight modules and scripts.")
+    parser.add_argument("--budget", help="Seconds allowed for each module or script", default=0.5, type=float)
+    parser.add_argument("--slowest", help="Imports listed for a module or script over budget", default=8, type=int)
+    args = parser.parse_args()
+
+    failed = False
+    for module in light_modules + entry_scripts:
+        times = script_import_times(module) if module.endswith(".py") else import_times(module)
+        total = times[module][1]
+        heavy = [package for package in heavy_packages if package in times]
+        ok = total <= args.budget and not heavy
+        print(f"{module:38s} {total:6.3f} s  {'ok' if ok else 'FAILED'}"
+              + (f"  imports {', '.join(heavy)}" if heavy else ""))
+        if not ok:
+            failed = True
+            slowest = sorted((package for package in times if package != module),
+                             key=lambda package: times[package][1], reverse=True)[:args.slowest]
+            for package in slowest:
+                print(f"    {package:30s} {times[package][1]:6.3f} s")
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,217 @@
+# Per grid point quantile summaries of the cGAN ensemble, kept when the
+# GAN_*.nc files are deleted.
+#
+# A summary of the ensemble members is their num_quantiles quantiles at
+# probabilities k/(num_quantiles+1), k = 1 to num_quantiles-1, and 1, the
+# largest member, at each grid point, found as
+# np.percentile(..., method="weibull").  np.percentile with method="weibull"
+# of the quantiles gives the same percentiles as of the members, to within the
+# interpolation between them, except above (num_quantiles-1)/(num_quantiles+1).
+# So a summary can be read as an ensemble of num_quantiles members, and with
+# 100 quantiles gives all of the percentiles used by ELR, 1 to 100 in 50
+# steps.  ELR/run_ELR.py and the forecast2histogram scripts read
+# GAN_*_quantiles.nc in this way when GAN_*.nc is missing.  The counts files
+# then have num_members = num_quantiles.
+#
+# The summary file is the GAN_*.nc file with a quantile dimension in place of
+# member, and the precipitation packed as int16, see packing.py.  When there
+# are several valid times, as in the 6h forecasts, daily_precipitation holds
+# the quantiles of each member's mean over the valid times, which ELR uses.
+# The mean of the quantiles is not the quantile of the mean.
+#
+# Usage:
+#    python quantiles.py GAN_FILE [GAN_FILE ...] [--num_quantiles 100]
+# writes the summaries of forecasts that have already been made.
+
+import argparse
+import os
+
+import netCDF4 as nc
+import numpy as np
+
+from packing import max_packed, set_packing, unpack_precipitation
+
+# The precipitation is held by EnsembleQuantiles as multiples of step mm/h
+step = 100.0 / max_packed["int16"]
+
+
+def quantile_probabilities(num_quantiles):
+    probabilities = np.arange(1, num_quantiles+1) / (num_quantiles+1)
+    probabilities[-1] = 1.0  # the largest member
+    return probabilities
+
+
+def quantiles_path(gan_path):
+    # GAN_<...>.nc -> GAN_<...>_quantiles.nc
+    return os.path.splitext(gan_path)[0] + "_quantiles.nc"
+
+
+def ensemble_path(gan_path):
+    # gan_path, or if it has been deleted the path of its summary
+    if not os.path.isfile(gan_path) and os.path.isfile(quantiles_path(gan_path)):
+        return quantiles_path(gan_path)
+    return gan_path
+
+
+def ensemble_quantiles(members, num_quantiles):
+    '''
+    The quantiles at quantile_probabilities(num_quantiles) of members
+    (members x ...) along the first axis, as
+    np.percentile(members, 100*quantile_probabilities(num_quantiles), axis=0, method="weibull")
+    but faster.
+    '''
+    num_members = members.shape[0]
+    position = np.clip(quantile_probabilities(num_quantiles) * (num_members+1) - 1, 0, num_members-1)
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, num_members - 1)
+    fraction = (position - lower).reshape((-1,) + (1,)*(members.ndim-1))
+    members = np.sort(members, axis=0)
+    return members[lower] * (1 - fraction) + members[upper] * fraction
+
+
+class EnsembleQuantiles(object):
+    '''
+    Holds the ensemble members of a field, given to add(), for their
+    quantiles.  Each member is stored as an int16 multiple of step, so 1000
+    members of the ICPAC domain take 270 MB.
+    The stored members are the sums of weight times the values added for
+    them, so with weight 1/4 and the members of four valid times added they
+    are the members' means.
+    '''
+    def __init__(self, ensemble_members, shape, weight=1.0):
+        self.members = np.zeros((ensemble_members,) + shape, dtype=np.int16)
+        self.weight = weight
+
+    def reset(self):
+        self.members[:] = 0
+
+    def add(self, start, precip):
+        # Add precip, members start onwards (members x lat x lon) in mm/h
+        stored = self.members[start:start+len(precip)]
+        values = np.rint(precip * (self.weight / step)).astype(np.int32)
+        values += stored
+        np.clip(values, -max_packed["int16"], max_packed["int16"], out=values)
+        stored[:] = values
+
+    def quantiles(self, num_quantiles, num_members=None, band_size=32):
+        # The quantiles of the first num_members members, by default all of
+        # them, num_quantiles x lat x lon in mm/h, sorting band_size
+        # latitudes at a time to save memory
+        members = self.members[:num_members]
+        height = members.shape[1]
+        quantiles = np.empty((num_quantiles,) + members.shape[1:], dtype=np.float32)
+        for j in range(0, height, band_size):
+            quantiles[:, j:j+band_size] = ensemble_quantiles(members[:, j:j+band_size], num_quantiles) * step
+        return quantiles
+
+
+def create_quantiles_file(nc_out_path, latitude, longitude, time, valid_times, num_quantiles, ensemble_members,
+                          daily=False, compression="zlib", complevel=4):
+    '''
+    Create the summary file nc_out_path of ensemble_members members, for
+    num_quantiles quantiles at the valid times valid_times.  The quantiles
+    are written to netcdf_dict["precipitation"][0, :, valid_time_idx], and
+    if daily is True those of the mean over the valid times to
+    netcdf_dict["daily_precipitation"][0].
+    '''
+    netcdf_dict = {}
+    rootgrp = nc.Dataset(nc_out_path, "w", format="NETCDF4")
+    netcdf_dict["rootgrp"] = rootgrp
+    rootgrp.description = "cGAN forecast ensemble quantiles"
+    rootgrp.ensemble_members = ensemble_members
+
+    rootgrp.createDimension("latitude", len(latitude))
+    rootgrp.createDimension("longitude", len(longitude))
+    rootgrp.createDimension("quantile", num_quantiles)
+    rootgrp.createDimension("time", 1)
+    rootgrp.createDimension("valid_time", len(valid_times))
+
+    latitude_data = rootgrp.createVariable("latitude", "f4", ("latitude",))
+    latitude_data.units = "degrees_north"
+    latitude_data[:] = latitude
+
+    longitude_data = rootgrp.createVariable("longitude", "f4", ("longitude",))
+    longitude_data.units = "degrees_east"
+    longitude_data[:] = longitude
+
+    quantile_data = rootgrp.createVariable("quantile", "f4", ("quantile",))
+    quantile_data.description = "Probability of the ensemble being below the quantile"
+    quantile_data[:] = quantile_probabilities(num_quantiles)
+
+    time_data = rootgrp.createVariable("time", "f4", ("time",))
+    time_data.units = "hours since 1900-01-01 00:00:00.0"
+    time_data[:] = time
+
+    valid_time_data = rootgrp.createVariable("fcst_valid_time", "f4", ("time", "valid_time"))
+    valid_time_data.units = "hours since 1900-01-01 00:00:00.0"
+    valid_time_data[0, :] = valid_times
+
+    netcdf_dict["precipitation"] = rootgrp.createVariable("precipitation", "i2",
+                                                          ("time", "quantile", "valid_time",
+                                                           "latitude", "longitude"),
+                                                          compression=compression,
+                                                          complevel=complevel,
+                                                          chunksizes=(1, 1, 1, len(latitude), len(longitude)))
+    netcdf_dict["precipitation"].units = "mm h**-1"
+    netcdf_dict["precipitation"].long_name = "Precipitation"
+    set_packing(netcdf_dict["precipitation"], "int16")
+
+    if daily:
+        netcdf_dict["daily_precipitation"] = rootgrp.createVariable("daily_precipitation", "i2",
+                                                                    ("time", "quantile", "latitude", "longitude"),
+                                                                    compression=compression,
+                                                                    complevel=complevel,
+                                                                    chunksizes=(1, 1, len(latitude), len(longitude)))
+        netcdf_dict["daily_precipitation"].units = "mm h**-1"
+        netcdf_dict["daily_precipitation"].long_name = "Precipitation, mean over the valid times"
+        set_packing(netcdf_dict["daily_precipitation"], "int16")
+
+    return netcdf_dict
+
+
+def summarise_file(gan_path, num_quantiles, compression="zlib", complevel=4, band_size=32):
+    '''
+    Write the summary of the GAN_*.nc file gan_path to
+    quantiles_path(gan_path), reading band_size latitudes at a time.
+    The members are summarised by EnsembleQuantiles, as forecast_date.py
+    summarises them, so with packing "float32" the summary is the one it
+    would have written.  The members of packed files have already been
+    rounded, so their summaries can differ by a few multiples of step, or
+    by the log_uint8 rounding.
+    '''
+    nc_in = nc.Dataset(gan_path, "r")
+    precip_var = nc_in["precipitation"]
+    valid_times = np.array(nc_in["fcst_valid_time"][0])
+    ensemble_members = len(nc_in.dimensions["member"])
+    netcdf_dict = create_quantiles_file(quantiles_path(gan_path), nc_in["latitude"][:], nc_in["longitude"][:],
+                                        nc_in["time"][:], valid_times, num_quantiles,
+                                        ensemble_members, len(valid_times) > 1,
+                                        compression, complevel)
+    height = len(nc_in.dimensions["latitude"])
+    for j in range(0, height, band_size):
+        # members x valid times x band x lon
+        precip = unpack_precipitation(np.array(precip_var[0, :, :, j:j+band_size]), precip_var).astype(np.float32)
+        summary = EnsembleQuantiles(ensemble_members, precip.shape[2:])
+        for v in range(len(valid_times)):
+            summary.reset()
+            summary.add(0, precip[:, v])
+            netcdf_dict["precipitation"][0, :, v, j:j+band_size] = summary.quantiles(num_quantiles)
+        if "daily_precipitation" in netcdf_dict:
+            daily_summary = EnsembleQuantiles(ensemble_members, precip.shape[2:], 1.0/len(valid_times))
+            for v in range(len(valid_times)):
+                daily_summary.add(0, precip[:, v])
+            netcdf_dict["daily_precipitation"][0, :, j:j+band_size] = daily_summary.quantiles(num_quantiles)
+    netcdf_dict["rootgrp"].close()
+    nc_in.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Write the quantile summaries of cGAN forecasts.")
+    parser.add_argument("gan_files", help="GAN_*.nc files", nargs="+")
+    parser.add_argument("--num_quantiles", help="Quantiles at each grid point", default=100, type=int)
+    args = parser.parse_args()
+
+    for gan_path in args.gan_files:
+        print(f"Writing {quantiles_path(gan_path)}")
+        summarise_file(gan_path, args.num_quantiles)
@@ -0,0 +1,207 @@
+# Convert a cGAN generator to a quantised TFLite model for forecasts on CPU,
+# and report how much the quantisation changes the forecasts
+#
+# Usage:
+#    python quantise_generator.py MODE --calibration IFS_FILE [IFS_FILE ...] --test IFS_FILE [IFS_FILE ...]
+# e.g.
+#    python quantise_generator.py int8 --calibration ../../IFS_forecast_data/IFS_20241021_00Z.nc \
+#                                      --test ../../IFS_forecast_data/IFS_20241022_00Z.nc
+#
+# MODE is one of
+#    dynamic - int8 weights, float32 activations
+#    int8    - int8 weights and activations, calibrated on the --calibration files
+#    float16 - float16 weights
+#
+# The model in forecast.yaml is converted, or the one given by --model_folder
+# and --checkpoint.  The report compares ensembles made by the float32 and
+# quantised generators, with the same noise, for each valid time in the
+# --test files, which should not be calibration files:
+#    - the histogram counts in each bin of counts.bin_spec_1h
+#    - the CRPS of each ensemble, scored against an independent float32
+#      member, which stands in for the observations
+#    - the time per ensemble member.
+# It is written to MODEL_FOLDER/models/gen_MODE-CHECKPOINT_report.txt.
+#
+# The TFLite model is only saved, to MODEL_FOLDER/models/gen_MODE-CHECKPOINT.tflite,
+# if the changes are within --max_count_change and --max_crps_increase.  Set
+# quantised: MODE in forecast.yaml to use it.
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+import read_config
+from data import HOURS, denormalise, load_hires_constants
+from noise import NoiseGenerator
+from counts import bin_spec_1h, add_counts
+from crps import crps_ensemble
+from forecast_date import latitude, longitude, load_fcst_params, build_generator, quantised_generator_path, \
+    load_fcst_input
+from ifs_reader import IFSReader
+from inference import quantise_generator, TFLiteGenerator
+
+
+def load_inputs(ifs_paths, fcst_params):
+    # The network inputs for every valid time of the forecast in each file,
+    # as forecast_date.py makes them
+    num_valid_times = (fcst_params["INPUT"]["end_hour"] - fcst_params["INPUT"]["start_hour"]) // HOURS
+    network_fcst_inputs = []
+    for ifs_path in ifs_paths:
+        with IFSReader(ifs_path, num_valid_times+1) as ifs:
+            network_fcst_inputs += [load_fcst_input(ifs, out_time_idx) for out_time_idx in range(num_valid_times)]
+    return np.concatenate(network_fcst_inputs)
+
+
+def generate_members(gen, network_fcst_input, network_const_input, noise, member_batch_size):
+    # The precipitation of one ensemble member for each noise sample, and the
+    # time taken per member
+    num_members = noise.shape[0]
+    start_time = time.time()
+    gan_prediction = gen.predict([np.repeat(network_fcst_input[None], num_members, axis=0),
+                                  np.repeat(network_const_input, num_members, axis=0),
+                                  noise],
+                                 batch_size=member_batch_size, verbose=False)
+    return denormalise(gan_prediction[:, :, :, 0]), (time.time() - start_time) / num_members
+
+
+def compare_ensembles(gen, quantised_gen, network_fcst_inputs, network_const_input, noise_channels,
+                      ensemble_members, member_batch_size):
+    '''
+    Returns the lines of the report comparing the ensembles of gen and
+    quantised_gen for each of network_fcst_inputs, the fraction of members
+    changing bin and the CRPS increase in percent.
+    '''
+    noise_shape = network_fcst_inputs.shape[1:-1] + (noise_channels,)
+    counts = np.zeros((2, len(bin_spec_1h)-1, len(latitude), len(longitude)), dtype=np.int64)
+    abs_count_diff = np.zeros(len(bin_spec_1h)-1)
+    crps = np.zeros(2)
+    seconds_per_member = np.zeros(2)
+
+    for i, network_fcst_input in enumerate(network_fcst_inputs):
+        print(f"Test input {i+1} of {len(network_fcst_inputs)}")
+        noise_gen = NoiseGenerator(noise_shape, batch_size=ensemble_members, random_seed=i)
+        noise = noise_gen()
+        noise_gen.batch_size = 1
+        obs_noise = noise_gen()
+
+        # The same noise is used by both generators, so the ensembles only
+        # differ by the quantisation
+        case_counts = np.zeros((2, len(bin_spec_1h)-1, len(latitude), len(longitude)), dtype=np.int64)
+        obs, _ = generate_members(gen, network_fcst_input, network_const_input, obs_noise, 1)
+        for k, g in enumerate((gen, quantised_gen)):
+            precip, seconds = generate_members(g, network_fcst_input, network_const_input, noise, member_batch_size)
+            add_counts(case_counts[k], precip)
+            crps[k] += crps_ensemble(obs[0], np.moveaxis(precip, 0, -1)).mean()
+            seconds_per_member[k] += seconds
+        counts += case_counts
+        abs_count_diff += np.abs(case_counts[1] - case_counts[0]).mean(axis=(1, 2))
+
+    num_cases = len(network_fcst_inputs)
+    crps /= num_cases
+    seconds_per_member /= num_cases
+    # The average number of members in each bin at each grid point
+    mean_counts = counts.mean(axis=(2, 3)) / num_cases
+    abs_count_diff /= num_cases
+
+    # Each member that changes bin changes two counts by one
+    count_change = abs_count_diff.sum() / 2 / ensemble_members
+    if crps[0] > 0:
+        crps_increase = 100 * (crps[1] - crps[0]) / crps[0]
+    else:
+        # no rain in the float32 ensembles or the observations
+        crps_increase = 0.0 if crps[1] == 0 else np.inf
+
+    lines = [f"{num_cases} test valid times, {ensemble_members} ensemble members",
+             "",
+             "Histogram counts per grid point, averaged over grid points and valid times",
+             f"{'bin (mm/h)':>20} {'float32':>10} {'quantised':>10} {'mean |diff|':>12}"]
+    for b in range(len(bin_spec_1h)-1):
+        lines.append(f"{bin_spec_1h[b]:9.3f} - {bin_spec_1h[b+1]:8.3f} {mean_counts[0, b]:10.3f} "
+                     f"{mean_counts[1, b]:10.3f} {abs_count_diff[b]:12.4f}")
+    lines += ["",
+              f"Fraction of members changing bin (at most): {count_change:.5f}",
+              "",
+              "CRPS (mm/h), against an independent float32 member",
+              f"    float32:   {crps[0]:.6f}",
+              f"    quantised: {crps[1]:.6f}",
+              f"    increase:  {crps_increase:.3f}%",
+              "",
+              "Seconds per ensemble member",
+              f"    float32:   {seconds_per_member[0]:.3f}",
+              f"    quantised: {seconds_per_member[1]:.3f}"]
+    return lines, count_change, crps_increase
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Quantise a cGAN generator and report the change in the forecasts.")
+    parser.add_argument("mode", help="Quantisation", choices=["dynamic", "int8", "float16"])
+    parser.add_argument("--calibration", help="IFS files to calibrate int8 quantisation with", nargs="+", default=[])
+    parser.add_argument("--test", help="IFS files to compare the forecasts on", nargs="+", required=True)
+    parser.add_argument("--model_folder", help="Model folder, default from forecast.yaml")
+    parser.add_argument("--checkpoint", help="Checkpoint, default from forecast.yaml", type=int)
+    parser.add_argument("--members", help="Ensemble members compared for each valid time", default=20, type=int)
+    parser.add_argument("--calibration_samples", help="Noise samples for each calibration input", default=2, type=int)
+    parser.add_argument("--max_count_change", help="Largest acceptable fraction of members changing bin",
+                        default=0.02, type=float)
+    parser.add_argument("--max_crps_increase", help="Largest acceptable CRPS increase, in percent",
+                        default=1.0, type=float)
+    args = parser.parse_args()
+
+    if args.mode == "int8" and not args.calibration:
+        parser.error("int8 quantisation needs --calibration files")
+
+    fcst_params = load_fcst_params()
+    model_folder = fcst_params["MODEL"]["folder"] if args.model_folder is None else args.model_folder
+    checkpoint = fcst_params["MODEL"]["checkpoint"] if args.checkpoint is None else args.checkpoint
+    member_batch_size = fcst_params["OUTPUT"]["member_batch_size"]
+
+    read_config.set_gpu_mode()  # set up whether to use GPU, and mem alloc mode
+
+    network_const_input = load_hires_constants(batch_size=1)  # 1 x lats x lons x 2
+    print(f"Quantising model in {model_folder} checkpoint {checkpoint}.")
+    gen, noise_channels = build_generator(model_folder)
+    gen.load_weights(os.path.join(model_folder, "models", f"gen_weights-{checkpoint:07}.h5"))
+
+    calibration_inputs = []
+    if args.mode == "int8":
+        network_fcst_inputs = load_inputs(args.calibration, fcst_params)
+        noise_gen = NoiseGenerator(network_fcst_inputs.shape[1:-1] + (noise_channels,), batch_size=1)
+        calibration_inputs = [[network_fcst_input[None], network_const_input, noise_gen()]
+                              for network_fcst_input in network_fcst_inputs
+                              for _ in range(args.calibration_samples)]
+    tflite_model = quantise_generator(gen, len(latitude), len(longitude), args.mode, calibration_inputs)
+
+    # Compare with the float32 generator
+    tflite_path = quantised_generator_path(model_folder, checkpoint, args.mode)
+    tmp_path = tflite_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(tflite_model)
+    report, count_change, crps_increase = compare_ensembles(gen, TFLiteGenerator(tmp_path),
+                                                            load_inputs(args.test, fcst_params),
+                                                            network_const_input, noise_channels,
+                                                            args.members, member_batch_size)
+    accepted = count_change <= args.max_count_change and crps_increase <= args.max_crps_increase
+
+    report = [f"Model in {model_folder} checkpoint {checkpoint}, {args.mode} quantisation",
+              f"Calibration files: {' '.join(args.calibration)}",
+              f"Test files: {' '.join(args.test)}",
+              ""] + report + \
+             ["",
+              f"{'ACCEPTED' if accepted else 'REJECTED'} (max_count_change {args.max_count_change}, "
+              f"max_crps_increase {args.max_crps_increase}%)"]
+    report_path = tflite_path[:-len(".tflite")] + "_report.txt"
+    with open(report_path, "w") as f:
+        f.write("\n".join(report) + "\n")
+    print("\n".join(report))
+    print(f"Report saved to {report_path}")
+
+    if accepted:
+        os.replace(tmp_path, tflite_path)
+        print(f"Saved to {tflite_path}")
+    else:
+        os.remove(tmp_path)
+        sys.exit(1)
@@ -30,7 +30,6 @@
 
 
 import numpy as np
-import matplotlib.pyplot as plt
 
 
 def compute_centred_coord_array(M, N):
@@ -190,6 +189,8 @@ def plot_spectrum1d(
     ax: Axes
         Plot axes
     """
+    import matplotlib.pyplot as plt  # only needed for plotting
+
     # Check input dimensions
     n_freq = len(fft_freq)
     n_pow = len(fft_power)
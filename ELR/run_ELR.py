@@ -29,6 +29,21 @@ subcounty = True
 counties = None
 subcounties = None
 
+def unpack_precipitation(ds):
+    # GAN forecasts may be packed as log10(1 + precipitation), see
+    # cGAN/dsrnngan/packing.py.  xarray has already undone the scale_factor.
+    if 'precipitation' in ds and ds.precipitation.attrs.get('packing') == 'log_uint8':
+        ds['precipitation'] = 10**ds.precipitation - 1.0
+    return ds
+
+def open_forecast(file_name):
+    # If the GAN ensemble has been deleted its quantile summary, which
+    # stands in for it, see cGAN/dsrnngan/quantiles.py
+    quantiles_name = file_name.replace('.nc', '_quantiles.nc')
+    if not os.path.exists(file_name) and os.path.exists(quantiles_name):
+        return xr.open_dataset(quantiles_name)
+    return unpack_precipitation(xr.open_dataset(file_name))
+
 def get_model_output(date, accumulation = "6h_accumulations", model="GAN", day=1):
 
     if model == 'GAN':
@@ -37,12 +52,15 @@ def get_model_output(date, accumulation = "6h_accumulations", model="GAN", day=1
         fcst_root_dir = f'{FCST_PATH}/{accumulation}/{model}_forecast_data/'
 
     if accumulation == "6h_accumulations":
-        ds_fcst = xr.open_dataset(fcst_root_dir+f'{model}_{date}_00Z.nc')
+        ds_fcst = open_forecast(fcst_root_dir+f'{model}_{date}_00Z.nc')
         ds_fcst = ds_fcst.mean("valid_time")
+        if 'daily_precipitation' in ds_fcst:
+            # A quantile summary holds the quantiles of the members' means
+            ds_fcst['precipitation'] = ds_fcst.daily_precipitation
         ds_fcst['fcst_valid_time'] = xr.DataArray(ds_fcst.time.values+np.timedelta64(30,'h'),dims=['time'],
                                                   coords={'time':ds_fcst.time.values})
     else:
-        ds_fcst = xr.open_dataset(fcst_root_dir+f'{model}_{date}_00Z_v{day}.nc')
+        ds_fcst = open_forecast(fcst_root_dir+f'{model}_{date}_00Z_v{day}.nc')
         ds_fcst = ds_fcst.isel({"valid_time":0})
 
     return ds_fcst
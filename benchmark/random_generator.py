@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+# Save randomly initialised weights for the generators used by the forecast
+# script in the current directory, so that the forecasts can be benchmarked
+# without the trained checkpoints.
+#
+# Usage, from a copy of 6h_accumulations/cGAN/dsrnngan or
+# 24h_accumulations/cGAN/dsrnngan (it overwrites the weights there):
+#    python ../../../benchmark/random_generator.py [--seed 0]
+#
+# Each generator is built from the setup_params.yaml in its model folder, as
+# forecast_date.py builds it, so it has the shapes and cost of the trained
+# one, and its weights are saved where forecast_date.py loads them from:
+# the 6h model in forecast.yaml, or every model in the 24h
+# lead_time_models.  The forecasts it makes are not meaningful, but they
+# take as long to make as real ones.  They have rain almost everywhere, so
+# they compress a little less well than real forecasts.
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.getcwd())  # the forecast script's directory, not this one
+
+
+def generator_checkpoints():
+    # The (model folder, checkpoint) of each generator that forecast_date.py loads
+    import forecast_date
+    if hasattr(forecast_date, "lead_time_models"):
+        return sorted(set(forecast_date.lead_time_models.values()))
+    fcst_params = forecast_date.load_fcst_params()
+    return [(fcst_params["MODEL"]["folder"], fcst_params["MODEL"]["checkpoint"])]
+
+
+def save_random_weights(model_folder, checkpoint, seed):
+    # Build the generator in model_folder with weights drawn using seed, and
+    # save them as the weights of checkpoint
+    import tensorflow as tf
+    from forecast_date import build_generator
+
+    tf.keras.utils.set_random_seed(seed)
+    gen, _ = build_generator(model_folder)
+    os.makedirs(os.path.join(model_folder, "models"), exist_ok=True)
+    weights_fn = os.path.join(model_folder, "models", f"gen_weights-{checkpoint:07}.h5")
+    gen.save_weights(weights_fn)
+    return weights_fn
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Save randomly initialised weights for the forecast generators.")
+    parser.add_argument("--seed", help="Seed of the first generator's weights, the next generators use seed+1, ...",
+                        default=0, type=int)
+    args = parser.parse_args()
+
+    import read_config
+    read_config.set_gpu_mode()  # set up whether to use GPU, and mem alloc mode
+    for i, (model_folder, checkpoint) in enumerate(generator_checkpoints()):
+        print(f"Random weights: {save_random_weights(model_folder, checkpoint, args.seed + i)}")
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+# Benchmark the forecast pipeline run by run_forecast.py, on any Linux
+# machine, without the ECMWF data or the trained models.
+#
+# Usage, from the SEWAA-forecasts directory:
+#    python benchmark/run_benchmark.py
+#    python benchmark/run_benchmark.py --accumulation 6h --members 50
+#    python benchmark/run_benchmark.py --stages inference histogram --workers 4
+#
+# For each accumulation the scripts are copied to a sandbox in the work
+# directory, with randomly initialised generators (random_generator.py) in
+# place of the trained weights and a synthetic IFS file (synthetic_ifs.py)
+# in place of the download from gbmc.  The stages of run_forecast.py are
+# then run there, with the same commands:
+#
+#    inference  forecast_date.py, the cGAN ensemble
+#    histogram  forecast2histogram_lowRAM.py or forecast2histogram_7d_lowRAM.py
+#    dates      find_available_dates.py
+#    elr        ELR/run_ELR.py
+#
+# The wall clock time, CPU time and peak memory of each stage are reported,
+# with the time spent in each stage of the inference from its run log (see
+# cGAN/dsrnngan/timing.py), and the change since the last result on the same
+# host with the same options.  Each result is appended to the results file,
+# a JSON-lines file that also records the git commit, the CPU and the
+# versions of the main packages, so it can be tracked across versions.
+#
+# The inputs only depend on --seed, and the sandbox sets reproducible_noise,
+# so the same version on the same machine does the same work every time.
+# The members are fewer than the operational 1000 by default; the inference
+# and histogram times grow in proportion to the members.
+
+import argparse
+import importlib.metadata
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import yaml
+
+from synthetic_ifs import write_synthetic_ifs
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # the SEWAA-forecasts directory
+benchmark_dir = os.path.join(root_dir, "benchmark")
+
+# The run log of the inference is summarised with the forecast scripts' code
+sys.path.append(os.path.join(root_dir, "6h_accumulations", "cGAN", "dsrnngan"))
+from timing import read_runs, stage_times  # noqa: E402
+
+all_stages = ["inference", "histogram", "dates", "elr"]
+
+# The file in each sandbox that marks it as safe to delete
+sandbox_marker = ".benchmark_sandbox"
+
+# Files not copied to the sandboxes: outputs, caches and the trained weights
+sandbox_ignore = shutil.ignore_patterns("__pycache__", "cGAN_forecasts", "IFS_forecast_data", "forecast_queue",
+                                        "forecast_timing.jsonl", "*_cache_v*", "gen_weights-*.h5", "gen_export-*",
+                                        "*.tflite")
+
+packages = ["numpy", "netCDF4", "tensorflow", "xarray"]
+
+
+def stage_commands(accumulation, date_str, workers):
+    '''
+    The command and directory, relative to the SEWAA-forecasts directory,
+    of each stage of run_forecast.py for accumulation ("6h" or "24h") and
+    the forecast initialised at 00Z on date_str.
+    '''
+    python = sys.executable
+    acc_dir = f"{accumulation}_accumulations"
+    if accumulation == "6h":
+        inference = [python, "forecast_date.py", date_str, "0"]
+        histogram = [python, "forecast2histogram_lowRAM.py", date_str, "0", "--workers", str(workers)]
+        elr = [python, "run_ELR.py", "--date", date_str, "--model", "GAN", "--day", "1",
+               "--accumulation", "6h_accumulations"]
+    else:
+        inference = [python, "forecast_date.py", ",".join(str(v) for v in range(7)), date_str]
+        histogram = [python, "forecast2histogram_7d_lowRAM.py", date_str, "0", "--workers", str(workers)]
+        elr = [python, "run_ELR.py", "--date", date_str, "--model", "GAN", "--accumulation", "24h_accumulations"]
+    return {"inference": (inference, os.path.join(acc_dir, "cGAN", "dsrnngan")),
+            "histogram": (histogram, acc_dir),
+            "dates": ([python, "find_available_dates.py"], acc_dir),
+            "elr": (elr, "ELR")}
+
+
+def make_sandbox(sandbox_dir, accumulation, members, timing_log):
+    '''
+    Copy the scripts, constants, shapes and ELR models needed by the stages
+    of accumulation to sandbox_dir, replacing a previous sandbox there, and
+    set the ensemble size and run log in its forecast.yaml.
+    '''
+    if os.path.exists(sandbox_dir):
+        assert os.path.isfile(os.path.join(sandbox_dir, sandbox_marker)), \
+            f"{sandbox_dir} exists and is not a benchmark sandbox, not deleting it"
+        shutil.rmtree(sandbox_dir)
+    os.makedirs(sandbox_dir)
+    open(os.path.join(sandbox_dir, sandbox_marker), "w").close()
+
+    acc_dir = f"{accumulation}_accumulations"
+    for name in [acc_dir, "ELR", "shapes", "cGAN_data"]:
+        shutil.copytree(os.path.join(root_dir, name), os.path.join(sandbox_dir, name), ignore=sandbox_ignore)
+    shutil.copy(os.path.join(root_dir, "run_forecast.py"), sandbox_dir)
+    for name in ["cGAN_forecasts", "IFS_forecast_data"]:
+        os.makedirs(os.path.join(sandbox_dir, acc_dir, name))
+    # Where the histogram scripts write the counts, and run_forecast.py looks for them
+    for counts_dir in ["interface/view_forecasts/data", "interface/data"]:
+        os.makedirs(os.path.join(sandbox_dir, counts_dir, f"counts_{accumulation}"))
+
+    fcstyaml_path = os.path.join(sandbox_dir, acc_dir, "cGAN", "dsrnngan", "forecast.yaml")
+    with open(fcstyaml_path) as f:
+        fcst_params = yaml.safe_load(f)
+    fcst_params["OUTPUT"]["ensemble_members"] = members
+    fcst_params["OUTPUT"]["write_ensemble"] = True  # the histogram and ELR stages read the ensemble
+    fcst_params["OUTPUT"]["reproducible_noise"] = True  # the same noise on every run
+    fcst_params["OUTPUT"]["timing_log"] = timing_log
+    with open(fcstyaml_path, "w") as f:
+        yaml.safe_dump(fcst_params, f, sort_keys=False)
+
+
+def run_stage(command, cwd, log_path):
+    '''
+    Run command in cwd, with its output in log_path, and return its wall
+    clock and CPU time (s), peak memory (MB, of its largest process) and
+    exit code.
+    '''
+    start = time.perf_counter()
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)  # already waited for
+    return {"seconds": round(seconds, 3),
+            "cpu_seconds": round(rusage.ru_utime + rusage.ru_stime, 3),
+            "max_rss_mb": round(rusage.ru_maxrss / 1024, 1),  # ru_maxrss is in kB on Linux
+            "returncode": process.returncode}
+
+
+def git_version():
+    # The commit of the SEWAA-forecasts directory, marked -dirty if it has changed
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=root_dir,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def package_versions():
+    versions = {}
+    for package in packages:
+        try:
+            versions[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def benchmark_accumulation(accumulation, args, ifs_path):
+    # Run the stages for accumulation in a new sandbox, and return the result
+    sandbox_dir = os.path.join(args.work_dir, accumulation)
+    timing_log = os.path.join(sandbox_dir, "forecast_timing.jsonl")
+    make_sandbox(sandbox_dir, accumulation, args.members, timing_log)
+    acc_dir = os.path.join(sandbox_dir, f"{accumulation}_accumulations")
+    os.symlink(ifs_path, os.path.join(acc_dir, "IFS_forecast_data", os.path.basename(ifs_path)))
+    os.makedirs(os.path.join(sandbox_dir, "interface", "view_forecasts", "data", f"counts_{accumulation}",
+                             args.date[:4]))
+
+    print(f"Random generator weights for {accumulation}")
+    subprocess.run([sys.executable, os.path.join(benchmark_dir, "random_generator.py"), "--seed", str(args.seed)],
+                   cwd=os.path.join(acc_dir, "cGAN", "dsrnngan"), check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    result = {"time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+              "host": socket.gethostname(), "cpu": cpu_model(), "cpus": os.cpu_count(),
+              "python": platform.python_version(), "packages": package_versions(), "version": git_version(),
+              "accumulation": accumulation, "members": args.members, "seed": args.seed, "workers": args.workers,
+              "stages": {}}
+    commands = stage_commands(accumulation, args.date, args.workers)
+    for stage in args.stages:
+        command, cwd = commands[stage]
+        print(f"{accumulation} {stage}: {' '.join(command[1:])}")
+        result["stages"][stage] = run_stage(command, os.path.join(sandbox_dir, cwd),
+                                            os.path.join(sandbox_dir, f"{stage}.log"))
+        if result["stages"][stage]["returncode"] != 0:
+            print(f"    failed, see {os.path.join(sandbox_dir, stage + '.log')}")
+
+    if "inference" in args.stages and os.path.isfile(timing_log):
+        totals, _ = stage_times(read_runs([timing_log]))
+        result["inference_stages"] = {stage: round(float(seconds.sum()), 3) for stage, seconds in totals.items()}
+    return result
+
+
+def previous_result(results_path, result):
+    # The last result in results_path comparable with result, or None
+    if not os.path.isfile(results_path):
+        return None
+    keys = ["host", "cpus", "accumulation", "members", "seed", "workers"]
+    matches = [r for r in read_runs([results_path]) if all(r.get(key) == result[key] for key in keys)]
+    return matches[-1] if matches else None
+
+
+def change(seconds, previous_seconds):
+    if previous_seconds is None or previous_seconds == 0:
+        return ""
+    return f"{100*(seconds - previous_seconds)/previous_seconds:+7.1f}%"
+
+
+def print_result(result, previous):
+    print(f"\n{result['accumulation']}, {result['members']} members, version {result['version']}, "
+          f"{result['cpus']} x {result['cpu']}"
+          + (f", compared with {previous['version']} at {previous['time']}" if previous else ""))
+    print(f"{'stage':18s} {'status':>8s} {'seconds':>9s} {'cpu s':>9s} {'peak MB':>9s} {'change':>8s}")
+    for stage, r in result["stages"].items():
+        previous_seconds = previous["stages"].get(stage, {}).get("seconds") if previous else None
+        status = "ok" if r["returncode"] == 0 else f"exit {r['returncode']}"
+        print(f"{stage:18s} {status:>8s} {r['seconds']:9.2f} {r['cpu_seconds']:9.2f} {r['max_rss_mb']:9.1f} "
+              f"{change(r['seconds'], previous_seconds):>8s}")
+        if stage == "inference":
+            inference_stages = result.get("inference_stages", {})
+            for sub_stage in sorted(inference_stages, key=inference_stages.get, reverse=True):
+                previous_seconds = previous.get("inference_stages", {}).get(sub_stage) if previous else None
+                print(f"  {sub_stage:16s} {'':>8s} {inference_stages[sub_stage]:9.2f} {'':>9s} {'':>9s} "
+                      f"{change(inference_stages[sub_stage], previous_seconds):>8s}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the forecast pipeline with synthetic inputs and random generators.")
+    parser.add_argument("--accumulation", help="Accumulations to benchmark", nargs="+", default=["6h", "24h"],
+                        choices=["6h", "24h"])
+    parser.add_argument("--stages", help="Stages of run_forecast.py to run", nargs="+", default=all_stages,
+                        choices=all_stages)
+    parser.add_argument("--members", help="Ensemble members", default=20, type=int)
+    parser.add_argument("--workers", help="Processes computing the histogram counts", default=1, type=int)
+    parser.add_argument("--seed", help="Seed of the synthetic IFS data and generator weights", default=0, type=int)
+    parser.add_argument("--date", help="Initialisation date of the synthetic forecast, YYYYMMDD", default="20250101",
+                        type=str)
+    parser.add_argument("--work_dir", help="Directory for the sandboxes and inputs",
+                        default=os.path.join(benchmark_dir, "work"), type=str)
+    parser.add_argument("--results", help="JSON-lines file the results are appended to",
+                        default=os.path.join(benchmark_dir, "results.jsonl"), type=str)
+    args = parser.parse_args()
+    args.work_dir = os.path.abspath(args.work_dir)
+    args.stages = [stage for stage in all_stages if stage in args.stages]  # in pipeline order
+
+    # The synthetic IFS file is made once for each seed and date
+    ifs_path = os.path.join(args.work_dir, "inputs", f"seed{args.seed}", f"IFS_{args.date}_00Z.nc")
+    if not os.path.isfile(ifs_path):
+        print(f"Synthetic IFS data: {ifs_path}")
+        os.makedirs(os.path.dirname(ifs_path), exist_ok=True)
+        write_synthetic_ifs(ifs_path + ".tmp", datetime.strptime(args.date, "%Y%m%d"), seed=args.seed,
+                            orography_path=os.path.join(root_dir, "cGAN_data", "elev.nc"))
+        os.replace(ifs_path + ".tmp", ifs_path)
+
+    for accumulation in args.accumulation:
+        result = benchmark_accumulation(accumulation, args, ifs_path)
+        print_result(result, previous_result(args.results, result))
+        with open(args.results, "a") as f:
+            f.write(json.dumps(result) + "\n")
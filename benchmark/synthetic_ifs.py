@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+# Write a synthetic IFS forecast file, IFS_<date>_<hh>Z.nc, for benchmarking
+# the forecast pipeline without access to the ECMWF data on gbmc.
+#
+# Usage:
+#    python synthetic_ifs.py IFS_20250101_00Z.nc
+#    python synthetic_ifs.py IFS_20250101_00Z.nc --seed 1 --orography ../cGAN_data/elev.nc
+#
+# The file has the layout the forecast scripts read: the ensemble mean and
+# standard deviation of every field used by the 6h or the 24h model, at
+# num_steps 6 hourly valid times on the 384 x 352 ICPAC grid.  The 24h
+# forecasts read time steps 1 to 29, so 30 are written by default.
+#
+# The fields are smooth random patterns that change from one time step to
+# the next, with plausible units and magnitudes: intermittent rain, a daily
+# cycle of solar radiation and temperature, and surface pressure and
+# temperature that fall with height if the orography is given.  They are not
+# meteorologically consistent with each other, which does not matter for
+# timing the pipeline.  The same seed always gives the same file.
+
+import argparse
+import os
+from datetime import datetime, timedelta
+
+import netCDF4 as nc
+import numpy as np
+
+# The ICPAC grid, as in cGAN/dsrnngan/forecast_date.py
+latitude = np.arange(-13.65, 24.7, 0.1)
+longitude = np.arange(19.15, 54.3, 0.1)
+
+# Every field of the 6h and 24h models, with how its ensemble mean is made:
+# (kind, typical value, variability), in the units of the IFS files
+field_specs = {"cape": ("positive", 500.0, 400.0),       # J/kg
+               "cp": ("rain", 0.002, None),              # m, 6h accumulation
+               "mcc": ("fraction", 0.4, 0.3),            # 0 to 1
+               "sp": ("pressure", 101325.0, 300.0),      # Pa
+               "ssr": ("radiation", 1.5e7, 0.2),         # J/m^2, 6h accumulation
+               "t2m": ("temperature", 300.0, 2.0),       # K
+               "tciw": ("positive", 0.05, 0.05),         # kg/m^2
+               "tclw": ("positive", 0.1, 0.1),           # kg/m^2
+               "tcrw": ("positive", 0.05, 0.05),         # kg/m^2
+               "tcw": ("positive", 30.0, 10.0),          # kg/m^2
+               "tcwv": ("positive", 30.0, 10.0),         # kg/m^2
+               "tp": ("rain", 0.004, None),              # m, 6h accumulation
+               "u700": ("wind", 0.0, 6.0),               # m/s
+               "v700": ("wind", 0.0, 4.0)}               # m/s
+
+# Grid points between the random values that are interpolated to make the
+# smooth patterns, and the correlation of the patterns between time steps
+pattern_spacing = 16
+step_correlation = 0.8
+
+
+def interpolation_matrix(num_fine, num_coarse):
+    # num_fine x num_coarse matrix, linearly interpolating num_coarse evenly
+    # spaced values to num_fine points
+    positions = np.linspace(0, num_coarse - 1, num_fine)
+    return np.stack([np.interp(positions, np.arange(num_coarse), column) for column in np.eye(num_coarse)], axis=1)
+
+
+class SmoothPatterns(object):
+    '''
+    Makes smooth random patterns on the grid, of zero mean and unit
+    variance (roughly), that evolve over time steps.
+    '''
+    def __init__(self, rng, shape):
+        self.rng = rng
+        coarse_shape = tuple(n // pattern_spacing + 2 for n in shape)
+        self.interp_lat = interpolation_matrix(shape[0], coarse_shape[0])
+        self.interp_lon = interpolation_matrix(shape[1], coarse_shape[1])
+        self.coarse_shape = coarse_shape
+        # Interpolation smooths the values, so they are scaled back up
+        variance = (self.interp_lat**2).sum(axis=1).mean() * (self.interp_lon**2).sum(axis=1).mean()
+        self.scale = 1.0/np.sqrt(variance)
+
+    def steps(self, num_steps):
+        # num_steps x lat x lon patterns, each correlated with the one before
+        coarse = self.rng.standard_normal(self.coarse_shape)
+        patterns = []
+        for _ in range(num_steps):
+            patterns.append(self.scale * self.interp_lat @ coarse @ self.interp_lon.T)
+            coarse = step_correlation*coarse + np.sqrt(1 - step_correlation**2)*self.rng.standard_normal(self.coarse_shape)
+        return np.stack(patterns)
+
+
+def field_steps(field, patterns, local_hours, elevation):
+    '''
+    The ensemble mean and standard deviation of field, steps x lat x lon,
+    from patterns made by SmoothPatterns.  local_hours is the local time of
+    day at the end of each step, and elevation (lat x lon, m) the height of
+    the ground.
+    '''
+    kind, value, variability = field_specs[field]
+    mean_pattern, sd_pattern = patterns.steps(len(local_hours)), patterns.steps(len(local_hours))
+    spread = 0.5 + 0.25*np.abs(sd_pattern)  # standard deviation relative to the field's variability
+    hours = np.asarray(local_hours)[:, None, None]
+    if kind == "positive":
+        mean = np.maximum(value + variability*mean_pattern, 0.0)
+        sd = variability*spread
+    elif kind == "fraction":
+        mean = np.clip(value + variability*mean_pattern, 0.0, 1.0)
+        sd = variability*spread*np.sqrt(mean*(1 - mean))*2
+    elif kind == "rain":
+        # Rain falls over about a third of the domain
+        mean = value*np.maximum(mean_pattern - 0.5, 0.0)**1.5
+        sd = mean*spread + 0.1*value*np.maximum(mean_pattern, 0.0)
+    elif kind == "radiation":
+        # Accumulated over the 6 hours before the end of the step
+        daylight = np.maximum(np.cos((hours - 3 - 12)/24*2*np.pi), 0.0)
+        mean = value*daylight*np.clip(1 - variability*np.abs(mean_pattern), 0.0, 1.0)
+        sd = variability*mean*spread
+    elif kind == "temperature":
+        daily_cycle = 5*np.cos((hours - 15)/24*2*np.pi)
+        mean = value - 0.0065*elevation + daily_cycle + variability*mean_pattern
+        sd = variability*spread/2
+    elif kind == "pressure":
+        mean = value*np.exp(-elevation/8400) + variability*mean_pattern
+        sd = variability*spread/2
+    elif kind == "wind":
+        mean = value + variability*mean_pattern
+        sd = variability*spread/2
+    else:
+        raise ValueError(f"unknown kind {kind} of field {field}")
+    return mean.astype(np.float32), np.broadcast_to(sd, mean.shape).astype(np.float32)
+
+
+def write_synthetic_ifs(nc_out_path, init_time, num_steps=30, seed=0, orography_path=None, complevel=1):
+    '''
+    Write a synthetic IFS file to nc_out_path, for the forecast initialised
+    at init_time (a datetime), with num_steps 6 hourly valid times, the
+    first at init_time.  Fields made with the same seed are the same.  If
+    orography_path is given, a netCDF file with the ICPAC grid's elevation
+    (e.g. cGAN_data/elev.nc), the surface pressure and temperature depend on
+    it.  The variables are compressed with zlib at complevel, in chunks of
+    one time step, unless complevel is 0.
+    '''
+    rng = np.random.default_rng(seed)
+    shape = (len(latitude), len(longitude))
+    if orography_path is None:
+        elevation = np.zeros(shape)
+    else:
+        with nc.Dataset(orography_path, mode="r") as nc_orog:
+            elevation = np.maximum(np.array(nc_orog["elevation"][:], dtype=np.float64), 0.0)
+        assert elevation.shape == shape, f"orography in {orography_path} is not on the ICPAC grid"
+
+    init_hours = (init_time - datetime(1900, 1, 1)) / timedelta(hours=1)
+    valid_hours = init_hours + 6*np.arange(num_steps)
+    local_hours = (valid_hours + 3) % 24  # East Africa Time
+
+    rootgrp = nc.Dataset(nc_out_path, "w", format="NETCDF4")
+    rootgrp.description = f"Synthetic IFS forecast for benchmarking, seed {seed}"
+    rootgrp.createDimension("time", 1)
+    rootgrp.createDimension("valid_time", num_steps)
+    rootgrp.createDimension("latitude", len(latitude))
+    rootgrp.createDimension("longitude", len(longitude))
+
+    time_data = rootgrp.createVariable("time", "f8", ("time",))
+    time_data.units = "hours since 1900-01-01 00:00:00.0"
+    time_data[:] = [init_hours]
+    valid_time_data = rootgrp.createVariable("valid_time", "f8", ("valid_time",))
+    valid_time_data.units = "hours since 1900-01-01 00:00:00.0"
+    valid_time_data[:] = valid_hours
+    latitude_data = rootgrp.createVariable("latitude", "f4", ("latitude",))
+    latitude_data.units = "degrees_north"
+    latitude_data[:] = latitude
+    longitude_data = rootgrp.createVariable("longitude", "f4", ("longitude",))
+    longitude_data.units = "degrees_east"
+    longitude_data[:] = longitude
+
+    patterns = SmoothPatterns(rng, shape)
+    compression = {"zlib": True, "complevel": complevel, "chunksizes": (1,) + shape} if complevel > 0 else {}
+    for field in field_specs:
+        mean, sd = field_steps(field, patterns, local_hours, elevation)
+        for name, data in ((f"{field}_ensemble_mean", mean), (f"{field}_ensemble_standard_deviation", sd)):
+            var = rootgrp.createVariable(name, "f4", ("valid_time", "latitude", "longitude"), **compression)
+            var[:] = data
+    rootgrp.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Write a synthetic IFS forecast file for benchmarking.")
+    parser.add_argument("nc_out_path", help="File to write, IFS_<YYYYMMDD>_<HH>Z.nc; the date and hour are taken from its name")
+    parser.add_argument("--num_steps", help="Number of 6 hourly valid times", default=30, type=int)
+    parser.add_argument("--seed", help="Seed of the random fields", default=0, type=int)
+    parser.add_argument("--orography", help="netCDF file of the elevation on the ICPAC grid", default=None, type=str)
+    parser.add_argument("--complevel", help="zlib compression level, 0 for none", default=1, type=int)
+    args = parser.parse_args()
+
+    try:
+        init_time = datetime.strptime(os.path.basename(args.nc_out_path), "IFS_%Y%m%d_%HZ.nc")
+    except ValueError:
+        parser.error(f"{args.nc_out_path} is not named IFS_<YYYYMMDD>_<HH>Z.nc")
+    write_synthetic_ifs(args.nc_out_path, init_time, args.num_steps, args.seed, args.orography, args.complevel)
@@ -30,6 +30,21 @@
 # Run todays 6h forecasts initialised at 0000 and delete the forecasts once
 # statistics have been computed
 #    python run_forecast.py --delete_forecasts Y
+#
+# Run todays 6h forecasts initialised at 0000, computing the histogram counts
+# with 8 processes
+#    python run_forecast.py --workers 8
+#
+# If forecast_worker.py is running in 6h_accumulations/cGAN/dsrnngan or
+# 24h_accumulations/cGAN/dsrnngan the cGAN forecasts are sent to it, so the
+# models do not need to be loaded again for every forecast.
+#
+# If write_counts is True in the forecast.yaml of the cGAN/dsrnngan
+# directory the histogram counts are written while the forecast is made. If
+# write_ensemble is False the ensemble members are not saved, and a forecast
+# is only run when its counts files are missing. If write_quantiles is True
+# the quantile summaries of the ensemble, GAN_*_quantiles.nc, are kept when
+# the forecasts are deleted.
 
 import argparse
 import sys
@@ -37,6 +52,20 @@ import os
 import subprocess
 import pathlib
 import datetime
+import json
+import time
+import yaml
+
+
+# How often to check whether the forecast worker has finished a job (seconds)
+worker_poll_seconds = 5
+
+# The longest a forecast worker job may take before it is withdrawn and the
+# forecast run by forecast_date.py instead (seconds): this base, plus this
+# much for each ensemble member of each valid time, several times what a CPU
+# takes
+worker_timeout_base_seconds = 600
+worker_timeout_member_seconds = 10
 
 
 # Parse arguments to this script
@@ -70,11 +99,16 @@ def parseArguments():
  Run todays 6h forecasts initialised at 0000 and delete the forecasts once
  statistics have been computed
     python run_forecast.py --delete_forecasts Y  
+
+ Run todays 6h forecasts initialised at 0000, computing the histogram
+ counts with 8 processes
+    python run_forecast.py --workers 8
     """, formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('--accumulation', help='How long rainfall is accumulated for, either 6h or 24h',default=None,type=str)
     parser.add_argument('--date', help='Forecast initialisation date (YYMMDD)',default=None,type=str)
     parser.add_argument('--time', help='Forecast initialisation time (HHMM)',default=None,type=str)    
     parser.add_argument('--delete_forecasts', help='Should forecasts be deleted or not (Y/N)',default=None,type=str)
+    parser.add_argument('--workers', help='Number of processes used to compute the histogram counts',default=1,type=int)
     args = parser.parse_args()
     
     # Parse the accumulation
@@ -157,7 +191,7 @@ def parseArguments():
             delete_forecasts = True
         
     
-    return accumulation_time, year, month, day, hour, minute, delete_forecasts
+    return accumulation_time, year, month, day, hour, minute, delete_forecasts, args.workers
 
 
 # Checks that all of the histogram counts files for this date and time are there or not.
@@ -201,10 +235,113 @@ def check_ELR_files():
     return True
 
 
+# Checks whether the cGAN forecast script saves every ensemble member.
+# Arguments:
+#    script_path - The directory containing forecast_date.py and forecast.yaml.
+# Returns:
+#    The value of write_ensemble in forecast.yaml.
+def ensemble_written(script_path):
+
+    with open(f"{script_path}/forecast.yaml", "r") as f:
+        fcst_params = yaml.safe_load(f)
+
+    return fcst_params["OUTPUT"]["write_ensemble"]
+
+
+# The longest to wait for the forecast worker to run a job.
+# Arguments:
+#    script_path     - The directory containing forecast_date.py and forecast.yaml.
+#    num_valid_times - The number of valid times in the job.
+# Returns:
+#    The timeout in seconds, from the ensemble size in forecast.yaml.
+def worker_timeout_seconds(script_path, num_valid_times):
+
+    with open(f"{script_path}/forecast.yaml", "r") as f:
+        fcst_params = yaml.safe_load(f)
+
+    ensemble_members = fcst_params["OUTPUT"]["ensemble_members"]
+    return worker_timeout_base_seconds + worker_timeout_member_seconds * ensemble_members * num_valid_times
+
+
+# Checks whether forecast_worker.py is running for a queue directory.
+# Arguments:
+#    queue_path - The queue directory the worker was started with.
+# Returns:
+#    If the worker process is running.
+def worker_running(queue_path):
+
+    pid_file = f"{queue_path}/worker.pid"
+    if not os.path.isfile(pid_file):
+        return False
+
+    try:
+        with open(pid_file, "r") as f:
+            pid = int(f.read())
+        os.kill(pid, 0)  # Signal 0 only checks that the process exists
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass  # The process exists but belongs to another user
+
+    # worker.pid is left behind if the worker is killed with SIGKILL, and its
+    # process id may then be reused, so check that the process is the worker
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            cmdline = f.read()
+    except FileNotFoundError:
+        return False
+    except OSError:
+        return True  # No /proc, e.g. not Linux, so trust the process id
+    return b"forecast_worker.py" in cmdline
+
+
+# Sends a forecast job to forecast_worker.py and waits for it to finish.
+# Arguments:
+#    queue_path - The queue directory the worker was started with.
+#    job_name   - A name for the job.
+#    job        - A dictionary with the arguments for the job.
+#    timeout    - The longest to wait for the job (seconds), see worker_timeout_seconds.
+# Returns:
+#    If the worker completed the job. False if the job failed, the worker
+#    stopped or the job took longer than timeout.
+def run_worker_job(queue_path, job_name, job, timeout):
+
+    job_root = f"{queue_path}/{job_name}_{os.getpid()}"
+
+    # Write then rename, so that the worker never sees a partly written job
+    with open(f"{job_root}.tmp", "w") as f:
+        json.dump(job, f)
+    os.rename(f"{job_root}.tmp", f"{job_root}.job")
+    deadline = time.time() + timeout
+
+    while True:
+        if os.path.isfile(f"{job_root}.done"):
+            os.remove(f"{job_root}.done")
+            return True
+
+        if os.path.isfile(f"{job_root}.failed"):
+            print(f"The forecast worker could not run the job, see {job_root}.failed")
+            return False
+
+        worker_stopped = not worker_running(queue_path)
+        if worker_stopped or time.time() > deadline:
+            if worker_stopped:
+                print("The forecast worker has stopped.")
+            else:
+                print(f"The forecast worker has not finished the job after {timeout:.0f} seconds.")
+            # Don't leave the job for the next worker that starts
+            for ext in [".job", ".running"]:
+                if os.path.isfile(f"{job_root}{ext}"):
+                    os.remove(f"{job_root}{ext}")
+            return False
+
+        time.sleep(worker_poll_seconds)
+
+
 if __name__=='__main__':
     
     # Parse arguments to this script
-    accumulation_time, year, month, day, hour, minute, delete_forecasts = parseArguments()
+    accumulation_time, year, month, day, hour, minute, delete_forecasts, workers = parseArguments()
     
     print(f"Producing forecasts of {accumulation_time}h accumulations")
     print(f"initialised on {year}-{month:02d}-{day:02d} at {hour:02d}{minute:02d}.")
@@ -238,6 +375,12 @@ if __name__=='__main__':
     # Where the 6h cGAN model forecast script is located
     cGAN_forecast_script_path_24h = f"{root_dir}/24h_accumulations/cGAN/dsrnngan"
 
+    # Where jobs are sent when the 6h forecast worker is running
+    forecast_queue_path_6h = f"{root_dir}/6h_accumulations/forecast_queue"
+
+    # Where jobs are sent when the 24h forecast worker is running
+    forecast_queue_path_24h = f"{root_dir}/24h_accumulations/forecast_queue"
+
     # Where the ELR model script is located
     ELR_script_path = f"{root_dir}/ELR/"
     
@@ -312,8 +455,9 @@ if __name__=='__main__':
         # Check to see if the ELR files are there first
         correct_num_ELR_files = check_ELR_files()
         
-        # If the counts files are there and delete_forecasts is true don't run the forecasts
-        if not (correct_num_counts_files and correct_num_ELR_files and delete_forecasts):
+        # If the counts files are there and the forecasts are, or will be, deleted don't run the forecasts
+        if not (correct_num_counts_files and correct_num_ELR_files and
+                (delete_forecasts or not ensemble_written(cGAN_forecast_script_path_6h))):
             
             # Create the directory for the cGAN forecasts if it doesn't exist
             pathlib.Path(cGAN_forecast_path_6h).mkdir(exist_ok=True)
@@ -325,12 +469,21 @@ if __name__=='__main__':
                 print(f"{cGAN_forecast_path_6h}/{file_name} already exists.")
             
             else:
-                print(f"Running 6h cGAN: forecast_date.py {date_str} {time_str}")
-                run_dir = cGAN_forecast_script_path_6h
-                subprocess.run(["python", "forecast_date.py", date_str, str(hour)], cwd=run_dir)
+                worker_done = False
+                if worker_running(forecast_queue_path_6h):
+                    print(f"Sending 6h cGAN forecast {date_str} {time_str} to the forecast worker")
+                    worker_done = run_worker_job(forecast_queue_path_6h, f"{date_str}_{hour:02d}Z",
+                                                 {"date": date_str, "hour": hour},
+                                                 worker_timeout_seconds(cGAN_forecast_script_path_6h,
+                                                                        len(valid_hours_6h)))
+
+                if not worker_done:
+                    print(f"Running 6h cGAN: forecast_date.py {date_str} {time_str}")
+                    run_dir = cGAN_forecast_script_path_6h
+                    subprocess.run(["python", "forecast_date.py", date_str, str(hour)], cwd=run_dir)
                 
         else:
-            print("Counts and ELR files exist and delete_forecasts is True; no forecast required.")
+            print("Counts and ELR files exist and the forecasts are not kept; no forecast required.")
     
     elif (accumulation_time == 24):
         
@@ -341,13 +494,15 @@ if __name__=='__main__':
         # Check to see if the ELR files are there first
         correct_num_ELR_files = check_ELR_files()
         
-        # If the counts and ELR files are there and delete_forecasts is true don't run the forecasts
-        if not (correct_num_counts_files and correct_num_ELR_files and delete_forecasts):
+        # If the counts and ELR files are there and the forecasts are, or will be, deleted don't run the forecasts
+        if not (correct_num_counts_files and correct_num_ELR_files and
+                (delete_forecasts or not ensemble_written(cGAN_forecast_script_path_24h))):
             
             # Create the directory for the cGAN forecasts if it doesn't exist
             pathlib.Path(cGAN_forecast_path_24h).mkdir(exist_ok=True)
             
-            # Perform a separate forecast for each lead time
+            # Find the lead times that haven't been forecast yet
+            lead_time_idxs = []
             for lead_time_idx in range(7):
             
                 file_name = f"GAN_{date_str}_{hour:02d}Z_v{lead_time_idx}.nc"
@@ -355,14 +510,28 @@ if __name__=='__main__':
                 # Check to see if the forecast is there first
                 if os.path.isfile(f"{cGAN_forecast_path_24h}/{file_name}"):
                     print(f"{cGAN_forecast_path_24h}/{file_name} already exists.")
-                
                 else:
-                    print(f"Running 24h cGAN: forecast_date.py {lead_time_idx} {date_str}")
+                    lead_time_idxs.append(lead_time_idx)
+
+            # Forecast all of the missing lead times together, so that the IFS
+            # data is read once and each model is loaded once
+            if len(lead_time_idxs) > 0:
+                lead_time_str = ",".join(str(idx) for idx in lead_time_idxs)
+                worker_done = False
+                if worker_running(forecast_queue_path_24h):
+                    print(f"Sending 24h cGAN forecasts {lead_time_str} {date_str} to the forecast worker")
+                    worker_done = run_worker_job(forecast_queue_path_24h, f"{date_str}_v{lead_time_str.replace(',', '')}",
+                                                 {"date": date_str, "valid_time_nums": lead_time_idxs},
+                                                 worker_timeout_seconds(cGAN_forecast_script_path_24h,
+                                                                        len(lead_time_idxs)))
+
+                if not worker_done:
+                    print(f"Running 24h cGAN: forecast_date.py {lead_time_str} {date_str}")
                     run_dir = cGAN_forecast_script_path_24h
-                    subprocess.run(["python", "forecast_date.py", str(lead_time_idx), date_str], cwd=run_dir)
+                    subprocess.run(["python", "forecast_date.py", lead_time_str, date_str], cwd=run_dir)
 
         else:
-            print("Counts and ELR files exist and delete_forecasts is True; no forecast required.")
+            print("Counts and ELR files exist and the forecasts are not kept; no forecast required.")
 
     # Compute the histogram counts
     
@@ -395,7 +564,8 @@ if __name__=='__main__':
             pathlib.Path(f"{cGAN_counts_path_6h}/{year}").mkdir(exist_ok=True)
             
             run_dir = f"{root_dir}/6h_accumulations"
-            subprocess.run(["python", "forecast2histogram_lowRAM.py", date_str, str(hour)], cwd=run_dir)
+            subprocess.run(["python", "forecast2histogram_lowRAM.py", date_str, str(hour),
+                            "--workers", str(workers)], cwd=run_dir)
         
         else:
             print("Histogram counts files already exist.")
@@ -426,7 +596,8 @@ if __name__=='__main__':
             pathlib.Path(f"{cGAN_counts_path_24h}/{year}").mkdir(exist_ok=True)
             
             run_dir = f"{root_dir}/24h_accumulations"
-            subprocess.run(["python", f"forecast2histogram_7d_lowRAM.py", date_str, str(hour)], cwd=run_dir)
+            subprocess.run(["python", f"forecast2histogram_7d_lowRAM.py", date_str, str(hour),
+                            "--workers", str(workers)], cwd=run_dir)
         
         else:
             print("Histogram counts files already exist.")